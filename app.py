@@ -1,12 +1,17 @@
 import modal
 from fastapi import FastAPI, HTTPException, Request
+from fastapi import Response as HTTPResponse
 from pathlib import Path
 from fastapi import FastAPI
-from models import ImageRequest, ImageResponse, Response
+from models import ImageRequest, ImageResponse, Response, BatchImageRequest, BatchImageResponse, BatchResponse
 from fastapi import HTTPException
 import time
-from utils import base64_to_image, image_to_base64,run_sam
-from config import logger
+from utils import bytes_to_model_image, mask_image_bytes, mask_media_type, run_sam, run_sam_batch, parse_coordinates, predict_masks, predict_prompt_groups, original_size_for
+from config import logger, EMBEDDING_CACHE_MAX_BYTES, DOWNSCALE_ON_DECODE
+from mask_formats import COMPACT_FORMATS, encode_mask, merge_masks
+from embedding_cache import set_image_cached
+from tracing import bound_request_id, client_request_id, client_request_id_var, new_request_id, request_id_var
+import metrics
 import numpy as np
 
 # CUDA version and dependencies
@@ -70,12 +75,14 @@ mask_image = (
     "opencv-python==4.10.0.84",
     "packaging==24.2",
     "pillow==11.0.0",
+    "prometheus_client==0.26.0",
     "protobuf==5.29.1",
     "pycocotools==2.0.8",
     "pydantic==2.10.3",
     "pydantic_core==2.27.1",
     "pyparsing==3.2.0",
     "python-dateutil==2.9.0.post0",
+    "python-multipart==0.0.20",
     "requests==2.32.3",
     "git+https://github.com/facebookresearch/segment-anything.git@dca509fe793f601edb92606367a655c15ac00fdf#egg=segment_anything",
     "setuptools==75.6.0",
@@ -109,6 +116,12 @@ local_config_path = Path("/home/bilal/sahal/sam_serverless/config.py").resolve()
 local_utils_path = Path("/home/bilal/sahal/sam_serverless/utils.py").resolve()
 local_models_init_path = Path("/home/bilal/sahal/sam_serverless/models_init.py").resolve()
 local_models_path = Path("/home/bilal/sahal/sam_serverless/models.py").resolve()
+local_embedding_cache_path = Path("/home/bilal/sahal/sam_serverless/embedding_cache.py").resolve()
+local_mask_formats_path = Path("/home/bilal/sahal/sam_serverless/mask_formats.py").resolve()
+local_metrics_path = Path("/home/bilal/sahal/sam_serverless/metrics.py").resolve()
+local_checkpoints_path = Path("/home/bilal/sahal/sam_serverless/checkpoints.py").resolve()
+local_inference_opt_path = Path("/home/bilal/sahal/sam_serverless/inference_opt.py").resolve()
+local_tracing_path = Path("/home/bilal/sahal/sam_serverless/tracing.py").resolve()
 # local_SUPIR_path = Path("/home/nimra/sahal/SUPIR/SUPIR").resolve()
 # local_sgm_path = Path("/home/nimra/sahal/SUPIR/sgm").resolve()
 
@@ -117,6 +130,12 @@ remote_config_path = Path("/root/config.py")
 remote_utils_path = Path("/root/utils.py")
 remote_models_init_path = Path("/root/models_init.py")
 remote_models_path = Path("/root/models.py")
+remote_embedding_cache_path = Path("/root/embedding_cache.py")
+remote_mask_formats_path = Path("/root/mask_formats.py")
+remote_metrics_path = Path("/root/metrics.py")
+remote_checkpoints_path = Path("/root/checkpoints.py")
+remote_inference_opt_path = Path("/root/inference_opt.py")
+remote_tracing_path = Path("/root/tracing.py")
 # remote_SUPIR_path = Path("/root/SUPIR")
 # remote_sgm_path = Path("/root/sgm")
 
@@ -126,6 +145,12 @@ mounts = [
     modal.Mount.from_local_file(local_utils_path, remote_utils_path),
     modal.Mount.from_local_file(local_config_path, remote_config_path),
     modal.Mount.from_local_file(local_models_path, remote_models_path),
+    modal.Mount.from_local_file(local_embedding_cache_path, remote_embedding_cache_path),
+    modal.Mount.from_local_file(local_mask_formats_path, remote_mask_formats_path),
+    modal.Mount.from_local_file(local_metrics_path, remote_metrics_path),
+    modal.Mount.from_local_file(local_checkpoints_path, remote_checkpoints_path),
+    modal.Mount.from_local_file(local_inference_opt_path, remote_inference_opt_path),
+    modal.Mount.from_local_file(local_tracing_path, remote_tracing_path),
     # modal.Mount.from_local_file(local_SUPIR_path, remote_SUPIR_path),
     # modal.Mount.from_local_file(local_sgm_path, remote_sgm_path),
 ]
@@ -144,38 +169,109 @@ class Model:
     @modal.enter()  #Enter the container
     def start_runtime(self):
         from models_init import initialize_models
+        from embedding_cache import EmbeddingCache
         global model
-        model = initialize_models()
+        # Warm before the container takes its first call
+        model = initialize_models(warmup=True)
         self.model = model
+        self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MAX_BYTES)
+        # Set to decode large images straight to the model input size
+        self.target_length = model.transform.target_length if DOWNSCALE_ON_DECODE else None
         print("Models initialized successfully")
 
     @modal.method()
-    def segment_image(self,request: ImageRequest) -> ImageResponse:
-        request_id = str(int(time.time()))
+    def segment_image(self, request: ImageRequest, request_id: str = None, client_id: str = "-") -> ImageResponse:
+        # Logged under the ID the web container gave the request
+        with metrics.IN_FLIGHT.track_inprogress(), bound_request_id(request_id or new_request_id(), client_id):
+            return self._segment_image(request)
+
+    def _segment_image(self, request: ImageRequest) -> ImageResponse:
+        request_id = request_id_var.get()
         start_time = time.time()
         logger.info(f"Request {request_id} received at {start_time}")
         item = request.input
-        pil_image = base64_to_image(item.target_image)
+        # The request validator already decoded the base64 payload
+        pil_image, size = bytes_to_model_image(item.image_bytes, self.target_length)
         
         # Validate and reshape coordinates
-        pos_coord = np.array(item.pos_coord)
-        if pos_coord.ndim == 1:
-            # Reshape flat list to list of lists
-            pos_coord = pos_coord.reshape(-1, 2)
-        elif pos_coord.ndim != 2 or pos_coord.shape[1] != 2:
-            raise ValueError("pos_coord must be a list of [x, y] coordinate pairs.")
+        pos_coord = parse_coordinates(item.pos_coord)
+
+        if item.format in COMPACT_FORMATS:
+            # Straight from the boolean masks, no rendering or PNG encoding
+            set_image_cached(self.model, np.array(pil_image), self.embedding_cache, original_size_for(pil_image, size))
+            masks = predict_masks(self.model, pos_coord)
+            return ImageResponse(output=Response(**encode_mask(merge_masks(masks), item.format)))
         
-        masked_image = run_sam(pil_image, pos_coord, self.model)
+        masked_image = run_sam(pil_image, pos_coord, self.model, self.embedding_cache, size)
 
-        # Convert the image to base64 for the response
-        img_base64 = image_to_base64(masked_image)
-        return ImageResponse(output=Response(mask=f"data:image/png;base64,{img_base64}"))
+        return ImageResponse(output=Response.from_image_bytes(mask_image_bytes(masked_image), mask_media_type()))
+
+    @modal.method()
+    def segment_image_batch(self, request: BatchImageRequest, request_id: str = None, client_id: str = "-") -> BatchImageResponse:
+        with metrics.IN_FLIGHT.track_inprogress(), bound_request_id(request_id or new_request_id(), client_id):
+            return self._segment_image_batch(request)
+
+    def _segment_image_batch(self, request: BatchImageRequest) -> BatchImageResponse:
+        request_id = request_id_var.get()
+        start_time = time.time()
+        item = request.input
+        logger.info(f"Batch request {request_id} with {len(item.prompts)} prompt groups received at {start_time}")
+        pil_image, size = bytes_to_model_image(item.image_bytes, self.target_length)
+
+        prompt_groups = [parse_coordinates(group) for group in item.prompts]
+
+        if item.format in COMPACT_FORMATS:
+            set_image_cached(self.model, np.array(pil_image), self.embedding_cache, original_size_for(pil_image, size))
+            masks = predict_prompt_groups(self.model, prompt_groups)
+            results = [Response(**encode_mask(merge_masks(mask), item.format)) for mask in masks]
+            return BatchImageResponse(output=BatchResponse(results=results))
+
+        masked_images = run_sam_batch(pil_image, prompt_groups, self.model, self.embedding_cache, size)
+
+        image_bytes_list = [mask_image_bytes(masked_image) for masked_image in masked_images]
+        return BatchImageResponse(output=BatchResponse.from_image_bytes(image_bytes_list, mask_media_type()))
+
+    @modal.method()
+    def cache_stats(self) -> dict:
+        return self.embedding_cache.stats()
+
+    @modal.method()
+    def metrics_snapshot(self) -> list:
+        # Plain tuples, so the snapshot pickles across to the web container
+        return metrics.collect(container="model")
 
 # Instantiate the Modal Model class
 app_model = Model()
 
+@web_app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start_time = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.REQUEST_SECONDS.labels(path).observe(time.perf_counter() - start_time)
+        metrics.REQUESTS.labels(path, status).inc()
+
+@web_app.middleware("http")
+async def assign_request_id(request: Request, call_next):
+    # Always an ID of our own, the client's X-Request-ID is only logged and echoed
+    request_id = new_request_id()
+    client_id = client_request_id(request.headers.get("X-Request-ID"))
+    request_id_var.set(request_id)
+    client_request_id_var.set(client_id)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    if client_id != "-":
+        response.headers["X-Client-Request-ID"] = client_id
+    return response
+
 # Define the endpoint
-@web_app.post("/mask_image", response_model=ImageResponse)
+@web_app.post("/mask_image", response_model=ImageResponse, response_model_exclude_none=True)
 async def generate_images_endpoint(request: Request):
     try:
         # Parse the incoming JSON request into an ImageRequest object
@@ -183,11 +279,36 @@ async def generate_images_endpoint(request: Request):
         image_request = ImageRequest(**request_data)
 
         # Call the generate_images method asynchronously
-        image_response = await app_model.segment_image.remote.aio(image_request)
+        image_response = await app_model.segment_image.remote.aio(image_request, request_id_var.get(), client_request_id_var.get())
         return image_response
     except Exception as e:
+        metrics.ERRORS.labels(type(e).__name__).inc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Several prompt groups against one image, encoded once
+@web_app.post("/mask_image/batch", response_model=BatchImageResponse, response_model_exclude_none=True)
+async def generate_images_batch_endpoint(request: Request):
+    try:
+        request_data = await request.json()
+        batch_request = BatchImageRequest(**request_data)
+        return await app_model.segment_image_batch.remote.aio(batch_request, request_id_var.get(), client_request_id_var.get())
+    except Exception as e:
+        metrics.ERRORS.labels(type(e).__name__).inc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# Embedding-cache counters of the container that serves this call
+@web_app.get("/cache/stats")
+async def cache_stats_endpoint():
+    return await app_model.cache_stats.remote.aio()
+
+# Prometheus metrics of this web container merged with those of the model
+# container that serves the call, told apart by the `container` label
+@web_app.get("/metrics")
+async def metrics_endpoint():
+    model_metrics = await app_model.metrics_snapshot.remote.aio()
+    content = metrics.render(metrics.collect(container="web"), model_metrics)
+    return HTTPResponse(content=content, media_type=metrics.CONTENT_TYPE)
+
 # Serve the FastAPI app using Modal
 @app.function(
     image=mask_image,
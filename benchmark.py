@@ -0,0 +1,247 @@
+# CPU benchmark of the segmentation pipeline against the tiny random-weight SAM
+# (see stub_predictor.py), so it runs anywhere without a checkpoint or a GPU:
+#   python benchmark.py --output bench_results.json
+#   python benchmark.py --sizes 1024,5472 --prompts 1,8 --compare bench_results.json
+#   python benchmark.py --stages mask_encode
+# Results are JSON with the commit they were measured on; --compare prints
+# the ratio of every median against an earlier results file.
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# Must be set before endpoint/config are imported
+os.environ.setdefault("SAM_MODEL_TYPE", "tiny")
+os.environ.setdefault("SAM_DEVICE", "cpu")
+
+import numpy as np
+import PIL
+import torch
+from PIL import Image
+
+from utils import MASK_IMAGE_ENCODINGS, base64_to_image, draw_mask, encode_mask_image, image_to_base64, render_masks, run_sam
+
+# Longest image side; images are 4:3 like most camera photos (5472 is a 20 MP frame)
+DEFAULT_SIZES = (640, 1280, 2560, 5472)
+DEFAULT_PROMPTS = (1, 4, 16)
+
+STAGES = ("draw_mask", "image_to_base64", "mask_encode", "base64_to_image", "run_sam", "segment_image")
+
+
+def synthetic_image(width, height, seed=0):
+    """
+    Deterministic photo-like RGB image: smooth gradients, a few solid shapes
+    and mild noise, so it compresses roughly like a real picture (pure noise
+    would make every PNG/JPEG stage look far worse than in production).
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack([
+        255 * x / max(width - 1, 1),
+        255 * y / max(height - 1, 1),
+        127 + 64 * np.sin(x / 97.0) * np.cos(y / 61.0),
+    ], axis=-1)
+    for _ in range(12):
+        x0, y0 = rng.randint(0, width), rng.randint(0, height)
+        w, h = rng.randint(width // 16 + 1, width // 3 + 2), rng.randint(height // 16 + 1, height // 3 + 2)
+        image[y0:y0 + h, x0:x0 + w] = rng.randint(0, 256, 3)
+    image += rng.normal(0, 4, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def synthetic_mask(width, height):
+    """Ellipse covering about a third of the image, like a typical foreground object."""
+    y, x = np.ogrid[0:height, 0:width]
+    return ((x - width / 2) / (width / 3)) ** 2 + ((y - height / 2) / (height / 3)) ** 2 <= 1
+
+
+def prompt_points(width, height, count, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.stack([rng.uniform(0, width, count), rng.uniform(0, height, count)], axis=1).round()
+
+
+def jpeg_data_uri(image):
+    buffered = io.BytesIO()
+    Image.fromarray(image).save(buffered, format="JPEG", quality=90)
+    return "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+
+def measure(function, repeat, warmup):
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return timings
+
+
+def summarize(timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    return {
+        "repeat": len(timings_ms),
+        "median_ms": statistics.median(timings_ms),
+        "mean_ms": statistics.fmean(timings_ms),
+        "min_ms": timings_ms[0],
+        "p95_ms": timings_ms[min(len(timings_ms) - 1, int(round(0.95 * (len(timings_ms) - 1))))],
+        "stdev_ms": statistics.stdev(timings_ms) if len(timings_ms) > 1 else 0.0,
+    }
+
+
+def bench_cases(stages, sizes, prompt_counts):
+    """Yield (stage, width, height, prompts, function) for every benchmark case."""
+    predictor = None
+    endpoint = None
+    if "run_sam" in stages:
+        from models_init import initialize_models
+        predictor = initialize_models()
+    if "segment_image" in stages:
+        import endpoint
+        # The server loads it on startup
+        endpoint.load_model()
+
+    for size in sizes:
+        width, height = size, size * 3 // 4
+        image = synthetic_image(width, height)
+        mask = synthetic_mask(width, height)
+
+        if "draw_mask" in stages:
+            canvas = np.zeros((3, height, width), dtype=np.uint8)
+            yield "draw_mask", width, height, None, lambda: draw_mask(mask, canvas)
+        if "image_to_base64" in stages:
+            # What the endpoint encodes: a rendered black and white mask
+            mask_image = render_masks(mask[None], (width, height))
+            yield "image_to_base64", width, height, None, lambda: image_to_base64(mask_image)
+        if "mask_encode" in stages:
+            # Rendering and encoding of a response mask, once per MASK_IMAGE_FORMAT;
+            # the encoded size is recorded with the timings
+            for encoding in MASK_IMAGE_ENCODINGS:
+                yield f"mask_encode/{encoding}", width, height, None, lambda encoding=encoding: encode_mask_image(mask[None], (width, height), encoding)
+        if "base64_to_image" in stages:
+            data_uri = jpeg_data_uri(image)
+            yield "base64_to_image", width, height, None, lambda: base64_to_image(data_uri)
+
+        for count in prompt_counts:
+            coordinates = prompt_points(width, height, count)
+            if "run_sam" in stages:
+                pil_image = Image.fromarray(image)
+                yield "run_sam", width, height, count, lambda: run_sam(pil_image, coordinates, predictor)
+            if "segment_image" in stages:
+                from models import ImageRequest
+                payload = {"input": {"target_image": jpeg_data_uri(image), "pos_coord": coordinates.tolist()}}
+
+                def segment():
+                    # Cold path: request validation, decode, encoder, decoder, render, PNG and base64
+                    endpoint.embedding_cache.clear()
+                    endpoint.segment_image(ImageRequest(**payload))
+
+                yield "segment_image", width, height, count, segment
+
+
+def git_commit():
+    # Ask the checkout this file lives in, wherever the benchmark is run from
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def environment():
+    commit, dirty = git_commit()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+    }
+
+
+def case_key(result):
+    return (result["stage"], result["width"], result["height"], result["prompts"])
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    previous = {case_key(result): result for result in baseline["results"]}
+    print(f"\nCompared with {baseline_path} (commit {baseline['environment'].get('commit')}):", file=sys.stderr)
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        ratio = result["median_ms"] / old["median_ms"] if old["median_ms"] else float("inf")
+        print(f"  {_case_label(result):<40} {old['median_ms']:>10.2f} -> {result['median_ms']:>10.2f} ms  x{ratio:.2f}", file=sys.stderr)
+
+
+def _case_label(result):
+    label = f"{result['stage']} {result['width']}x{result['height']}"
+    if result["prompts"] is not None:
+        label += f" {result['prompts']} pt"
+    return label
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CPU-side stages of the segmentation pipeline.")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma separated subset of {', '.join(STAGES)}.")
+    parser.add_argument("--sizes", type=_int_list, default=list(DEFAULT_SIZES), help="Longest image sides, comma separated.")
+    parser.add_argument("--prompts", type=_int_list, default=list(DEFAULT_PROMPTS), help="Point counts per prompt, comma separated.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads, pin it for comparable numbers.")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare medians against.")
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    for stage, width, height, prompts, function in bench_cases(stages, args.sizes, args.prompts):
+        result = {"stage": stage, "width": width, "height": height, "prompts": prompts}
+        result.update(summarize(measure(function, args.repeat, args.warmup)))
+        if stage.startswith("mask_encode"):
+            result["bytes"] = len(function())
+        results.append(result)
+        print(f"{_case_label(result):<40} median {result['median_ms']:>10.2f} ms  "
+              f"p95 {result['p95_ms']:>10.2f} ms" + (f"  {result['bytes']:>10} bytes" if "bytes" in result else ""), file=sys.stderr)
+
+    report = {"environment": environment(), "config": vars(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
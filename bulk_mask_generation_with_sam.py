@@ -1,13 +1,27 @@
-import requests
+import argparse
+import asyncio
 import base64
 import json
 import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import httpx
 from PIL import Image  # <-- Make sure Pillow is installed
 
+# HTTP statuses worth retrying: the server queue is full or a proxy hiccuped
+RETRY_STATUSES = {429, 502, 503, 504}
+
 def load_image_to_base64(image_path):
     """Encode an image file to base64 format with the proper prefix."""
     with open(image_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
+        return image_bytes_to_base64(image_file.read())
+
+def image_bytes_to_base64(image_bytes):
+    """Encode image file bytes to base64 format with the proper prefix."""
+    encoded_string = base64.b64encode(image_bytes).decode("utf-8")
     return f"data:image/png;base64,{encoded_string}"
 
 def save_base64_image(base64_string, output_path):
@@ -16,10 +30,10 @@ def save_base64_image(base64_string, output_path):
         if base64_string.startswith("data:image"):
             base64_string = base64_string.split(",", 1)[1]
         image_data = base64.b64decode(base64_string)
-        
+
         # Ensure the directory exists
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
+
         with open(output_path, "wb") as f:
             f.write(image_data)
         print(f"Image saved to {output_path}")
@@ -34,117 +48,265 @@ def merge_images_horizontally(image_path_1, image_path_2, output_path):
     try:
         img1 = Image.open(image_path_1)
         img2 = Image.open(image_path_2)
+        merge_images(img1, img2, output_path)
+        print(f"Merged image saved to {output_path}")
 
-        # Determine final dimensions
-        total_width = img1.width + img2.width
-        max_height = max(img1.height, img2.height)
+    except Exception as e:
+        print(f"Error merging images: {e}")
 
-        # Create a new blank image with the combined width and max height
-        new_img = Image.new("RGB", (total_width, max_height))
+def merge_images(img1, img2, output_path):
+    """Paste two PIL images side by side and save the result at 'output_path'."""
+    # Determine final dimensions
+    total_width = img1.width + img2.width
+    max_height = max(img1.height, img2.height)
 
-        # Paste img1 at (0,0)
-        new_img.paste(img1, (0, 0))
-        # Paste img2 immediately after img1 in the x-axis
-        new_img.paste(img2, (img1.width, 0))
+    # Create a new blank image with the combined width and max height
+    new_img = Image.new("RGB", (total_width, max_height))
 
-        # Save the merged image
-        new_img.save(output_path)
-        print(f"Merged image saved to {output_path}")
+    # Paste img1 at (0,0)
+    new_img.paste(img1, (0, 0))
+    # Paste img2 immediately after img1 in the x-axis
+    new_img.paste(img2, (img1.width, 0))
 
-    except Exception as e:
-        print(f"Error merging images: {e}")
+    # Save the merged image
+    new_img.save(output_path)
 
-def process_images(folder_path, json_file_path, endpoint_url):
+def save_mask_and_comparison(image_bytes, mask_bytes, mask_output_path, merged_output_path):
     """
-    Reads from the JSON file line-by-line, skips images with empty coordinates,
-    sends a request to the endpoint for each valid entry, saves the mask,
-    and merges the original image with the mask horizontally for comparison.
+    Worker-pool job: write the mask and the side-by-side comparison, using the
+    image bytes already read for the request instead of re-reading the file.
     """
+    os.makedirs(os.path.dirname(mask_output_path) or ".", exist_ok=True)
+    with open(mask_output_path, "wb") as f:
+        f.write(mask_bytes)
+    merge_images(Image.open(BytesIO(image_bytes)), Image.open(BytesIO(mask_bytes)), merged_output_path)
 
-    if not os.path.isfile(json_file_path):
-        print(f"Error: JSON file '{json_file_path}' not found.")
-        return
+class Checkpoint:
+    """
+    Append-only record of finished entries, one JSON line each, so that a
+    restarted run skips everything that already completed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)["key"])
+                    except (json.JSONDecodeError, KeyError):
+                        # A line cut short by a crash
+                        continue
+        self._file = open(path, "a") if path else None
+
+    @staticmethod
+    def key(idx, target):
+        return f"{idx}:{target}"
+
+    def __contains__(self, key):
+        return key in self.done
 
+    def mark(self, key):
+        self.done.add(key)
+        if self._file:
+            self._file.write(json.dumps({"key": key}) + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+def iter_entries(json_file_path):
+    """Stream (line number, target, coordinates) from the JSONL coordinates file."""
     with open(json_file_path, 'r') as f:
-        lines = f.readlines()
+        for idx, line in enumerate(f, start=1):
+            try:
+                data = json.loads(line.strip())
+            except json.JSONDecodeError:
+                print(f"Skipping line {idx}: Invalid JSON format.")
+                continue
+            yield idx, data.get("target"), data.get("coordinates", [])
 
-    for idx, line in enumerate(lines, start=1):
+async def post_with_retry(client, endpoint_url, payload, max_retries=5, backoff=1.0):
+    """
+    POST `payload`, retrying busy (503) and gateway errors as well as
+    connection failures with exponential backoff and jitter. A Retry-After
+    header from the server takes precedence over the computed delay.
+    """
+    for attempt in range(max_retries + 1):
         try:
-            data = json.loads(line.strip())
-        except json.JSONDecodeError:
-            print(f"Skipping line {idx}: Invalid JSON format.")
-            continue
-
-        target = data.get("target")
-        coordinates = data.get("coordinates", [])
+            response = await client.post(endpoint_url, json=payload)
+            if response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+                return response
+            retry_after = response.headers.get("Retry-After")
+            error = httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+        except httpx.TransportError as e:
+            retry_after = None
+            error = e
+        if attempt == max_retries:
+            raise error
+        delay = backoff * 2 ** attempt * (0.5 + random.random())
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                pass
+        await asyncio.sleep(delay)
 
-        # Skip if coordinates are empty
-        if not coordinates:
-            print(f"Skipping '{target}' (line {idx}) because coordinates are empty.")
-            continue
+class Stats:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
 
-        # Build the local path to the image
-        image_path = os.path.join(folder_path, target)
-        if not os.path.exists(image_path):
-            print(f"Skipping '{target}' (line {idx}) because file not found: {image_path}")
-            continue
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        return (f"{self.done} done, {self.failed} failed, {self.skipped} skipped "
+                f"in {elapsed:.1f}s ({rate:.2f} images/s)")
 
-        # Convert image to Base64
-        base64_image = load_image_to_base64(image_path)
+async def _process_entry(client, pool, checkpoint, stats, folder_path, endpoint_url, idx, target, coordinates, max_retries):
+    image_path = os.path.join(folder_path, target)
+    loop = asyncio.get_running_loop()
+    # Every failure is counted here, an exception escaping would stop the worker
+    try:
+        with open(image_path, "rb") as image_file:
+            image_bytes = await loop.run_in_executor(None, image_file.read)
 
         # Prepare the payload
         payload = {
             "input": {
-                "target_image": base64_image,
+                "target_image": image_bytes_to_base64(image_bytes),
                 "pos_coord": coordinates
             }
         }
 
         print(f"Sending request to endpoint for image '{target}' (line {idx})...")
+        response = await post_with_retry(client, endpoint_url, payload, max_retries=max_retries)
+        response_data = response.json()
 
-        try:
-            response = requests.post(endpoint_url, json=payload)
-            response.raise_for_status()
+        # Get mask from response
+        mask_base64 = response_data.get("output", {}).get("mask")
+        folder_name = response_data.get("output", {}).get("folder_name", "default_masks")
+
+        if not mask_base64:
+            print(f"Warning: 'mask' key not found in response for image '{target}'.")
+            stats.failed += 1
+            return
+
+        # Paths to save the mask and the merged image; the mask keeps the server's format
+        header, encoded = mask_base64.split(",", 1)
+        mask_extension = ".webp" if header.startswith("data:image/webp") else ".png"
+        mask_output_path = os.path.join(folder_name, f"masked_{os.path.splitext(target)[0]}{mask_extension}")
+        merged_output_path = os.path.join(folder_name, f"comparison_{os.path.splitext(target)[0]}.png")
+        mask_bytes = base64.b64decode(encoded)
 
-            response_data = response.json()
-            print("Response received from server:")
-            print(json.dumps(response_data, indent=4))
+        # Compositing is CPU bound, keep it off the event loop
+        await loop.run_in_executor(pool, save_mask_and_comparison, image_bytes, mask_bytes, mask_output_path, merged_output_path)
+        checkpoint.mark(Checkpoint.key(idx, target))
+        stats.done += 1
+
+    except httpx.HTTPError as e:
+        print(f"Request failed for image '{target}': {e}")
+        stats.failed += 1
+    except OSError as e:
+        print(f"Could not read the image or write the mask for '{target}': {e}")
+        stats.failed += 1
+    except json.JSONDecodeError as e:
+        print(f"Failed to decode JSON response for image '{target}': {e}")
+        stats.failed += 1
+    except Exception as e:
+        print(f"An unexpected error occurred for image '{target}': {e}")
+        stats.failed += 1
+
+async def process_images_async(folder_path, json_file_path, endpoint_url, concurrency=4,
+                               checkpoint_path="bulk_checkpoint.jsonl", max_retries=5,
+                               composite_workers=None, timeout=300.0, report_every=50, transport=None):
+    """
+    Streams the JSON file line-by-line, skips images with empty coordinates or
+    entries already in the checkpoint, sends up to `concurrency` requests at a
+    time over a pooled HTTP client, saves each mask and merges the original
+    image with the mask horizontally for comparison in a worker pool.
+    `transport` stands in for the network, e.g. an httpx.MockTransport.
+    """
+
+    if not os.path.isfile(json_file_path):
+        print(f"Error: JSON file '{json_file_path}' not found.")
+        return
 
-            # Get mask from response
-            mask_base64 = response_data.get("output", {}).get("mask")
-            folder_name = response_data.get("output", {}).get("folder_name", "default_masks")
+    checkpoint = Checkpoint(checkpoint_path)
+    stats = Stats()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
 
-            if mask_base64:
-                # Paths to save the mask and the merged image
-                mask_filename = f"masked_{os.path.splitext(target)[0]}.png"
-                mask_output_path = os.path.join(folder_name, mask_filename)
+    async def worker():
+        while True:
+            entry = await queue.get()
+            try:
+                if entry is None:
+                    return
+                await _process_entry(client, pool, checkpoint, stats, folder_path, endpoint_url, *entry, max_retries)
+                if stats.done and stats.done % report_every == 0:
+                    print(f"Progress: {stats.report()}")
+            finally:
+                queue.task_done()
 
-                # Save mask image
-                save_base64_image(mask_base64, mask_output_path)
+    with ProcessPoolExecutor(max_workers=composite_workers) as pool:
+        # Bulk traffic queues behind interactive requests on the server
+        async with httpx.AsyncClient(timeout=timeout, limits=limits, headers={"X-Priority": "bulk"}, transport=transport) as client:
+            workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
 
-                # Create a name for the merged image
-                merged_filename = f"comparison_{os.path.splitext(target)[0]}.png"
-                merged_output_path = os.path.join(folder_name, merged_filename)
+            for idx, target, coordinates in iter_entries(json_file_path):
+                # Skip if coordinates are empty
+                if not coordinates:
+                    print(f"Skipping '{target}' (line {idx}) because coordinates are empty.")
+                    stats.skipped += 1
+                    continue
+                if Checkpoint.key(idx, target) in checkpoint:
+                    stats.skipped += 1
+                    continue
+                image_path = os.path.join(folder_path, target)
+                if not os.path.exists(image_path):
+                    print(f"Skipping '{target}' (line {idx}) because file not found: {image_path}")
+                    stats.skipped += 1
+                    continue
+                await queue.put((idx, target, coordinates))
 
-                # Merge original + mask horizontally
-                merge_images_horizontally(image_path, mask_output_path, merged_output_path)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
 
-            else:
-                print("Warning: 'mask' key not found in response.")
+    checkpoint.close()
+    print(f"Finished: {stats.report()}")
+    return stats
 
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed for image '{target}': {e}")
-        except json.JSONDecodeError as e:
-            print(f"Failed to decode JSON response for image '{target}': {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred for image '{target}': {e}")
+def process_images(folder_path, json_file_path, endpoint_url, **kwargs):
+    """Synchronous entry point, see `process_images_async` for the options."""
+    return asyncio.run(process_images_async(folder_path, json_file_path, endpoint_url, **kwargs))
 
 def main():
-    folder_path = "/home/nimra/segmentation_background_mask_checker/Not_in_training_samples_11300"
-    json_file_path = "/home/nimra/coordinates_generator/new_coordinate_generate/cords_set1_result.json"
-    endpoint_url = "https://nemoooooooooo--sam-fastapi-app.modal.run/mask_image/"
+    parser = argparse.ArgumentParser(description="Generate SAM masks for a folder of images through the HTTP endpoint.")
+    parser.add_argument("--folder", default="/home/nimra/segmentation_background_mask_checker/Not_in_training_samples_11300")
+    parser.add_argument("--coordinates", default="/home/nimra/coordinates_generator/new_coordinate_generate/cords_set1_result.json")
+    parser.add_argument("--endpoint", default="https://nemoooooooooo--sam-fastapi-app.modal.run/mask_image/")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once.")
+    parser.add_argument("--checkpoint", default="bulk_checkpoint.jsonl", help="Progress file used to resume a run.")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--composite-workers", type=int, default=None, help="Processes for saving masks and comparisons.")
+    args = parser.parse_args()
 
-    process_images(folder_path, json_file_path, endpoint_url)
+    process_images(
+        args.folder,
+        args.coordinates,
+        args.endpoint,
+        concurrency=args.concurrency,
+        checkpoint_path=args.checkpoint,
+        max_retries=args.max_retries,
+        composite_workers=args.composite_workers,
+    )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
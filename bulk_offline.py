@@ -0,0 +1,196 @@
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from bulk_mask_generation_with_sam import iter_entries, merge_images
+from config import logger
+from embedding_cache import restore_embedding, embedding_from_bytes
+from embedding_store import EmbeddingStore, file_hash, store_settings_from_args
+from models_init import initialize_models
+from pipeline import StageStats
+from utils import parse_coordinates, predict_mask_image, run_sam
+
+# Runs SAM over a folder in-process, without the HTTP endpoint:
+#   python bulk_offline.py --folder images/ --coordinates coords.jsonl --output masks/
+# The coordinates file uses the same JSONL format as bulk_mask_generation_with_sam.py.
+# With --embedding-store (see embedding_store.py), images found in the store
+# only run the mask decoder.
+
+# Keys of the embedding store, set in each decode process by `init_decoder`
+_stored_keys = frozenset()
+
+def init_decoder(stored_keys):
+    """Process-pool initializer: remember which images the embedding store has."""
+    global _stored_keys
+    _stored_keys = stored_keys
+
+def load_image(image_path):
+    """
+    Process-pool job: hash an image file and decode it to an RGB array, unless
+    the embedding store has it. Returns (array or None, seconds spent, embedding store key).
+    """
+    start_time = time.perf_counter()
+    with open(image_path, "rb") as f:
+        data = f.read()
+    key = file_hash(data)
+    if key in _stored_keys:
+        return None, time.perf_counter() - start_time, key
+    with Image.open(BytesIO(data)) as image:
+        array = np.asarray(image.convert("RGB"))
+    return array, time.perf_counter() - start_time, key
+
+def segment(image_array, coordinates, sam_predictor, embedding_store=None, key=None):
+    """Mask image for one entry, from the stored embedding of the image when there is one."""
+    stored = embedding_store.lookup(key) if embedding_store is not None else None
+    if stored is None:
+        return run_sam(Image.fromarray(image_array), coordinates, sam_predictor)
+    features, shape, original_size = stored
+    target_length = sam_predictor.transform.target_length
+    restore_embedding(sam_predictor, embedding_from_bytes(features, shape, original_size, target_length, sam_predictor.device))
+    return predict_mask_image(sam_predictor, coordinates, original_size[::-1])
+
+def write_outputs(image_array, image_path, mask_image, mask_output_path, merged_output_path):
+    """Writer job: save the mask and the side-by-side comparison. Images taken from the store are only decoded here."""
+    mask_image.save(mask_output_path)
+    if image_array is None:
+        with Image.open(image_path) as image:
+            merge_images(image.convert("RGB"), mask_image, merged_output_path)
+    else:
+        merge_images(Image.fromarray(image_array), mask_image, merged_output_path)
+
+def stage_report(stage):
+    stats = stage.stats(queued=0)
+    return (f"{stage.name}: {stats['processed']} items, {stats['busy_seconds']:.1f}s busy over "
+            f"{stats['workers']} worker(s), {stats['occupancy']:.0%} utilisation")
+
+def run_offline(folder_path, json_file_path, output_dir, sam_predictor, decode_workers=None,
+                writer_workers=2, queue_size=8, embedding_store=None):
+    """
+    Decode images in a process pool, keep up to `queue_size` of them decoded
+    ahead of the model, run SAM on the main thread and hand masks to
+    background writers. Images in `embedding_store` skip the image encoder,
+    and are only hashed ahead of the model, not decoded.
+    Prints throughput and per-stage utilisation at the end.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    decode_workers = decode_workers or os.cpu_count()
+    decode_stage = StageStats("decode", decode_workers)
+    model_stage = StageStats("model", 1)
+    write_stage = StageStats("write", writer_workers)
+    starved = 0.0
+    done = 0
+    failed = 0
+    stored = 0
+
+    start_time = time.perf_counter()
+    stored_keys = frozenset(embedding_store.entries) if embedding_store is not None else frozenset()
+    with ProcessPoolExecutor(max_workers=decode_workers, initializer=init_decoder, initargs=(stored_keys,)) as decode_pool, \
+            ThreadPoolExecutor(max_workers=writer_workers) as write_pool:
+        # Both windows are bounded so neither decoded images nor pending
+        # writes can pile up in memory
+        prefetched = deque()
+        pending_writes = deque()
+        entries = iter_entries(json_file_path)
+
+        def fill():
+            while len(prefetched) < queue_size:
+                entry = next(entries, None)
+                if entry is None:
+                    return
+                idx, target, coordinates = entry
+                image_path = os.path.join(folder_path, target or "")
+                if not coordinates or not os.path.isfile(image_path):
+                    print(f"Skipping '{target}' (line {idx}): empty coordinates or file not found.")
+                    continue
+                prefetched.append((target, image_path, coordinates, decode_pool.submit(load_image, image_path)))
+
+        fill()
+        while prefetched:
+            target, image_path, coordinates, future = prefetched.popleft()
+            wait_start = time.perf_counter()
+            try:
+                image_array, decode_time, key = future.result()
+            except Exception as e:
+                print(f"Error decoding '{target}': {e}")
+                failed += 1
+                fill()
+                continue
+            starved += time.perf_counter() - wait_start
+            decode_stage.add(decode_time)
+            fill()
+
+            try:
+                mask_image = model_stage.call(segment, image_array, parse_coordinates(coordinates), sam_predictor, embedding_store, key)
+            except Exception as e:
+                print(f"Error running SAM on '{target}': {e}")
+                failed += 1
+                continue
+            done += 1
+            stored += embedding_store is not None and key in embedding_store
+
+            name = os.path.splitext(target)[0]
+            while len(pending_writes) >= queue_size:
+                pending_writes.popleft().result()
+            pending_writes.append(write_pool.submit(
+                write_stage.call,
+                write_outputs,
+                image_array,
+                image_path,
+                mask_image,
+                os.path.join(output_dir, f"masked_{name}.png"),
+                os.path.join(output_dir, f"comparison_{name}.png"),
+            ))
+
+        for write in pending_writes:
+            write.result()
+
+    wall_time = time.perf_counter() - start_time
+    print(f"Finished: {done} images, {failed} failed in {wall_time:.1f}s ({done / wall_time:.2f} images/s)")
+    for stage in (decode_stage, model_stage, write_stage):
+        print(f"  {stage_report(stage)}")
+    print(f"  model waited {starved:.1f}s for decoded images")
+    if embedding_store is not None:
+        print(f"  {stored} from stored embeddings, {done - stored} encoded")
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate SAM masks for a folder of images in-process.")
+    parser.add_argument("--folder", required=True)
+    parser.add_argument("--coordinates", required=True, help="JSONL file of {\"target\", \"coordinates\"} entries.")
+    parser.add_argument("--output", default="default_masks")
+    parser.add_argument("--decode-workers", type=int, default=None, help="Processes decoding images, defaults to the CPU count.")
+    parser.add_argument("--writer-workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=8, help="Images decoded ahead of the model and writes in flight.")
+    parser.add_argument("--embedding-store", default=None, help="Directory of precomputed embeddings from embedding_store.py.")
+    parser.add_argument("--model-type", default=None)
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    # Images are decoded at full size here, so only a store computed that way fits
+    kwargs, settings = store_settings_from_args(args, False)
+    embedding_store = None
+    if args.embedding_store:
+        embedding_store = EmbeddingStore(args.embedding_store, settings)
+    sam_predictor = initialize_models(**kwargs)
+    logger.info("Models initialized successfully")
+
+    run_offline(
+        args.folder,
+        args.coordinates,
+        args.output,
+        sam_predictor,
+        decode_workers=args.decode_workers,
+        writer_workers=args.writer_workers,
+        queue_size=args.queue_size,
+        embedding_store=embedding_store,
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Conversion of SAM checkpoints into a form that loads without copying:
+#   python checkpoints.py sam_vit_h_4b8939.pth sam_vit_h.safetensors
+#   python checkpoints.py sam_vit_h_4b8939.pth sam_vit_h_fp16.safetensors --fp16
+# safetensors files are memory-mapped on load. Without the optional
+# safetensors package, pass a .pth output path instead: it is re-saved in
+# torch's zip format, which torch.load can memory-map as well.
+import argparse
+import os
+import time
+
+import torch
+
+from config import logger
+
+
+def _require_safetensors():
+    try:
+        import safetensors.torch
+    except ImportError as e:
+        raise ImportError("Loading or writing .safetensors checkpoints needs the safetensors package.") from e
+    return safetensors.torch
+
+
+def load_state_dict(path):
+    """
+    Load a SAM state dict from a .safetensors or torch checkpoint, memory
+    mapped, so tensors are only paged in as they are used.
+    """
+    if path.endswith(".safetensors"):
+        return _require_safetensors().load_file(path, device="cpu")
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def convert_checkpoint(source, destination, fp16=False):
+    """Re-save `source` as `destination` (.safetensors or .pth), optionally with floating point weights in fp16."""
+    start_time = time.perf_counter()
+    state_dict = torch.load(source, map_location="cpu", mmap=True, weights_only=True)
+    if fp16:
+        state_dict = {k: v.half() if v.is_floating_point() else v for k, v in state_dict.items()}
+    # safetensors refuses tensors sharing storage, and mmap'd ones must be contiguous
+    state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+
+    if destination.endswith(".safetensors"):
+        _require_safetensors().save_file(state_dict, destination)
+    else:
+        torch.save(state_dict, destination)
+    logger.info(
+        f"Converted {source} ({os.path.getsize(source) / 2**20:.0f} MB) to {destination} "
+        f"({os.path.getsize(destination) / 2**20:.0f} MB) in {time.perf_counter() - start_time:.1f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a SAM checkpoint into a memory-mappable format.")
+    parser.add_argument("source", help="Original SAM .pth checkpoint.")
+    parser.add_argument("destination", help="Output path, .safetensors or .pth.")
+    parser.add_argument("--fp16", action="store_true", help="Store floating point weights in fp16, half the size on disk.")
+    args = parser.parse_args()
+    convert_checkpoint(args.source, args.destination, fp16=args.fp16)
+
+
+if __name__ == "__main__":
+    main()
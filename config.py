@@ -1,10 +1,147 @@
 import logging
+import os
+
+from tracing import RequestIdFilter
 
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(levelname)s - [%(request_id)s client=%(client_request_id)s] %(message)s'
 )
+# Every record through the root handlers gets the IDs of the request it was logged for
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 logger = logging.getLogger(__name__)
 
+# SAM backbone, one of segment_anything's sam_model_registry keys, "tiny" for
+# the random-weight stand-in in stub_predictor.py (benchmarks only) or "stub"
+# for the same with an image encoder that only sleeps (load tests only)
+SAM_MODEL_TYPE = os.environ.get("SAM_MODEL_TYPE", "vit_h")
+DEFAULT_CHECKPOINTS = {
+    "vit_h": "sam_vit_h_4b8939.pth",
+    "vit_l": "sam_vit_l_0b3195.pth",
+    "vit_b": "sam_vit_b_01ec64.pth",
+}
+SAM_CHECKPOINT = os.environ.get("SAM_CHECKPOINT", DEFAULT_CHECKPOINTS.get(SAM_MODEL_TYPE, ""))
+# "auto" uses CUDA when it is available and falls back to the CPU
+SAM_DEVICE = os.environ.get("SAM_DEVICE", "auto")
+# Latency of the "stub" model in seconds, see load_test.py: every encoder pass
+# takes STUB_ENCODER_LATENCY plus STUB_ENCODER_IMAGE_LATENCY per image in it,
+# every mask decoder call STUB_DECODER_LATENCY
+STUB_ENCODER_LATENCY = float(os.environ.get("STUB_ENCODER_LATENCY", "0.05"))
+STUB_ENCODER_IMAGE_LATENCY = float(os.environ.get("STUB_ENCODER_IMAGE_LATENCY", "0.15"))
+STUB_DECODER_LATENCY = float(os.environ.get("STUB_DECODER_LATENCY", "0.01"))
+
 MAX_WORKERS = 1
-QUEUE_SIZE = 3
\ No newline at end of file
+# Model replica processes (see worker_pool.py). 0 runs the model in the server
+# process itself. Replicas use the REPLICA_DEVICES list in turn ("cuda:0,cuda:1"),
+# or one GPU each round-robin, or else split the CPU cores between them
+NUM_REPLICAS = int(os.environ.get("NUM_REPLICAS", "0"))
+REPLICA_DEVICES = os.environ.get("REPLICA_DEVICES", "")
+# Seconds before a replica that exited is started again, doubled for every
+# further failure before it becomes ready
+REPLICA_RESTART_DELAY = 1.0
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", "8"))
+# CPU stages around the model (see pipeline.py): threads decoding images
+# before it and rendering / encoding masks after it, plus the requests each
+# stage may hold waiting for a thread
+PRE_WORKERS = 2
+PRE_QUEUE_SIZE = 8
+POST_WORKERS = 2
+POST_QUEUE_SIZE = 8
+# Seconds a request may wait for a free queue slot before getting a 503
+QUEUE_PUT_TIMEOUT = float(os.environ.get("QUEUE_PUT_TIMEOUT", "5.0"))
+
+# Queue slots held back for interactive requests, bulk traffic (X-Priority:
+# bulk) can only fill QUEUE_SIZE - INTERACTIVE_RESERVE of them
+INTERACTIVE_RESERVE = 2
+# Default deadline in seconds of a request, clients can set their own with the
+# X-Request-Timeout header. Work still queued at its deadline is dropped
+REQUEST_TIMEOUT = 60.0
+# Seconds between checks whether the client of a queued request went away
+DISCONNECT_POLL_INTERVAL = 0.25
+
+# Image encoder execution modes, see inference_opt.py. ENCODER_DTYPE is
+# "fp32", "bf16" or "fp16" (autocast; embeddings stay fp32). TORCH_COMPILE is
+# empty for eager mode or a torch.compile mode ("default", "max-autotune", ...).
+# All of them are off unless asked for
+ENCODER_DTYPE = os.environ.get("ENCODER_DTYPE", "fp32")
+SDPA_ATTENTION = os.environ.get("SDPA_ATTENTION", "0") == "1"
+CHANNELS_LAST = os.environ.get("CHANNELS_LAST", "0") == "1"
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "")
+# With VALIDATE_OPTIMIZATIONS=1 each mode is checked at startup against fp32
+# masks on a fixed image and switched off again if the mean mask IoU drops
+# below this
+OPTIMIZATION_IOU_TOLERANCE = 0.95
+VALIDATE_OPTIMIZATIONS = os.environ.get("VALIDATE_OPTIMIZATIONS", "0") == "1"
+
+# Micro-batching: a batch is sent to the model once MAX_BATCH_SIZE requests
+# are queued or BATCH_WAIT_MS after the first one arrived, whichever is first
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "2"))
+BATCH_WAIT_MS = int(os.environ.get("BATCH_WAIT_MS", "10"))
+
+# Decode large images straight to the model input size (JPEG draft mode plus
+# a reduced resize) instead of at full resolution. Masks are still returned
+# at the original size, upsampled from the decoder logits. Off by default
+DOWNSCALE_ON_DECODE = os.environ.get("DOWNSCALE_ON_DECODE", "0") == "1"
+
+# Budget for cached SAM image embeddings (one ViT embedding is ~4 MB in fp32)
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Finished responses by image, prompts and output format, for repeated
+# identical requests: in memory up to RESPONSE_CACHE_MAX_BYTES, and with
+# RESPONSE_CACHE_DIR set also on local disk, which survives restarts. Entries
+# expire RESPONSE_CACHE_TTL seconds after they were computed
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = 600.0
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024
+
+# Directory of precomputed embeddings (see embedding_store.py), empty for none.
+# Requests for images in it skip the image encoder
+EMBEDDING_STORE_PATH = os.environ.get("EMBEDDING_STORE_PATH", "")
+
+# Interactive sessions (/sessions/): dropped after SESSION_TTL seconds without
+# a request, and least recently used first beyond SESSION_MAX_BYTES (one fp16
+# ViT embedding is ~2 MB)
+SESSION_TTL = 600.0
+SESSION_MAX_BYTES = 256 * 1024 * 1024
+
+# Limits of /segment_everything/: grid density, points decoded per call, crop
+# layers and the longest a request may keep the model busy, in seconds
+EVERYTHING_MAX_POINTS_PER_SIDE = 64
+EVERYTHING_MAX_POINTS_PER_BATCH = 256
+EVERYTHING_MAX_CROP_LAYERS = 2
+EVERYTHING_TIME_BUDGET = 120.0
+
+# Upper bound on the number of prompt groups in one batch request
+MAX_PROMPT_GROUPS = 64
+
+# Encoding of rendered masks (format=png, every mask is white on black):
+# "png" is an RGB PNG as always, "png-l" an 8-bit grayscale PNG, "png-1bit" a
+# 1-bit PNG and "webp" a lossless WebP. `python benchmark.py --stages
+# mask_encode` measures the size and encode time of each
+MASK_IMAGE_FORMAT = os.environ.get("MASK_IMAGE_FORMAT", "png")
+# zlib level of PNG masks, 0 (fastest) to 9 (smallest); Pillow's default is 6
+MASK_PNG_COMPRESS_LEVEL = int(os.environ.get("MASK_PNG_COMPRESS_LEVEL", "6"))
+# Effort of lossless WebP masks, 0 (fastest) to 6 (smallest)
+MASK_WEBP_METHOD = int(os.environ.get("MASK_WEBP_METHOD", "4"))
+
+# On-demand profiling of single requests, see tracing.py. A request with an
+# X-Profile header ("cprofile", or "torch" for a torch.profiler trace of the
+# model) is profiled, and so is a PROFILE_SAMPLE_RATE share of the other POSTs.
+# Profiles are saved in PROFILE_DIR, the newest PROFILE_MAX_FILES kept, for
+# GET /profiles/{request_id}. PROFILE_HEADER=0 ignores the header
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_HEADER = os.environ.get("PROFILE_HEADER", "1") == "1"
+PROFILE_MAX_FILES = 200
+
+# Douglas-Peucker tolerance in pixels for the polygon mask format
+POLYGON_EPSILON = 1.0
+
+# Backend of the decoder-only /decode/ endpoint: "torch" runs the mask decoder
+# of the loaded model, "onnx" runs an exported decoder (see onnx_decoder.py)
+# with onnxruntime on the CPU, off the model thread
+DECODER_BACKEND = os.environ.get("DECODER_BACKEND", "torch")
+ONNX_DECODER_PATH = os.environ.get("ONNX_DECODER_PATH", "sam_decoder.onnx")
+DECODER_WORKERS = 2
@@ -0,0 +1,162 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from segment_anything.utils.transforms import ResizeLongestSide
+
+from config import logger
+from metrics import timed
+
+
+@dataclass
+class CachedEmbedding:
+    """Everything SamPredictor needs to skip set_image for a known image."""
+    features: torch.Tensor
+    original_size: Tuple[int, int]
+    input_size: Tuple[int, int]
+    target_length: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.features.element_size() * self.features.nelement()
+
+
+def embedding_to_bytes(entry: CachedEmbedding) -> bytes:
+    """Serialize the features of an embedding as raw little-endian fp16."""
+    return entry.features.detach().to(torch.float16).cpu().numpy().astype("<f2", copy=False).tobytes()
+
+
+def embedding_from_bytes(data: bytes, shape, original_size, target_length: int, device="cpu") -> CachedEmbedding:
+    """Inverse of `embedding_to_bytes`; the features are restored in fp32 on `device`."""
+    features = np.frombuffer(data, dtype="<f2").reshape(shape).astype(np.float32)
+    original_size = tuple(int(v) for v in original_size)
+    return CachedEmbedding(
+        features=torch.from_numpy(features).to(device),
+        original_size=original_size,
+        input_size=ResizeLongestSide.get_preprocess_shape(original_size[0], original_size[1], target_length),
+        target_length=target_length,
+    )
+
+
+def image_hash(image: np.ndarray) -> str:
+    """
+    Content hash of a decoded HWC image array. Shape and dtype are part of the
+    key so that two buffers with the same bytes but different layouts differ.
+    """
+    image = np.ascontiguousarray(image)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.shape}{image.dtype}".encode("utf-8"))
+    h.update(memoryview(image).cast("B"))
+    return h.hexdigest()
+
+
+def snapshot_embedding(sam_predictor) -> CachedEmbedding:
+    """Capture the embedding state of a predictor after set_image."""
+    return CachedEmbedding(
+        features=sam_predictor.features,
+        original_size=tuple(sam_predictor.original_size),
+        input_size=tuple(sam_predictor.input_size),
+        target_length=sam_predictor.transform.target_length,
+    )
+
+
+def restore_embedding(sam_predictor, entry: CachedEmbedding) -> None:
+    """Load a cached embedding into the predictor, as if set_image had just run."""
+    sam_predictor.reset_image()
+    sam_predictor.features = entry.features
+    sam_predictor.original_size = entry.original_size
+    sam_predictor.input_size = entry.input_size
+    sam_predictor.is_image_set = True
+
+
+class EmbeddingCache:
+    """
+    LRU cache of SAM image embeddings keyed by a hash of the decoded image,
+    bounded by the total size of the stored feature tensors.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CachedEmbedding]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[CachedEmbedding]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CachedEmbedding) -> None:
+        if entry.nbytes > self.max_bytes:
+            # Would evict everything and still not fit
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def embedding_key(image: np.ndarray, original_size=None) -> str:
+    """Cache key of an image; a downscaled image is also keyed by the size it stands in for."""
+    key = image_hash(image)
+    if original_size is not None:
+        key += "@{}x{}".format(*original_size)
+    return key
+
+
+@timed("set_image")
+def set_image_cached(sam_predictor, image: np.ndarray, cache: Optional[EmbeddingCache] = None, original_size=None) -> None:
+    """
+    Drop-in replacement for `sam_predictor.set_image(image)` that reuses a
+    cached embedding when the same image has been encoded before.
+
+    `original_size` (height, width) is for an image already downscaled to the
+    model input size: prompts are then taken and masks returned in the
+    coordinates of the original image, as if it had been set in full.
+    """
+    key = embedding_key(image, original_size) if cache is not None else None
+    entry = cache.get(key) if cache is not None else None
+    if entry is not None and entry.target_length == sam_predictor.transform.target_length:
+        logger.info(f"Embedding cache hit for {key}")
+        restore_embedding(sam_predictor, entry)
+        return
+
+    sam_predictor.set_image(image)
+    if original_size is not None:
+        sam_predictor.original_size = tuple(original_size)
+    if cache is not None:
+        cache.put(key, snapshot_embedding(sam_predictor))
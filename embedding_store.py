@@ -0,0 +1,292 @@
+# Precomputed SAM embeddings on disk, for running new prompts over the same
+# images again without the image encoder:
+#   python embedding_store.py images/ embeddings/
+#   EMBEDDING_STORE_PATH=embeddings/ python endpoint.py
+#   python bulk_offline.py --folder images/ --coordinates coords.jsonl --embedding-store embeddings/
+# Entries are keyed by a hash of the image file bytes, so a lookup needs
+# neither the decoded image nor the encoder. Running the command again only
+# encodes the images that are not in the store yet. Images are decoded the
+# way the server decodes them, downscaled only with DOWNSCALE_ON_DECODE=1, and
+# a store is only used with the model, checkpoint and DOWNSCALE_ON_DECODE it
+# was computed with.
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from config import logger, DEFAULT_CHECKPOINTS, DOWNSCALE_ON_DECODE, SAM_CHECKPOINT, SAM_MODEL_TYPE
+from models_init import initialize_models
+from utils import bytes_to_model_image, encode_images, original_size_for
+
+INDEX_FILE = "index.json"
+DATA_FILE = "embeddings.f16"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+def file_hash(data: bytes) -> str:
+    """Store key of an image: a hash of its encoded file bytes."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def store_settings(model_type, checkpoint, downscale_on_decode) -> dict:
+    """
+    What stored embeddings depend on besides the image. The checkpoint goes
+    by file name and size, so a copy on another machine still matches.
+    """
+    try:
+        checkpoint_bytes = os.path.getsize(checkpoint)
+    except OSError:
+        checkpoint_bytes = None
+    return {
+        "model_type": model_type,
+        "checkpoint": os.path.basename(checkpoint),
+        "checkpoint_bytes": checkpoint_bytes,
+        "downscale_on_decode": downscale_on_decode,
+    }
+
+
+def store_settings_from_args(args, downscale_on_decode):
+    """
+    `initialize_models` kwargs for the --model-type, --checkpoint and --device
+    options of a CLI, and the store settings of that model. --checkpoint
+    defaults to the checkpoint of --model-type.
+    """
+    kwargs = {}
+    if args.model_type:
+        kwargs["model_type"] = args.model_type
+        kwargs["checkpoint"] = DEFAULT_CHECKPOINTS.get(args.model_type, "")
+    if args.checkpoint:
+        kwargs["checkpoint"] = args.checkpoint
+    if args.device:
+        kwargs["device"] = args.device
+    settings = store_settings(kwargs.get("model_type", SAM_MODEL_TYPE), kwargs.get("checkpoint", SAM_CHECKPOINT), downscale_on_decode)
+    return kwargs, settings
+
+
+class EmbeddingStore:
+    """
+    fp16 image embeddings appended to one data file, memory-mapped read-only,
+    and a JSON index of the offset, shape and original size of each entry.
+    `lookup` returns views into the mapping: the features are only paged in
+    from disk (or the page cache, shared by every process reading the store)
+    when they are used, and copied once, when converted to fp32 for the
+    decoder.
+
+    The index is replaced atomically after the data it points to is on disk,
+    so a reader never sees a partial entry. Readers pick up entries added by a
+    running precompute on their next miss.
+
+    `settings` (see `store_settings`) must match the ones the store was
+    computed with, else it is refused with a ValueError.
+    """
+
+    def __init__(self, path, settings=None, writable=False):
+        self.path = path
+        self.writable = writable
+        self.meta = {}
+        self.entries = {}
+        self._index_mtime = None
+        self._data = None
+        self._file = None
+        self._lock = threading.Lock()
+        if writable:
+            os.makedirs(path, exist_ok=True)
+            self._file = open(os.path.join(path, DATA_FILE), "ab")
+        elif not os.path.isfile(self._index_path):
+            raise FileNotFoundError(f"No embedding store at '{path}'.")
+        self._load_index()
+        for name, value in (settings or {}).items():
+            # Entries stored before a setting was recorded count as a mismatch
+            stored = self.meta.get(name, None if self.entries else value)
+            if stored != value:
+                raise ValueError(f"Embedding store '{path}' was computed with {name}={stored!r}, not {value!r}.")
+            self.meta[name] = value
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.path, INDEX_FILE)
+
+    def _load_index(self):
+        try:
+            mtime = os.stat(self._index_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._index_mtime:
+            return False
+        with open(self._index_path) as f:
+            index = json.load(f)
+        self.meta, self.entries, self._index_mtime = index["meta"], index["entries"], mtime
+        return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._entry(key) is not None
+
+    def _mapping(self, end):
+        # Remapped once the data file has grown past the entries mapped so far
+        if self._data is None or len(self._data) < end:
+            self._data = np.memmap(os.path.join(self.path, DATA_FILE), dtype=np.uint8, mode="r")
+        return self._data
+
+    def _entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None and not self.writable and self._load_index():
+            entry = self.entries.get(key)
+        return entry
+
+    def lookup(self, key):
+        """(fp16 features, shape, (height, width) of the image) stored under `key`, or None."""
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return None
+            offset, nbytes = entry["offset"], entry["nbytes"]
+            data = self._mapping(offset + nbytes)
+        features = data[offset:offset + nbytes].view("<f2").reshape(entry["shape"])
+        return features, tuple(entry["shape"]), tuple(entry["original_size"])
+
+    def add(self, key, embedding):
+        """Append a `CachedEmbedding`; it is visible to readers after the next `flush`."""
+        features = embedding.features.detach().cpu().numpy().astype("<f2")
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(features.tobytes())
+            self.entries[key] = {
+                "offset": offset,
+                "nbytes": features.nbytes,
+                "shape": list(features.shape),
+                "original_size": list(embedding.original_size),
+            }
+            self.meta.setdefault("target_length", embedding.target_length)
+
+    def flush(self):
+        """Make the entries added so far durable and visible to readers."""
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            tmp_path = self._index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"meta": self.meta, "entries": self.entries}, f)
+            os.replace(tmp_path, self._index_path)
+            self._index_mtime = os.stat(self._index_path).st_mtime_ns
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "path": self.path,
+                "entries": len(self.entries),
+                "bytes": sum(entry["nbytes"] for entry in self.entries.values()),
+                **self.meta,
+            }
+
+
+def read_image_file(image_path, target_length):
+    """Process-pool job: hash and decode an image file, to `target_length` if given. Returns (key, array, original size)."""
+    with open(image_path, "rb") as f:
+        data = f.read()
+    image, size = bytes_to_model_image(data, target_length)
+    if image is None:
+        raise ValueError(f"Could not decode {image_path}.")
+    return file_hash(data), np.asarray(image), original_size_for(image, size)
+
+
+def precompute(folder_path, store, sam_predictor, batch_size=4, decode_workers=None, queue_size=16, flush_every=64):
+    """
+    Encode every image in `folder_path` not in `store` yet, `batch_size`
+    images per encoder pass, with images decoded ahead in a process pool.
+    The index is written every `flush_every` images, so an interrupted run
+    loses at most that many. Returns the number of embeddings added.
+    """
+    paths = sorted(
+        os.path.join(folder_path, name) for name in os.listdir(folder_path)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    # Decoded like the server will decode them, see DOWNSCALE_ON_DECODE
+    target_length = sam_predictor.transform.target_length if store.meta.get("downscale_on_decode") else None
+    added = skipped = failed = 0
+    start_time = time.perf_counter()
+
+    def encode(batch):
+        images, original_sizes = zip(*batch.values())
+        for key, embedding in zip(batch, encode_images(sam_predictor, list(images), original_sizes=list(original_sizes))):
+            store.add(key, embedding)
+
+    with ProcessPoolExecutor(max_workers=decode_workers or os.cpu_count()) as decode_pool:
+        # Bounded so decoded images cannot pile up ahead of the encoder
+        pending = deque()
+        remaining = iter(paths)
+        # key -> (image, original size), identical files are encoded once
+        batch = {}
+        while True:
+            while len(pending) < queue_size:
+                path = next(remaining, None)
+                if path is None:
+                    break
+                pending.append((path, decode_pool.submit(read_image_file, path, target_length)))
+            if not pending:
+                break
+            path, future = pending.popleft()
+            try:
+                key, image, original_size = future.result()
+            except Exception as e:
+                logger.warning(f"Skipping {path}: {e}")
+                failed += 1
+                continue
+            if key in store or key in batch:
+                skipped += 1
+                continue
+            batch[key] = image, original_size
+            if len(batch) == batch_size:
+                encode(batch)
+                added += len(batch)
+                batch = {}
+                if added % flush_every < batch_size:
+                    store.flush()
+                logger.info(f"Encoded {added} images, {added / (time.perf_counter() - start_time):.2f} images/s")
+        if batch:
+            encode(batch)
+            added += len(batch)
+    store.flush()
+
+    logger.info(f"Added {added} embeddings to {store.path} ({skipped} already stored, {failed} failed) "
+                f"in {time.perf_counter() - start_time:.1f}s, {len(store)} in total")
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute SAM image embeddings for a folder into an embedding store.")
+    parser.add_argument("folder", help="Folder of images.")
+    parser.add_argument("store", help="Store directory, created if needed.")
+    parser.add_argument("--batch-size", type=int, default=4, help="Images per encoder pass.")
+    parser.add_argument("--decode-workers", type=int, default=None, help="Processes decoding images, defaults to the CPU count.")
+    parser.add_argument("--model-type", default=None)
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    kwargs, settings = store_settings_from_args(args, DOWNSCALE_ON_DECODE)
+    store = EmbeddingStore(args.store, settings, writable=True)
+    sam_predictor = initialize_models(**kwargs)
+    try:
+        precompute(args.folder, store, sam_predictor, batch_size=args.batch_size, decode_workers=args.decode_workers)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,43 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Body, File, Form, Query, Request, UploadFile
+from fastapi import Response as HTTPResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from models_init import initialize_models
-from models import ImageRequest, ImageResponse, Response
+from starlette.background import BackgroundTask
+from models import ImageRequest, ImageResponse, Response, BatchImageRequest, BatchImageResponse, BatchResponse, MaskFormat, SessionPrompt, SessionInfo
 from fastapi import HTTPException
-from config import logger, MAX_WORKERS, QUEUE_SIZE
+from config import logger, MAX_WORKERS, NUM_REPLICAS, REPLICA_DEVICES, REPLICA_RESTART_DELAY, QUEUE_SIZE, PRE_WORKERS, PRE_QUEUE_SIZE, POST_WORKERS, POST_QUEUE_SIZE, QUEUE_PUT_TIMEOUT, INTERACTIVE_RESERVE, REQUEST_TIMEOUT, DISCONNECT_POLL_INTERVAL, MAX_BATCH_SIZE, BATCH_WAIT_MS, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_MAX_BYTES, MASK_IMAGE_FORMAT, MASK_PNG_COMPRESS_LEVEL, MASK_WEBP_METHOD, SAM_MODEL_TYPE, SAM_CHECKPOINT, ENCODER_DTYPE, SDPA_ATTENTION, CHANNELS_LAST, TORCH_COMPILE, POLYGON_EPSILON, SESSION_TTL, SESSION_MAX_BYTES, EVERYTHING_MAX_POINTS_PER_SIDE, EVERYTHING_MAX_POINTS_PER_BATCH, EVERYTHING_MAX_CROP_LAYERS, EVERYTHING_TIME_BUDGET, DOWNSCALE_ON_DECODE, DECODER_BACKEND, ONNX_DECODER_PATH, DECODER_WORKERS, PROFILE_DIR, PROFILE_SAMPLE_RATE, PROFILE_HEADER, PROFILE_MAX_FILES
+from embedding_store import file_hash
+from onnx_decoder import OnnxDecoder
+from sessions import SessionStore
+from segment_everything import EverythingOptions, MaskDeduplicator, plan_crops
+from pipeline import Stage, StageStats
+from response_cache import ResponseCache, SingleFlight, file_fingerprint, response_key
+from tracing import RequestProfile, client_request_id, client_request_id_var, find_profile, new_request_id, profile_mode, profile_var, profiled, remote_call, request_id_var, run_in_executor
+from scheduler import MicroBatchScheduler, SchedulerBusy, DeadlineExceeded, PRIORITIES, INTERACTIVE
+from worker_pool import WorkerPool, SharedArray, ReplicaUnavailable
+import metrics
+import worker_pool
 import asyncio
+import json
+import os
 import time
+from contextlib import contextmanager
+from dataclasses import replace
+from typing import Literal, Optional
 from concurrent.futures import ThreadPoolExecutor
-from utils import base64_to_image, image_to_base64,run_sam
+from functools import partial
+from utils import bytes_to_model_image, mask_media_type, parse_coordinates
+from mask_formats import COMPACT_FORMATS
+from replica import SegmentJob, EverythingJob, embedding_cache, embedding_store, encode_output, segment_requests, refine_session_mask
+import replica
 import numpy as np
 
+# Reference point of the startup timings
+PROCESS_START = time.perf_counter()
+
+# Metadata headers of /embedding/ responses, needed again by /decode/
+EMBEDDING_HEADERS = ["X-Embedding-Shape", "X-Embedding-Dtype", "X-Original-Size"]
+
 app = FastAPI(
     title="Segmentation API",
     description="API for Masking images using SAM",
@@ -23,67 +51,717 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=EMBEDDING_HEADERS + ["X-Mask-Score", "X-Request-ID", "X-Client-Request-ID", "X-Profile"],
 )
 
-model = initialize_models()
-logger.info("Models initialized successfully")
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start_time = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template rather than raw path to keep cardinality bounded
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.REQUEST_SECONDS.labels(path).observe(time.perf_counter() - start_time)
+        metrics.REQUESTS.labels(path, status).inc()
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    """
+    Give the request its ID, and a profile if it asked for one (X-Profile)
+    or is a sampled POST. The profile is saved once the response is sent,
+    streamed ones included.
+    """
+    # Always an ID of our own, the client's X-Request-ID is only logged and echoed
+    request_id = new_request_id()
+    client_id = client_request_id(request.headers.get("X-Request-ID"))
+    request_id_var.set(request_id)
+    client_request_id_var.set(client_id)
+    sample_rate = PROFILE_SAMPLE_RATE if request.method == "POST" else 0.0
+    mode = profile_mode(request.headers.get("X-Profile"), sample_rate, PROFILE_HEADER)
+    profile = RequestProfile(request_id, mode) if mode is not None else None
+    profile_var.set(profile)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    if client_id != "-":
+        response.headers["X-Client-Request-ID"] = client_id
+    if profile is not None:
+        response.headers["X-Profile"] = f"/profiles/{request_id}"
+        response.background = BackgroundTask(profile.save, PROFILE_DIR, PROFILE_MAX_FILES)
+    return response
 
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)  # Single worker to ensure sequential processing
-request_queue = asyncio.Queue(maxsize=QUEUE_SIZE)  # Queue to hold incoming requests with a maximum size of 2
+# Loaded in the background once the server is up, see load_model; the
+# model itself is replica.model
+onnx_decoder = None
+startup_error = None
 
-# Background worker to process the queue sequentially
-async def process_queue():
-    while True:
-        request_id, request, future = await request_queue.get()
-        try:
-            # Process the request (offloaded to a separate thread if blocking)
-            result = await asyncio.get_event_loop().run_in_executor(executor, segment_image, request)
-            future.set_result(result)
-        except Exception as e:
-            future.set_exception(e)
-        finally:
-            request_queue.task_done()
-
-# Start the background worker at startup
+# Finished responses of repeated requests, and identical requests in progress
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_MAX_BYTES)
+single_flight = SingleFlight()
+# Every setting the masks depend on besides the request, in each response key,
+# so the disk tier never serves masks of an earlier checkpoint or config
+RESPONSE_KEY_SETTINGS = (
+    SAM_MODEL_TYPE, file_fingerprint(SAM_CHECKPOINT), DOWNSCALE_ON_DECODE, ENCODER_DTYPE, SDPA_ATTENTION,
+    CHANNELS_LAST, TORCH_COMPILE, POLYGON_EPSILON, MASK_IMAGE_FORMAT, MASK_PNG_COMPRESS_LEVEL, MASK_WEBP_METHOD,
+)
+sessions = SessionStore(SESSION_MAX_BYTES, SESSION_TTL)
+
+# OpenAPI description of the raw mask and embedding downloads
+PNG_RESPONSE = {200: {"content": {"image/png": {}, "image/webp": {}}, "description": "Mask as JSON, or the raw mask image (PNG or WebP per MASK_IMAGE_FORMAT) with response_format=png."}}
+EMBEDDING_RESPONSE = {200: {"content": {"application/octet-stream": {}}, "description": "fp16 image embedding, see the X-Embedding-* headers."}}
+
+# Single worker to ensure sequential processing; with replicas, one thread per
+# replica to decode images and wait on it
+executor = ThreadPoolExecutor(max_workers=max(MAX_WORKERS, NUM_REPLICAS))
+
+# The ONNX decoder runs on its own CPU threads; the torch decoder shares the model thread
+decoder_executor = ThreadPoolExecutor(max_workers=DECODER_WORKERS) if DECODER_BACKEND == "onnx" else executor
+
+def load_model():
+    """Load and warm up the predictor (and the ONNX decoder, if configured). Runs on the model thread."""
+    global onnx_decoder
+    start_time = time.perf_counter()
+    if DECODER_BACKEND == "onnx":
+        onnx_decoder = OnnxDecoder(ONNX_DECODER_PATH)
+    # Last, as /ready goes by the model
+    replica.load()
+    logger.info(f"Models initialized successfully in {time.perf_counter() - start_time:.2f}s, "
+                f"ready {time.perf_counter() - PROCESS_START:.2f}s after import")
+
+# Model replica processes, only with NUM_REPLICAS > 0
+pool = WorkerPool(replica.load, NUM_REPLICAS, REPLICA_DEVICES, REPLICA_RESTART_DELAY) if NUM_REPLICAS > 0 else None
+
+def _decode_target_length():
+    # Large images come out at the model input size, prompts and masks stay
+    # in original image pixels
+    if not DOWNSCALE_ON_DECODE:
+        return None
+    return pool.info.get("target_length") if pool is not None else replica.model.transform.target_length
+
+def prepare_job(job):
+    """
+    Pre-processing stage: decode the image of a job, unless its embedding is
+    in the store. With replicas the image goes to shared memory, which the
+    caller frees with `_release_image` once the model stage is done.
+    """
+    if job.key is not None:
+        return job
+    if job.image is None:
+        if embedding_store is not None:
+            key = file_hash(job.image_bytes)
+            stored = key in embedding_store
+            metrics.STORE_LOOKUPS.labels("hit" if stored else "miss").inc()
+            if stored:
+                return replace(job, key=key)
+        pil_image, size = bytes_to_model_image(job.image_bytes, _decode_target_length())
+        if pil_image is None:
+            # Bad client input, not a server error
+            raise HTTPException(status_code=422, detail="Could not decode the image.")
+        job = replace(job, image_bytes=None, image=np.array(pil_image), size=size)
+    if pool is not None and isinstance(job.image, np.ndarray):
+        job = replace(job, image=SharedArray.copy_from(job.image))
+    return job
+
+def _release_image(job, prepared):
+    # Shared memory that prepare_job made for a replica
+    if isinstance(prepared.image, SharedArray) and prepared.image is not job.image:
+        prepared.image.unlink()
+
+def run_on_replicas(jobs):
+    """
+    Model stage with a worker pool: the least loaded replica runs
+    `segment_requests` on the batch, reading the images from shared memory.
+    """
+    return remote_call(pool.call, segment_requests, jobs)
+
+def _job_from_request(request):
+    item = request.input
+    try:
+        # Validate and reshape coordinates
+        if isinstance(request, BatchImageRequest):
+            prompts = [parse_coordinates(group) for group in item.prompts]
+            return SegmentJob(item.image_bytes, prompts, batch=True, output_format=item.format)
+        return SegmentJob(item.image_bytes, parse_coordinates(item.pos_coord), output_format=item.format)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+def finish_job(job, result):
+    """Post-processing stage: PNG or compact encoding of the masks from the model stage."""
+    if job.output_format == "embedding":
+        return result
+    if job.batch:
+        return [encode_output(mask, job.output_format) for mask in result]
+    return encode_output(result, job.output_format)
+
+def lookup_response(job):
+    """Pre-processing stage: the cache key of a job and its cached response, if any (None, None for uncacheable jobs)."""
+    if job.image_bytes is None:
+        return None, None
+    key = response_key(job.image_bytes, job.prompts, job.output_format, job.batch, *RESPONSE_KEY_SETTINGS)
+    # Embeddings are only coalesced; the embedding cache and store keep those
+    if job.output_format == "embedding":
+        return key, None
+    return key, response_cache.get(key)
+
+def finish_and_cache(job, result, key):
+    """Post-processing stage: `finish_job`, keeping the response for later identical requests."""
+    response = finish_job(job, result)
+    if key is not None and job.output_format != "embedding":
+        response_cache.put(key, response)
+    return response
+
+def decode_embedding(embedding_bytes, shape, original_size, pos_coord, output_format):
+    """Run only the prompt encoder and mask decoder against a client-supplied embedding, on the ONNX decoder if loaded."""
+    if onnx_decoder is None:
+        return replica.decode_embedding(embedding_bytes, shape, original_size, pos_coord, output_format)
+    features = np.frombuffer(embedding_bytes, dtype="<f2").reshape(shape)
+    return encode_output(onnx_decoder.predict(features, pos_coord, original_size), output_format)
+
+def _decode_on_replica(*args):
+    return remote_call(pool.call, replica.decode_embedding, *args)
+
+async def _run_on_model(function, *args):
+    """Run a decoder-only call on the model thread, or on a replica with a worker pool."""
+    if pool is not None:
+        return await run_in_executor(decoder_executor, model_stage.call, remote_call, pool.call, function, *args)
+    return await run_in_executor(executor, model_stage.call, function, *args)
+
+def _single(job):
+    """All three stages in turn on the calling thread."""
+    prepared = prepare_job(job)
+    try:
+        result = (run_on_replicas if pool is not None else segment_requests)([prepared])[0]
+    finally:
+        _release_image(job, prepared)
+    if isinstance(result, BaseException):
+        raise result
+    return finish_job(prepared, result)
+
+def _to_response(result, output_format):
+    if output_format in COMPACT_FORMATS:
+        return ImageResponse(output=Response(**result))
+    return ImageResponse(output=Response.from_image_bytes(result, mask_media_type()))
+
+def _to_batch_response(results, output_format):
+    if output_format in COMPACT_FORMATS:
+        return BatchImageResponse(output=BatchResponse(results=[Response(**result) for result in results]))
+    return BatchImageResponse(output=BatchResponse.from_image_bytes(results, mask_media_type()))
+
+def segment_image(request: ImageRequest) -> ImageResponse:
+    return _to_response(_single(_job_from_request(request)), request.input.format)
+
+def segment_image_batch(request: BatchImageRequest) -> BatchImageResponse:
+    return _to_batch_response(_single(_job_from_request(request)), request.input.format)
+
+# The CPU stages around the model, see pipeline.py
+pre_stage = Stage("pre", PRE_WORKERS, PRE_QUEUE_SIZE, QUEUE_PUT_TIMEOUT)
+post_stage = Stage("post", POST_WORKERS, POST_QUEUE_SIZE, QUEUE_PUT_TIMEOUT)
+# Batches in parallel: one on the model thread, or one per replica
+model_stage = StageStats("model", max(1, NUM_REPLICAS))
+
+# Gathers queued requests into micro-batches for the model
+scheduler = MicroBatchScheduler(
+    partial(model_stage.call, run_on_replicas if pool is not None else segment_requests),
+    executor,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=BATCH_WAIT_MS,
+    queue_size=QUEUE_SIZE,
+    put_timeout=QUEUE_PUT_TIMEOUT,
+    interactive_reserve=INTERACTIVE_RESERVE,
+    concurrency=max(1, NUM_REPLICAS),
+)
+metrics.QUEUE_DEPTH.set_function(lambda: scheduler.queue_depth)
+
+# Start the background scheduler at startup
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(process_queue())
+    scheduler.start()
+    if pool is not None:
+        # Replicas load on their own; the ONNX decoder, if any, runs here
+        pool.start()
+        if DECODER_BACKEND == "onnx":
+            asyncio.create_task(_load_onnx_decoder_in_background())
+    else:
+        # Load in the background so the server binds at once; /ready says when it is done
+        asyncio.create_task(_load_model_in_background())
+    logger.info(f"Server started {time.perf_counter() - PROCESS_START:.2f}s after import, loading models")
 
-def segment_image(request: ImageRequest) -> ImageResponse:
-    request_id = str(int(time.time()))
-    start_time = time.time()
-    logger.info(f"Request {request_id} received at {start_time}")
-    item = request.input
-    pil_image = base64_to_image(item.target_image)
-    
-    # Validate and reshape coordinates
-    pos_coord = np.array(item.pos_coord)
-    if pos_coord.ndim == 1:
-        # Reshape flat list to list of lists
-        pos_coord = pos_coord.reshape(-1, 2)
-    elif pos_coord.ndim != 2 or pos_coord.shape[1] != 2:
-        raise ValueError("pos_coord must be a list of [x, y] coordinate pairs.")
-    
-    masked_image = run_sam(pil_image, pos_coord, model)
-
-    # Convert the image to base64 for the response
-    img_base64 = image_to_base64(masked_image)
-    return ImageResponse(output=Response(mask=f"data:image/png;base64,{img_base64}"))
+@app.on_event("shutdown")
+async def shutdown_event():
+    if pool is not None:
+        await asyncio.get_running_loop().run_in_executor(None, pool.stop)
 
-# Endpoint for image segmentation
-@app.post("/mask_image/", response_model=ImageResponse)
-async def generate_images(request: ImageRequest):
-    request_id = str(int(time.time()))
-    future = asyncio.get_event_loop().create_future()  # Create a future to hold the result
+async def _load_model_in_background():
+    global startup_error
+    try:
+        await asyncio.get_running_loop().run_in_executor(executor, load_model)
+    except Exception as e:
+        startup_error = e
+        logger.exception("Model loading failed")
 
+async def _load_onnx_decoder_in_background():
+    global onnx_decoder, startup_error
     try:
-        # Attempt to add request to queue with a timeout
-        await asyncio.wait_for(request_queue.put((request_id, request, future)), timeout=5.0)
+        onnx_decoder = await asyncio.get_running_loop().run_in_executor(decoder_executor, OnnxDecoder, ONNX_DECODER_PATH)
+    except Exception as e:
+        startup_error = e
+        logger.exception("ONNX decoder loading failed")
+
+def _is_ready():
+    if pool is not None:
+        return pool.ready_count() > 0 and (DECODER_BACKEND != "onnx" or onnx_decoder is not None)
+    return replica.model is not None
+
+def _check_ready():
+    if not _is_ready():
+        detail = "Model failed to load." if startup_error is not None else "Model is still loading."
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+
+def _request_options(http_request):
+    """Deadline and priority lane of a request, from the X-Request-Timeout and X-Priority headers."""
+    timeout = http_request.headers.get("X-Request-Timeout")
+    try:
+        timeout = float(timeout) if timeout is not None else REQUEST_TIMEOUT
+    except ValueError:
+        timeout = 0
+    if not timeout > 0:
+        raise HTTPException(status_code=422, detail="X-Request-Timeout must be a positive number of seconds.")
+    priority = http_request.headers.get("X-Priority", INTERACTIVE).lower()
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=422, detail=f"X-Priority must be one of {', '.join(PRIORITIES)}.")
+    return time.perf_counter() + timeout, priority
+
+async def _wait_for_disconnect(http_request):
+    while not await http_request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+async def _submit(request_id, job, http_request, deadline, priority):
+    submit = asyncio.ensure_future(scheduler.submit(request_id, job, deadline=deadline, priority=priority))
+    disconnect = asyncio.ensure_future(_wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait({submit, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        if not submit.done():
+            # Cancelling the submit drops the job from the queue before it reaches the model
+            submit.cancel()
+    if not submit.done() or submit.cancelled():
+        logger.info(f"Client of request {request_id} disconnected, dropped it")
+        # Nobody is left to read this
+        raise HTTPException(status_code=499, detail="Client closed request.")
+    return submit.result()
+
+async def _process(request_id, job, http_request, deadline, priority, key):
+    prepared = await pre_stage.run(prepare_job, job)
+    try:
+        result = await _submit(request_id, prepared, http_request, deadline, priority)
+    finally:
+        _release_image(job, prepared)
+    return await post_stage.run(finish_and_cache, prepared, result, key)
+
+def _retry_after_leader(e):
+    """Whether a follower should run a job itself after its leader failed with `e`: the leader's client went away, or the leader ran out of its own deadline or queue slot."""
+    if isinstance(e, HTTPException):
+        return e.status_code == 499
+    return isinstance(e, (asyncio.TimeoutError, SchedulerBusy, DeadlineExceeded))
+
+async def enqueue(request_id, job, http_request):
+    """
+    Run a job through the pipeline: image decode on the pre-processing
+    stage, the model through the scheduler, mask encoding on the
+    post-processing stage. Repeated requests are answered from the response
+    cache, and identical requests in progress share one run and one queue
+    slot.
+    """
+    _check_ready()
+    deadline, priority = _request_options(http_request)
+    with _scheduler_errors(request_id):
+        key, response = await pre_stage.run(lookup_response, job)
+        if response is not None:
+            return response
+        process = partial(_process, request_id, job, http_request, deadline, priority, key)
+        if key is None:
+            return await process()
+        # A follower gives up at its own deadline, not the leader's
+        return await single_flight.run(key, process, deadline=deadline, retry=_retry_after_leader)
+
+@contextmanager
+def _scheduler_errors(request_id):
+    """HTTP errors for the ways a job can fail to get through the scheduler to the model."""
+    try:
+        yield
     except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Request {request_id} was not served before its deadline.")
+    except SchedulerBusy as e:
+        metrics.REJECTED.inc()
         # Return error if the queue is full and timeout is reached
-        raise HTTPException(status_code=503, detail="Service is currently busy. Please try again later.")
-    
-    return await future  # Await the result from the queue processor
+        raise HTTPException(
+            status_code=503,
+            detail="Service is currently busy. Please try again later.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except ReplicaUnavailable as e:
+        # A replica died mid-request or none is up; the pool restarts them
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+def _parse_pos_coord_param(pos_coord):
+    """Parse coordinates sent as a JSON string in a form field or query parameter."""
+    try:
+        pos_coord = parse_coordinates(json.loads(pos_coord))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"pos_coord must be a JSON list of [x, y] coordinate pairs: {e}")
+    if len(pos_coord) == 0:
+        raise HTTPException(status_code=422, detail="pos_coord must contain at least one coordinate.")
+    return pos_coord
+
+def _check_formats(output_format, response_format):
+    if response_format == "png" and output_format != "png":
+        raise HTTPException(status_code=422, detail="response_format=png requires format=png.")
+
+def _parse_size_param(value, name, length):
+    try:
+        size = tuple(int(v) for v in value.split(","))
+    except ValueError:
+        size = ()
+    if len(size) != length or any(v <= 0 for v in size):
+        raise HTTPException(status_code=422, detail=f"{name} must be {length} comma separated positive integers.")
+    return size
+
+def _mask_response(result, output_format, response_format):
+    if response_format == "png":
+        return HTTPResponse(content=result, media_type=mask_media_type())
+    return _to_response(result, output_format)
+
+# Endpoint for image segmentation
+@app.post("/mask_image/", response_model=ImageResponse, response_model_exclude_none=True)
+async def generate_images(request: ImageRequest, http_request: Request):
+    request_id = request_id_var.get()
+    result = await enqueue(request_id, _job_from_request(request), http_request)
+    return _to_response(result, request.input.format)
+
+# Endpoint for segmenting several objects in one image with a single encoder pass
+@app.post("/mask_image/batch/", response_model=BatchImageResponse, response_model_exclude_none=True)
+async def generate_images_batch(request: BatchImageRequest, http_request: Request):
+    request_id = request_id_var.get()
+    results = await enqueue(request_id, _job_from_request(request), http_request)
+    return _to_batch_response(results, request.input.format)
+
+# Image as a multipart file upload, coordinates as a JSON form field.
+# response_format=png returns the mask as raw image bytes (image/png, or
+# image/webp with MASK_IMAGE_FORMAT=webp).
+@app.post("/mask_image/upload/", response_model=ImageResponse, response_model_exclude_none=True, responses=PNG_RESPONSE)
+async def generate_images_upload(
+    http_request: Request,
+    image: UploadFile = File(..., description="Image file to be segmented."),
+    pos_coord: str = Form(..., description="JSON list of [x, y] positive coordinates."),
+    format: MaskFormat = Query("png"),
+    response_format: Literal["json", "png"] = Query("json"),
+):
+    _check_formats(format, response_format)
+    request_id = request_id_var.get()
+    job = SegmentJob(await image.read(), _parse_pos_coord_param(pos_coord), output_format=format)
+    return _mask_response(await enqueue(request_id, job, http_request), format, response_format)
+
+# Image as the raw application/octet-stream body, coordinates as a JSON query parameter
+@app.post("/mask_image/raw/", response_model=ImageResponse, response_model_exclude_none=True, responses=PNG_RESPONSE)
+async def generate_images_raw(
+    http_request: Request,
+    image: bytes = Body(..., media_type="application/octet-stream"),
+    pos_coord: str = Query(..., description="JSON list of [x, y] positive coordinates."),
+    format: MaskFormat = Query("png"),
+    response_format: Literal["json", "png"] = Query("json"),
+):
+    _check_formats(format, response_format)
+    request_id = request_id_var.get()
+    job = SegmentJob(image, _parse_pos_coord_param(pos_coord), output_format=format)
+    return _mask_response(await enqueue(request_id, job, http_request), format, response_format)
+
+# Image embedding only, as raw fp16 bytes with the shape and original image
+# size in headers. Pass both back to /decode/ to get masks without the encoder.
+@app.post("/embedding/", response_class=HTTPResponse, responses=EMBEDDING_RESPONSE)
+async def compute_embedding(http_request: Request, image: bytes = Body(..., media_type="application/octet-stream")):
+    request_id = request_id_var.get()
+    embedding_bytes, shape, original_size = await enqueue(request_id, SegmentJob(image, None, output_format="embedding"), http_request)
+    headers = {
+        "X-Embedding-Shape": ",".join(str(v) for v in shape),
+        "X-Embedding-Dtype": "float16",
+        "X-Original-Size": ",".join(str(v) for v in original_size),
+    }
+    return HTTPResponse(content=embedding_bytes, media_type="application/octet-stream", headers=headers)
+
+# Decoder only: masks for an embedding from /embedding/ (raw fp16 body) and a set of points
+@app.post("/decode/", response_model=ImageResponse, response_model_exclude_none=True, responses=PNG_RESPONSE)
+async def decode_mask(
+    embedding: bytes = Body(..., media_type="application/octet-stream"),
+    shape: str = Query(..., description="Embedding shape from X-Embedding-Shape, e.g. 1,256,64,64."),
+    original_size: str = Query(..., description="Image height,width from X-Original-Size."),
+    pos_coord: str = Query(..., description="JSON list of [x, y] positive coordinates."),
+    format: MaskFormat = Query("png"),
+    response_format: Literal["json", "png"] = Query("json"),
+):
+    _check_formats(format, response_format)
+    shape = _parse_size_param(shape, "shape", 4)
+    original_size = _parse_size_param(original_size, "original_size", 2)
+    if len(embedding) != 2 * int(np.prod(shape)):
+        raise HTTPException(status_code=422, detail=f"Embedding has {len(embedding)} bytes, expected fp16 data of shape {shape}.")
+    pos_coord = _parse_pos_coord_param(pos_coord)
+    _check_ready()
+
+    # The torch decoder needs a model, which only the replicas have with a pool
+    decode = _decode_on_replica if pool is not None and onnx_decoder is None else decode_embedding
+    try:
+        result = await run_in_executor(
+            decoder_executor, profiled, "decode", decode, embedding, shape, original_size, pos_coord, format
+        )
+    except ReplicaUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return _mask_response(result, format, response_format)
+
+# Interactive segmentation: upload the image once (raw body), then send new
+# clicks and boxes to /sessions/{session_id}/predict. Only the prompt encoder
+# and mask decoder run per click, refined from the previous mask.
+@app.post("/sessions/", response_model=SessionInfo)
+async def create_session(http_request: Request, image: bytes = Body(..., media_type="application/octet-stream")):
+    request_id = request_id_var.get()
+    embedding_bytes, shape, original_size = await enqueue(request_id, SegmentJob(image, None, output_format="embedding"), http_request)
+    session = sessions.create(embedding_bytes, shape, original_size)
+    return SessionInfo(session_id=session.session_id, original_size=list(original_size), expires_in=SESSION_TTL)
+
+def _get_session(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} does not exist or has expired.")
+    return session
+
+@app.post("/sessions/{session_id}/predict", response_model=ImageResponse, response_model_exclude_none=True, responses=PNG_RESPONSE)
+async def predict_session(
+    session_id: str,
+    prompt: SessionPrompt,
+    response_format: Literal["json", "png"] = Query("json"),
+):
+    _check_formats(prompt.format, response_format)
+    try:
+        pos_coord = parse_coordinates(prompt.pos_coord)
+        neg_coord = parse_coordinates(prompt.neg_coord)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    session = _get_session(session_id)
+    _check_ready()
+
+    async with session.lock:
+        point_coords, point_labels, box, logits = session.prompts_with(
+            np.concatenate([pos_coord, neg_coord]),
+            np.concatenate([np.ones(len(pos_coord)), np.zeros(len(neg_coord))]),
+            prompt.box,
+            reset=prompt.reset,
+        )
+        if len(point_coords) == 0 and box is None:
+            raise HTTPException(status_code=422, detail="Send at least one point or a box.")
+        try:
+            result, score, logits = await _run_on_model(
+                refine_session_mask, session.embedding, session.shape, session.original_size,
+                point_coords, point_labels, box, logits, prompt.format,
+            )
+        except ReplicaUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+        session.update(point_coords, point_labels, box, logits)
+    sessions.trim()
+
+    if response_format == "png":
+        return HTTPResponse(content=result, media_type=mask_media_type(), headers={"X-Mask-Score": f"{score:.4f}"})
+    response = Response(**result) if prompt.format in COMPACT_FORMATS else Response.from_image_bytes(result, mask_media_type())
+    response.score = score
+    return ImageResponse(output=response)
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Session {session_id} does not exist or has expired.")
+    return {"deleted": session_id}
+
+# Number and size of the open interactive sessions
+@app.get("/sessions/stats")
+async def session_stats():
+    return sessions.stats()
+
+async def _crop_embedding(request_id, image, crop_box, http_request):
+    """Embedding of one crop of a decoded image, through the scheduler like every encoder pass."""
+    x0, y0, x1, y1 = crop_box
+    crop = np.ascontiguousarray(image[y0:y1, x0:x1])
+    job = SegmentJob(None, None, output_format="embedding", image=crop, size=(x1 - x0, y1 - y0))
+    return await enqueue(request_id, job, http_request)
+
+def decode_full_image(image_bytes):
+    """Pre-processing stage of /segment_everything/ with crops: the image at full size, to cut the crops from."""
+    pil_image, _ = bytes_to_model_image(image_bytes)
+    if pil_image is None:
+        raise HTTPException(status_code=422, detail="Could not decode the image.")
+    return np.array(pil_image)
+
+async def _stream_everything(request_id, image, embedding, options, max_masks, time_budget, http_request, deadline, priority):
+    start_time = time.perf_counter()
+    image_size = embedding[2]
+    # Point batches queue for the model like any request in the same lane;
+    # one still queued when the time budget or the request deadline runs out
+    # ends the stream early
+    batch_deadline = min(deadline, start_time + time_budget)
+    deduplicator = MaskDeduplicator(options.box_nms_thresh, options.crop_nms_thresh)
+    emitted = batches = 0
+    truncated = None
+    try:
+        for crop_index, (crop_box, point_batches) in enumerate(plan_crops(options, image_size)):
+            if crop_index > 0:
+                embedding = await _crop_embedding(request_id, image, crop_box, http_request)
+            for points in point_batches:
+                if time.perf_counter() - start_time >= time_budget:
+                    truncated = "time_budget"
+                    break
+                job = EverythingJob(embedding, points, crop_box, image_size, options)
+                with _scheduler_errors(request_id):
+                    try:
+                        records = await _submit(request_id, job, http_request, batch_deadline, priority)
+                    except (DeadlineExceeded, SchedulerBusy):
+                        truncated = "deadline" if batch_deadline == deadline else "time_budget"
+                        break
+                batches += 1
+                records = deduplicator.filter(records, crop_index)
+                if max_masks is not None:
+                    records = records[:max_masks - emitted]
+                emitted += len(records)
+                # One line per mask, all of a batch at once
+                yield "".join(json.dumps({"batch": batches, **record}) + "\n" for record in records)
+                if max_masks is not None and emitted >= max_masks:
+                    truncated = "max_masks"
+                    break
+            if truncated:
+                break
+    except HTTPException as e:
+        yield json.dumps({"error": e.detail, "status_code": e.status_code}) + "\n"
+        return
+    except Exception as e:
+        logger.exception(f"segment_everything {request_id} failed")
+        yield json.dumps({"error": str(e), "status_code": 500}) + "\n"
+        return
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"segment_everything {request_id}: {emitted} masks from {batches} batches in {elapsed:.2f}s")
+    yield json.dumps({"done": True, "masks": emitted, "batches": batches, "elapsed": round(elapsed, 3), "truncated": truncated}) + "\n"
+
+# All masks of an image, from a grid of point prompts (segment_anything's
+# automatic mask generator). Image as the raw body. Masks are streamed as
+# NDJSON, one COCO RLE record per line, as each batch of points is decoded;
+# the last line is a summary with "done": true, or an "error".
+@app.post("/segment_everything/", response_class=StreamingResponse, responses={200: {"content": {"application/x-ndjson": {}}}})
+async def segment_everything(
+    http_request: Request,
+    image: bytes = Body(..., media_type="application/octet-stream"),
+    points_per_side: int = Query(32, ge=1, le=EVERYTHING_MAX_POINTS_PER_SIDE),
+    points_per_batch: int = Query(64, ge=1, le=EVERYTHING_MAX_POINTS_PER_BATCH),
+    crop_n_layers: int = Query(0, ge=0, le=EVERYTHING_MAX_CROP_LAYERS),
+    crop_n_points_downscale_factor: int = Query(1, ge=1),
+    pred_iou_thresh: float = Query(0.88, ge=0, le=1),
+    stability_score_thresh: float = Query(0.95, ge=0, le=1),
+    box_nms_thresh: float = Query(0.7, gt=0, le=1),
+    min_mask_region_area: int = Query(0, ge=0),
+    max_masks: Optional[int] = Query(None, ge=1, description="Stop after this many masks."),
+    time_budget: float = Query(EVERYTHING_TIME_BUDGET, gt=0, le=EVERYTHING_TIME_BUDGET, description="Stop starting new batches after this many seconds."),
+):
+    options = EverythingOptions(
+        points_per_side=points_per_side,
+        points_per_batch=points_per_batch,
+        pred_iou_thresh=pred_iou_thresh,
+        stability_score_thresh=stability_score_thresh,
+        box_nms_thresh=box_nms_thresh,
+        crop_n_layers=crop_n_layers,
+        crop_n_points_downscale_factor=crop_n_points_downscale_factor,
+        min_mask_region_area=min_mask_region_area,
+    )
+    request_id = request_id_var.get()
+    _check_ready()
+    deadline, priority = _request_options(http_request)
+    job = SegmentJob(image, None, output_format="embedding")
+    image_array = None
+    if crop_n_layers > 0:
+        # Decoded once, for the whole image and every crop
+        with _scheduler_errors(request_id):
+            image_array = await pre_stage.run(decode_full_image, image)
+        job = SegmentJob(None, None, output_format="embedding", image=image_array)
+    # Encode the whole image before the response starts, so a busy server
+    # still answers with a plain 503
+    embedding = await enqueue(request_id, job, http_request)
+    return StreamingResponse(
+        _stream_everything(request_id, image_array, embedding, options, max_masks, time_budget, http_request, deadline, priority),
+        media_type="application/x-ndjson",
+    )
+
+# Profile of a request sent with an X-Profile header (or sampled), by its
+# X-Request-ID: pstats (.prof) for cprofile, a Chrome trace (.json) for torch
+@app.get("/profiles/{request_id}")
+async def get_profile(request_id: str):
+    path = find_profile(PROFILE_DIR, request_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"No profile of request {request_id}.")
+    media_type = "application/json" if path.endswith(".json") else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
+
+# Workers, queued requests and occupancy of the pre-processing, model and post-processing stages
+@app.get("/pipeline/stats")
+async def pipeline_stats():
+    return {
+        "pre": pre_stage.report(),
+        "model": {**model_stage.stats(scheduler.queue_depth), "queue_size": QUEUE_SIZE},
+        "post": post_stage.report(),
+    }
+
+# Liveness: the process is up and serving HTTP, whether or not the model is loaded
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# Readiness: 200 once the predictor is loaded and warm, 503 until then
+@app.get("/ready")
+async def ready():
+    replicas = {"replicas": pool.status()} if pool is not None else {}
+    if _is_ready():
+        return {"status": "ready", **replicas}
+    if startup_error is not None:
+        return JSONResponse(status_code=503, content={"status": "failed", "detail": str(startup_error), **replicas})
+    return JSONResponse(status_code=503, content={"status": "loading", **replicas})
+
+def _cache_stats():
+    return embedding_cache.stats()
+
+def _replica_metrics():
+    return metrics.collect(process=f"replica-{worker_pool.REPLICA}")
+
+# Hit/miss/eviction counters of the image-embedding cache, summed over replicas,
+# the size of the embedding store and the response cache counters
+@app.get("/cache/stats")
+async def cache_stats():
+    if pool is None:
+        stats = _cache_stats()
+    else:
+        per_replica = await asyncio.get_running_loop().run_in_executor(None, partial(pool.call_each, _cache_stats, timeout=2.0))
+        stats = {key: sum(stats[key] for stats in per_replica) for key in _cache_stats()}
+    if embedding_store is not None:
+        stats["store"] = embedding_store.stats()
+    stats["responses"] = {**response_cache.stats(), "coalesced": single_flight.coalesced, "in_flight": single_flight.in_flight}
+    return stats
+
+# Stage latencies, queue wait, queue depth and error counters in Prometheus text format
+@app.get("/metrics", response_class=HTTPResponse)
+async def prometheus_metrics():
+    if pool is None:
+        return HTTPResponse(content=metrics.render(metrics.collect()), media_type=metrics.CONTENT_TYPE)
+    # Stage timings of the model are recorded in the replicas; a busy one is left out of this scrape
+    snapshots = await asyncio.get_running_loop().run_in_executor(None, partial(pool.call_each, _replica_metrics, timeout=2.0))
+    content = metrics.render(metrics.collect(process="front"), *snapshots)
+    return HTTPResponse(content=content, media_type=metrics.CONTENT_TYPE)
 
 if __name__ == "__main__":
     import uvicorn
@@ -91,6 +769,6 @@ if __name__ == "__main__":
         "endpoint:app",
         host="0.0.0.0",
         port=8000,
-        workers=1,  # Since using GPU, multiple workers might not be beneficial
+        workers=1,  # One model per process; scale out with NUM_REPLICAS instead
         log_level="info"
     )  
\ No newline at end of file
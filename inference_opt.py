@@ -0,0 +1,185 @@
+import contextlib
+import time
+import types
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from segment_anything.modeling.image_encoder import Attention, get_rel_pos
+
+from config import logger
+
+AUTOCAST_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def _decomposed_rel_pos_bias(q, rel_pos_h, rel_pos_w, q_size, k_size):
+    """
+    The relative position term `add_decomposed_rel_pos` adds to the attention
+    logits, as a standalone (B, q_h * q_w, k_h * k_w) bias for SDPA.
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
+    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
+
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    return (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).reshape(B, q_h * q_w, k_h * k_w)
+
+
+def _sdpa_attention_forward(self, x):
+    # Same as Attention.forward, with the softmax(QK^T)V part done by the fused kernel
+    B, H, W, _ = x.shape
+    qkv = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
+
+    attn_bias = None
+    if self.use_rel_pos:
+        attn_bias = _decomposed_rel_pos_bias(q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W)).to(q.dtype)
+
+    # SDPA's default scale is head_dim ** -0.5, like self.scale
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+    x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+    return self.proj(x)
+
+
+def set_sdpa_attention(encoder, enabled=True):
+    """Swap the attention of every image encoder block to scaled_dot_product_attention, or back."""
+    for module in encoder.modules():
+        if isinstance(module, Attention):
+            if enabled:
+                module.forward = types.MethodType(_sdpa_attention_forward, module)
+            else:
+                module.__dict__.pop("forward", None)
+
+
+class OptimizedImageEncoder(torch.nn.Module):
+    """
+    Wraps SAM's image encoder to run it under inference_mode, optionally with
+    autocast, channels_last inputs and torch.compile. Embeddings always come
+    out as fp32, so the decoder, the embedding cache and /embedding/ see no
+    difference.
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+        self.autocast_dtype = None
+        self.channels_last = False
+        self._compiled = None
+
+    @property
+    def img_size(self):
+        # Sam.preprocess pads to this
+        return self.encoder.img_size
+
+    def set_channels_last(self, enabled):
+        self.channels_last = enabled
+        self.encoder.to(memory_format=torch.channels_last if enabled else torch.contiguous_format)
+
+    def compile(self, mode=None):
+        self._compiled = torch.compile(self.encoder, mode=mode, dynamic=False)
+
+    def uncompile(self):
+        self._compiled = None
+
+    def forward(self, x):
+        device_type = x.device.type
+        autocast = (
+            torch.autocast(device_type=device_type, dtype=self.autocast_dtype)
+            if self.autocast_dtype is not None
+            else contextlib.nullcontext()
+        )
+        with torch.inference_mode(), autocast:
+            if self.channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            features = (self.encoder if self._compiled is None else self._compiled)(x)
+        return features.float()
+
+
+def _validation_image(size=768, seed=0):
+    """Deterministic image with a few flat regions for the masks to latch onto."""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    image = np.stack([x * 255 // size, y * 255 // size, np.full_like(x, 96)], axis=-1).astype(np.uint8)
+    for _ in range(6):
+        x0, y0 = rng.randint(0, size - size // 4, 2)
+        image[y0:y0 + size // 4, x0:x0 + size // 4] = rng.randint(0, 256, 3)
+    return image, rng.randint(0, size, (8, 1, 2))
+
+
+@torch.no_grad()
+def _predict_validation_masks(predictor):
+    image, prompts = _validation_image()
+    predictor.set_image(image)
+    masks = []
+    for points in prompts:
+        mask, _, _ = predictor.predict(point_coords=points, point_labels=np.ones(len(points)), multimask_output=False)
+        masks.append(mask[0])
+    predictor.reset_image()
+    return masks
+
+
+def _mask_iou(reference, candidate):
+    """Mean IoU over prompt masks; two empty masks count as a perfect match."""
+    ious = []
+    for a, b in zip(reference, candidate):
+        union = np.logical_or(a, b).sum()
+        ious.append(1.0 if union == 0 else np.logical_and(a, b).sum() / union)
+    return float(np.mean(ious))
+
+
+def apply_optimizations(predictor, dtype="fp32", channels_last=False, sdpa=False, compile_mode=None,
+                        validate=True, iou_tolerance=0.95, warmup_batch_sizes=(1,)):
+    """
+    Turn on the requested encoder execution modes one at a time. With
+    `validate`, masks for a fixed image and prompts are compared against the
+    plain fp32 encoder after each step, and a mode that drops the mean IoU
+    below `iou_tolerance` is switched back off with a warning.
+
+    `compile_mode` is None (no torch.compile) or a torch.compile mode such as
+    "default" or "max-autotune". The compiled encoder is warmed up for every
+    batch size in `warmup_batch_sizes`, since shapes are static.
+    """
+    if dtype not in AUTOCAST_DTYPES:
+        raise ValueError(f"Unknown encoder dtype '{dtype}', expected one of {sorted(AUTOCAST_DTYPES)}.")
+    sam = predictor.model
+    reference = _predict_validation_masks(predictor) if validate else None
+    encoder = sam.image_encoder if isinstance(sam.image_encoder, OptimizedImageEncoder) else OptimizedImageEncoder(sam.image_encoder)
+    sam.image_encoder = encoder
+
+    def check(name, undo):
+        if not validate:
+            logger.info(f"Enabled {name} for the image encoder")
+            return
+        start_time = time.perf_counter()
+        iou = _mask_iou(reference, _predict_validation_masks(predictor))
+        if iou < iou_tolerance:
+            undo()
+            logger.warning(f"Disabled {name}: mask IoU against fp32 is {iou:.4f}, below {iou_tolerance}")
+        else:
+            logger.info(f"Enabled {name} for the image encoder (mask IoU against fp32 {iou:.4f}, "
+                        f"checked in {time.perf_counter() - start_time:.2f}s)")
+
+    if sdpa:
+        set_sdpa_attention(encoder.encoder)
+        check("SDPA attention", lambda: set_sdpa_attention(encoder.encoder, enabled=False))
+    if channels_last:
+        encoder.set_channels_last(True)
+        check("channels_last", lambda: encoder.set_channels_last(False))
+    if AUTOCAST_DTYPES[dtype] is not None:
+        encoder.autocast_dtype = AUTOCAST_DTYPES[dtype]
+        check(f"{dtype} autocast", lambda: setattr(encoder, "autocast_dtype", None))
+    if compile_mode:
+        encoder.compile(mode=None if compile_mode == "default" else compile_mode)
+        start_time = time.perf_counter()
+        for batch_size in warmup_batch_sizes:
+            # Compilation happens on the first call for each input shape
+            dummy = torch.zeros(batch_size, 3, encoder.img_size, encoder.img_size, device=predictor.device)
+            encoder(dummy)
+        logger.info(f"Compiled the image encoder in {time.perf_counter() - start_time:.2f}s "
+                    f"(batch sizes {', '.join(str(b) for b in warmup_batch_sizes)})")
+        check(f"torch.compile ({compile_mode})", encoder.uncompile)
+    return predictor
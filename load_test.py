@@ -0,0 +1,439 @@
+# Load test of the serving path: replays request payloads at a fixed arrival
+# rate (open loop) or with a fixed number of requests in flight (closed loop)
+# and reports latency percentiles, throughput, the 503 rate with the
+# Retry-After the server asked for, and the scheduler queue wait. Without --url it starts `uvicorn endpoint:app` itself with the
+# "stub" model (see stub_predictor.py), so only the scheduler, the CPU stages
+# and the configured model latency are measured:
+#   python load_test.py --rate 8 --duration 30
+#   python load_test.py --concurrency 16 --requests 500 --encoder-latency 0.3
+#   python load_test.py --rate 20 --server-env QUEUE_SIZE=16 --server-env MAX_BATCH_SIZE=4 --output run.json
+#   python load_test.py --folder images/ --coordinates coords.jsonl --rate 4
+#   python load_test.py --payload payload_schema.txt --url http://localhost:8000 --concurrency 4
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import httpx
+import numpy as np
+from PIL import Image
+
+# Sentinel the coordinates of a payload are serialized as, replaced per request
+COORDINATES_PLACEHOLDER = "__coordinates__"
+QUEUE_WAIT_METRIC = "sam_queue_wait_seconds"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def synthetic_payloads(count, width=1280, height=960, seed=0):
+    """`count` request bodies, each a different gradient JPEG with a few random points."""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    payloads = []
+    for _ in range(count):
+        phase = rng.uniform(0, 2 * np.pi, 3)
+        image = np.stack([127 + 127 * np.sin(x / rng.uniform(40, 200) + phase[i]) * np.cos(y / rng.uniform(40, 200)) for i in range(3)], axis=-1)
+        buffered = io.BytesIO()
+        Image.fromarray(image.astype(np.uint8)).save(buffered, format="JPEG", quality=90)
+        points = np.stack([rng.uniform(0, width, 2), rng.uniform(0, height, 2)], axis=1).round().tolist()
+        payloads.append({"input": {
+            "target_image": "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode("utf-8"),
+            "pos_coord": points,
+        }})
+    return payloads
+
+
+def load_payloads(path):
+    """Request bodies from a JSON file (one body, or a list of them) or a JSONL file of bodies."""
+    with open(path, "r") as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+
+def folder_payloads(folder_path, coordinates_path, limit=None):
+    """Request bodies from a folder of images and a JSONL file of {"target", "coordinates"} lines, as bulk_mask_generation_with_sam.py sends them."""
+    payloads = []
+    with open(coordinates_path, "r") as f:
+        for line in f:
+            if limit is not None and len(payloads) >= limit:
+                break
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            image_path = os.path.join(folder_path, entry.get("target") or "")
+            if not entry.get("coordinates") or not os.path.isfile(image_path):
+                continue
+            with open(image_path, "rb") as image_file:
+                encoded = base64.b64encode(image_file.read()).decode("utf-8")
+            payloads.append({"input": {"target_image": f"data:image/png;base64,{encoded}", "pos_coord": entry["coordinates"]}})
+    return payloads
+
+
+class Template:
+    """
+    A payload serialized once around its coordinates, so a request body costs
+    a string join instead of serializing a multi-megabyte image again.
+    """
+
+    def __init__(self, payload):
+        payload = json.loads(json.dumps(payload))
+        inputs = payload.get("input", payload)
+        self.field = "pos_coord" if "pos_coord" in inputs else "prompts" if "prompts" in inputs else None
+        if self.field is None:
+            self.coordinates = None
+            self.prefix, self.suffix = json.dumps(payload).encode("utf-8"), b""
+            return
+        self.coordinates = inputs[self.field]
+        inputs[self.field] = COORDINATES_PLACEHOLDER
+        self.prefix, self.suffix = json.dumps(payload).encode("utf-8").split(json.dumps(COORDINATES_PLACEHOLDER).encode("utf-8"))
+
+    def body(self, offset=0.0):
+        """The request body with `offset` pixels added to the x of the first point."""
+        if self.coordinates is None:
+            return self.prefix
+        coordinates = json.loads(json.dumps(self.coordinates))
+        if offset:
+            first = coordinates[0][0] if self.field == "prompts" else coordinates[0]
+            first[0] += offset
+        return self.prefix + json.dumps(coordinates).encode("utf-8") + self.suffix
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {f"p{int(q * 100)}": values[min(len(values) - 1, int(round(q * (len(values) - 1))))] for q in QUANTILES}
+    result.update({"mean": statistics.fmean(values), "max": values[-1]})
+    return result
+
+
+def parse_histogram(text, name):
+    """{upper bound: cumulative count} plus the sum of a Prometheus histogram, summed over label sets."""
+    buckets, total = {}, 0.0
+    for line in text.splitlines():
+        if line.startswith(f"{name}_bucket"):
+            labels, value = line[len(name) + len("_bucket"):].rsplit(" ", 1)
+            bound = labels.split('le="', 1)[1].split('"', 1)[0]
+            bound = float("inf") if bound == "+Inf" else float(bound)
+            buckets[bound] = buckets.get(bound, 0.0) + float(value)
+        elif line.startswith(f"{name}_sum"):
+            total += float(line.rsplit(" ", 1)[1])
+    return buckets, total
+
+
+def histogram_quantile(q, buckets):
+    """Quantile estimated from cumulative buckets, interpolating within a bucket like Prometheus does."""
+    bounds = sorted(buckets)
+    count = buckets[bounds[-1]] if bounds else 0
+    if count <= 0:
+        return None
+    rank = q * count
+    lower, below = 0.0, 0.0
+    for bound in bounds:
+        if buckets[bound] >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(buckets[bound] - below, 1e-12)
+        lower, below = bound, buckets[bound]
+    return lower
+
+
+def queue_wait_report(before, after):
+    """Queue wait distribution of the requests dispatched between two /metrics scrapes."""
+    (buckets_before, sum_before), (buckets_after, sum_after) = before, after
+    buckets = {bound: count - buckets_before.get(bound, 0.0) for bound, count in buckets_after.items()}
+    count = buckets.get(float("inf"), 0.0)
+    report = {"count": int(count), "mean": (sum_after - sum_before) / count if count else None}
+    report.update({f"p{int(q * 100)}": histogram_quantile(q, buckets) for q in QUANTILES})
+    report["buckets"] = {("+Inf" if bound == float("inf") else str(bound)): int(count) for bound, count in sorted(buckets.items())}
+    return report
+
+
+async def scrape_queue_wait(client):
+    try:
+        response = await client.get("/metrics")
+        response.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    return parse_histogram(response.text, QUEUE_WAIT_METRIC)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        # Retry-After seconds of the 503 responses
+        self.retry_after = []
+        self.statuses = Counter()
+        self.first_sent = None
+        self.last_done = None
+
+    def record(self, sent_at, status, latency, retry_after=None):
+        self.statuses[status] += 1
+        if status == 200:
+            self.latencies.append(latency)
+        if retry_after is not None:
+            self.retry_after.append(retry_after)
+        self.first_sent = sent_at if self.first_sent is None else min(self.first_sent, sent_at)
+        self.last_done = time.perf_counter()
+
+
+async def send(client, path, body, recorder, headers):
+    sent_at = time.perf_counter()
+    retry_after = None
+    try:
+        response = await client.post(path, content=body, headers=headers)
+        await response.aread()
+        status = response.status_code
+        if status == 503:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+    except httpx.TimeoutException:
+        status = "timeout"
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    recorder.record(sent_at, status, time.perf_counter() - sent_at, retry_after)
+
+
+def parse_retry_after(value):
+    """Seconds of a Retry-After header, None if missing or not a number."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def request_bodies(templates, distinct):
+    """Endless request bodies, cycling through the payloads. With `distinct`,
+    each gets a different sub-pixel offset so the response cache and request
+    coalescing on the server do not turn repeats into free hits."""
+    index = 0
+    while True:
+        template = templates[index % len(templates)]
+        offset = ((index // len(templates)) % 4096 + 1) * 1e-4 if distinct else 0.0
+        yield template.body(offset)
+        index += 1
+
+
+async def run_open_loop(client, path, bodies, recorder, headers, rate, total, duration, poisson):
+    """Send `rate` requests per second whatever the responses, until `total` are sent or `duration` is over."""
+    tasks = []
+    start_time = time.perf_counter()
+    next_at = start_time
+    for sent in range(total):
+        if time.perf_counter() - start_time >= duration:
+            break
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, path, next(bodies), recorder, headers)))
+        next_at += random.expovariate(rate) if poisson else 1.0 / rate
+    await asyncio.gather(*tasks)
+    return len(tasks)
+
+
+async def run_closed_loop(client, path, bodies, recorder, headers, concurrency, total, duration):
+    """Keep `concurrency` requests in flight until `total` are sent or `duration` is over."""
+    sent = 0
+    start_time = time.perf_counter()
+
+    async def worker():
+        nonlocal sent
+        while sent < total and time.perf_counter() - start_time < duration:
+            sent += 1
+            await send(client, path, next(bodies), recorder, headers)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return sent
+
+
+def summarize(recorder, sent, queue_wait):
+    elapsed = (recorder.last_done - recorder.first_sent) if sent else 0.0
+    ok = recorder.statuses.get(200, 0)
+    return {
+        "sent": sent,
+        "elapsed_s": elapsed,
+        "statuses": {str(status): count for status, count in sorted(recorder.statuses.items(), key=lambda item: str(item[0]))},
+        "throughput_rps": ok / elapsed if elapsed else 0.0,
+        "offered_rps": sent / elapsed if elapsed else 0.0,
+        "rate_503": recorder.statuses.get(503, 0) / sent if sent else 0.0,
+        "retry_after_s": percentiles(recorder.retry_after),
+        "error_rate": (sent - ok) / sent if sent else 0.0,
+        "latency_s": percentiles(recorder.latencies),
+        "queue_wait_s": queue_wait,
+    }
+
+
+def print_report(report):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f} ms"
+
+    latency, retry_after, queue_wait = report["latency_s"], report["retry_after_s"], report["queue_wait_s"]
+    print(f"sent {report['sent']} in {report['elapsed_s']:.1f}s, statuses {report['statuses']}", file=sys.stderr)
+    print(f"throughput {report['throughput_rps']:.2f} req/s (offered {report['offered_rps']:.2f}), "
+          f"503 rate {report['rate_503']:.1%}, error rate {report['error_rate']:.1%}", file=sys.stderr)
+    if latency:
+        print(f"latency     p50 {ms(latency['p50'])}  p95 {ms(latency['p95'])}  p99 {ms(latency['p99'])}  "
+              f"max {ms(latency['max'])}", file=sys.stderr)
+    if retry_after:
+        print(f"Retry-After p50 {retry_after['p50']:g}s  p95 {retry_after['p95']:g}s  max {retry_after['max']:g}s  "
+              f"(of the 503 responses)", file=sys.stderr)
+    if queue_wait:
+        print(f"queue wait  p50 {ms(queue_wait['p50'])}  p95 {ms(queue_wait['p95'])}  p99 {ms(queue_wait['p99'])}  "
+              f"mean {ms(queue_wait['mean'])}  ({queue_wait['count']} dispatched, from /metrics buckets)", file=sys.stderr)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args):
+    """`uvicorn endpoint:app` on a free local port with the stub model, plus any --server-env overrides."""
+    port = free_port()
+    env = {
+        **os.environ,
+        "SAM_MODEL_TYPE": "stub",
+        "SAM_DEVICE": "cpu",
+        "STUB_ENCODER_LATENCY": str(args.encoder_latency),
+        "STUB_ENCODER_IMAGE_LATENCY": str(args.image_latency),
+        "STUB_DECODER_LATENCY": str(args.decoder_latency),
+    }
+    if not args.keep_caches:
+        # Every request pays for the encoder, like distinct production images
+        env.update({"EMBEDDING_CACHE_MAX_BYTES": "0", "RESPONSE_CACHE_MAX_BYTES": "0"})
+    for item in args.server_env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "endpoint:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    return process, f"http://127.0.0.1:{port}"
+
+
+async def wait_until_ready(client, process, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode} before it was ready.")
+        try:
+            response = await client.get("/ready")
+            if response.status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f"The server was not ready after {timeout}s.")
+
+
+async def load_test(args, templates, base_url, process=None):
+    headers = {"Content-Type": "application/json"}
+    if args.priority:
+        headers["X-Priority"] = args.priority
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        await wait_until_ready(client, process, args.ready_timeout)
+        bodies = request_bodies(templates, not args.repeat_identical)
+        for _ in range(args.warmup):
+            await send(client, args.path, next(bodies), Recorder(), headers)
+
+        before = await scrape_queue_wait(client)
+        recorder = Recorder()
+        if args.rate:
+            sent = await run_open_loop(client, args.path, bodies, recorder, headers, args.rate, args.requests, args.duration, not args.uniform)
+        else:
+            sent = await run_closed_loop(client, args.path, bodies, recorder, headers, args.concurrency, args.requests, args.duration)
+        after = await scrape_queue_wait(client)
+
+        report = summarize(recorder, sent, queue_wait_report(before, after) if before and after else None)
+        try:
+            report["pipeline"] = (await client.get("/pipeline/stats")).json()
+        except (httpx.HTTPError, ValueError):
+            pass
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay segmentation requests against the server and report latency, throughput and queueing.")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--rate", type=float, default=None, help="Open loop: requests per second, sent whatever the responses.")
+    load.add_argument("--concurrency", type=int, default=4, help="Closed loop: requests kept in flight (default when --rate is not given).")
+    parser.add_argument("--uniform", action="store_true", help="Evenly spaced arrivals with --rate instead of Poisson ones.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests to send at most.")
+    parser.add_argument("--duration", type=float, default=float("inf"), help="Seconds to send requests for at most.")
+    parser.add_argument("--warmup", type=int, default=2, help="Requests sent before measuring.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Client timeout per request in seconds.")
+    parser.add_argument("--priority", default=None, help="X-Priority header to send (interactive or bulk).")
+
+    source = parser.add_argument_group("payloads (synthetic 1280x960 JPEGs by default)")
+    source.add_argument("--payload", default=None, help="JSON request body, list of bodies or JSONL file of bodies, e.g. payload_schema.txt.")
+    source.add_argument("--folder", default=None, help="Folder of images, with --coordinates.")
+    source.add_argument("--coordinates", default=None, help="JSONL of {\"target\": file name, \"coordinates\": [[x, y], ...]} lines.")
+    source.add_argument("--max-payloads", type=int, default=64, help="Distinct payloads to load from --folder, or to generate.")
+    source.add_argument("--path", default="/mask_image/", help="Route the payloads are posted to.")
+    source.add_argument("--repeat-identical", action="store_true",
+                        help="Send repeated payloads byte for byte, so caching and coalescing on the server kick in.")
+
+    server = parser.add_argument_group("server (started locally with the stub model unless --url is given)")
+    server.add_argument("--url", default=None, help="Base URL of a running server.")
+    server.add_argument("--encoder-latency", type=float, default=0.05, help="Stub seconds per encoder pass.")
+    server.add_argument("--image-latency", type=float, default=0.15, help="Stub seconds per image in an encoder pass.")
+    server.add_argument("--decoder-latency", type=float, default=0.01, help="Stub seconds per mask decoder call.")
+    server.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Environment of the local server, e.g. QUEUE_SIZE=16, MAX_BATCH_SIZE=4 or NUM_REPLICAS=2.")
+    server.add_argument("--keep-caches", action="store_true", help="Leave the embedding and response caches of the local server on.")
+    server.add_argument("--server-log", default=None, help="File for the output of the local server.")
+    server.add_argument("--ready-timeout", type=float, default=120.0)
+    parser.add_argument("--output", default=None, help="Also write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    if args.folder or args.coordinates:
+        if not (args.folder and args.coordinates):
+            parser.error("--folder and --coordinates go together.")
+        payloads = folder_payloads(args.folder, args.coordinates, args.max_payloads)
+    elif args.payload:
+        payloads = load_payloads(args.payload)
+    else:
+        payloads = synthetic_payloads(args.max_payloads)
+    if not payloads:
+        parser.error("No payloads to send.")
+    templates = [Template(payload) for payload in payloads]
+
+    process = None
+    base_url = args.url
+    if base_url is None:
+        process, base_url = start_server(args)
+    try:
+        report = asyncio.run(load_test(args, templates, base_url, process))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    report["config"] = {key: value for key, value in vars(args).items() if value != float("inf")}
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
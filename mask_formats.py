@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+from pycocotools import mask as mask_utils
+
+from config import POLYGON_EPSILON
+from metrics import timed
+
+# Output formats that skip rendering and PNG encoding entirely
+COMPACT_FORMATS = ("rle", "polygon", "bbox")
+
+
+def merge_masks(masks) -> np.ndarray:
+    """Union of a CxHxW stack of boolean masks, as one HxW boolean mask."""
+    masks = np.asarray(masks, dtype=bool)
+    if masks.ndim == 2:
+        return masks
+    return masks.any(axis=0)
+
+
+def mask_to_rle(mask: np.ndarray) -> dict:
+    """COCO run-length encoding of an HxW boolean mask, with `counts` as a string."""
+    rle = mask_utils.encode(np.asfortranarray(mask, dtype=np.uint8))
+    return {"size": rle["size"], "counts": rle["counts"].decode("ascii")}
+
+
+def mask_to_polygons(mask: np.ndarray, epsilon: float = POLYGON_EPSILON) -> list:
+    """
+    Outer contours of an HxW boolean mask, simplified with Douglas-Peucker
+    to within `epsilon` pixels, as flat [x1, y1, x2, y2, ...] lists.
+    """
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    polygons = []
+    for contour in contours:
+        if epsilon > 0:
+            contour = cv2.approxPolyDP(contour, epsilon, True)
+        # A polygon needs at least three vertices
+        if len(contour) >= 3:
+            polygons.append(contour.reshape(-1).tolist())
+    return polygons
+
+
+def mask_to_bbox(mask: np.ndarray):
+    """COCO [x, y, width, height] box and pixel area of an HxW boolean mask."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return [0, 0, 0, 0], 0
+    cols = np.flatnonzero(mask.any(axis=0))
+    bbox = [int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)]
+    return bbox, int(np.count_nonzero(mask))
+
+
+@timed("compact_encode")
+def encode_mask(mask: np.ndarray, output_format: str) -> dict:
+    """
+    Encode an HxW boolean mask in one of COMPACT_FORMATS. Returns the fields
+    of a `models.Response`; every format carries the bbox and area.
+    """
+    if output_format == "rle":
+        rle = mask_to_rle(mask)
+        # pycocotools derives both straight from the runs
+        bbox = [int(v) for v in mask_utils.toBbox(rle)]
+        return {"rle": rle, "bbox": bbox, "area": int(mask_utils.area(rle))}
+    bbox, area = mask_to_bbox(mask)
+    if output_format == "polygon":
+        return {"polygons": mask_to_polygons(mask), "bbox": bbox, "area": area}
+    if output_format == "bbox":
+        return {"bbox": bbox, "area": area}
+    raise ValueError(f"Unsupported mask format '{output_format}'.")
@@ -0,0 +1,192 @@
+import functools
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, disable_created_metrics, generate_latest
+from prometheus_client.core import Metric
+from prometheus_client.exposition import CONTENT_TYPE_PLAIN_0_0_4
+
+# Metrics are prometheus_client ones. What is ours is `collect` and `render`:
+# replicas and the Modal model container send plain snapshots of their
+# registry to the process serving /metrics, which merges them into one page.
+
+# Upper bounds in seconds, from sub-millisecond decoder calls to full
+# encoder passes on large images queued behind a batch
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Every metric of the server, without the default registry's process and
+# runtime collectors
+REGISTRY = CollectorRegistry()
+
+# No *_created samples next to counters and histograms
+disable_created_metrics()
+
+# Content type of the text exposition format, the version every Prometheus
+# server reads
+CONTENT_TYPE = CONTENT_TYPE_PLAIN_0_0_4
+
+
+def collect(registry=REGISTRY, **const_labels):
+    """
+    Snapshot of every metric as plain (name, type, help, samples) tuples, so
+    it can be sent across processes. `const_labels` are added to each sample.
+    """
+    families = []
+    for metric in registry.collect():
+        samples = [(sample.name, {**const_labels, **sample.labels}, sample.value) for sample in metric.samples]
+        families.append((metric.name, metric.type, metric.documentation, samples))
+    return families
+
+
+class _Snapshots:
+    """`collect` snapshots as a collector for `generate_latest`, families with the same name merged."""
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+
+    def collect(self):
+        merged = {}
+        for families in self.snapshots:
+            for name, metric_type, documentation, samples in families:
+                if name not in merged:
+                    merged[name] = Metric(name, documentation, metric_type)
+                for sample_name, labels, value in samples:
+                    merged[name].add_sample(sample_name, labels, value)
+        return merged.values()
+
+
+def render(*snapshots) -> str:
+    """
+    Prometheus text exposition of one or more `collect` snapshots. Families
+    with the same name are merged, so snapshots from several processes can be
+    served together as long as their const labels tell them apart.
+    """
+    return generate_latest(_Snapshots(snapshots)).decode("utf-8")
+
+
+@contextmanager
+def track(gauge, amount=1.0):
+    """Raise `gauge` by `amount` while the block runs."""
+    gauge.inc(amount)
+    try:
+        yield
+    finally:
+        gauge.dec(amount)
+
+
+STAGE_SECONDS = Histogram(
+    "sam_stage_seconds",
+    "Time spent in each processing stage of a request.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+    registry=REGISTRY,
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "sam_queue_wait_seconds",
+    "Time a request waited in the scheduler queue before its batch was dispatched.",
+    buckets=LATENCY_BUCKETS,
+    registry=REGISTRY,
+)
+BATCH_SIZE = Histogram(
+    "sam_batch_size",
+    "Number of requests per dispatched micro-batch.",
+    buckets=(1, 2, 4, 8, 16, 32),
+    registry=REGISTRY,
+)
+REQUEST_SECONDS = Histogram(
+    "sam_request_seconds",
+    "End-to-end HTTP request latency.",
+    ["path"],
+    buckets=LATENCY_BUCKETS,
+    registry=REGISTRY,
+)
+REQUESTS = Counter(
+    "sam_requests",
+    "HTTP requests by route and status code.",
+    ["path", "status"],
+    registry=REGISTRY,
+)
+QUEUE_DEPTH = Gauge(
+    "sam_queue_depth",
+    "Requests waiting in the scheduler queue.",
+    registry=REGISTRY,
+)
+IN_FLIGHT = Gauge(
+    "sam_in_flight",
+    "Requests currently being processed by the model.",
+    registry=REGISTRY,
+)
+REJECTED = Counter(
+    "sam_rejected",
+    "Requests rejected with 503 because the queue was full.",
+    registry=REGISTRY,
+)
+DROPPED = Counter(
+    "sam_dropped",
+    "Requests dropped before reaching the model: refused at admission, cancelled or expired in the queue.",
+    ["reason"],
+    registry=REGISTRY,
+)
+ERRORS = Counter(
+    "sam_errors",
+    "Requests that failed while being processed, by exception type.",
+    ["type"],
+    registry=REGISTRY,
+)
+PIPELINE_WORKERS = Gauge(
+    "sam_pipeline_workers",
+    "Threads (model: batches in parallel) of each stage of the request pipeline.",
+    ["stage"],
+    registry=REGISTRY,
+)
+PIPELINE_BUSY = Gauge(
+    "sam_pipeline_busy",
+    "Workers of each pipeline stage processing a request right now.",
+    ["stage"],
+    registry=REGISTRY,
+)
+PIPELINE_QUEUED = Gauge(
+    "sam_pipeline_queued",
+    "Requests waiting for a worker of each pipeline stage.",
+    ["stage"],
+    registry=REGISTRY,
+)
+PIPELINE_BUSY_SECONDS = Counter(
+    "sam_pipeline_busy_seconds",
+    "Worker time spent in each pipeline stage; occupancy is its rate over sam_pipeline_workers.",
+    ["stage"],
+    registry=REGISTRY,
+)
+STORE_LOOKUPS = Counter(
+    "sam_embedding_store_lookups",
+    "Lookups of request images in the precomputed embedding store, by result.",
+    ["result"],
+    registry=REGISTRY,
+)
+REPLICAS_READY = Gauge(
+    "sam_replicas_ready",
+    "Model replica processes loaded and accepting work (NUM_REPLICAS > 0).",
+    registry=REGISTRY,
+)
+REPLICA_RESTARTS = Counter(
+    "sam_replica_restarts",
+    "Model replica processes restarted after they exited.",
+    registry=REGISTRY,
+)
+
+
+def timed(stage):
+    """Decorator recording the duration of every call in STAGE_SECONDS under `stage`."""
+    # Resolve the child once so the hot path is two clock reads and an observe
+    histogram = STAGE_SECONDS.labels(stage)
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start_time)
+        return wrapper
+    return decorator
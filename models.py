@@ -1,26 +1,51 @@
-from pydantic import BaseModel, Field, validator
-from typing import List
+from pydantic import BaseModel, Field, PrivateAttr, model_validator, validator
+from typing import List, Literal, Optional
 import base64
+from config import MAX_PROMPT_GROUPS
+from metrics import STAGE_SECONDS
 
 
-class Request(BaseModel):
+# "png" is a rendered mask image; the others skip rendering and PNG encoding
+MaskFormat = Literal["png", "rle", "polygon", "bbox"]
+
+
+class ImageInput(BaseModel):
     target_image: str = Field(..., description="Base64 encoded string of the target image to be segmented.")
-    pos_coord: List[List[float]] = Field(..., description="Array of positive coordinates for the segmentation points.")
-    
+    _image_bytes: Optional[bytes] = PrivateAttr(default=None)
+
     @validator("target_image")
     def validate_base64_image(cls, value):
         """
-        Validates that the `target_image` is a valid base64 string.
+        Validates that the `target_image` is a base64 data URI. The payload
+        itself is decoded once, in `decode_target_image`.
+        """
+        # Check if the string starts with 'data:image/' and carries a payload
+        if not value.startswith("data:image/") or "," not in value:
+            raise ValueError("Invalid base64 image format.")
+        return value
+
+    @model_validator(mode="after")
+    def decode_target_image(self):
+        """
+        Decodes `target_image` and keeps the bytes, so the handler does not
+        have to decode the payload a second time.
         """
+        header, encoded = self.target_image.split(",", 1)
         try:
-            # Check if the string starts with 'data:image/' and contains a valid base64 image
-            if not value.startswith("data:image/"):
-                raise ValueError("Image must start with 'data:image/'.")
-            header, encoded = value.split(",", 1)
-            base64.b64decode(encoded)
+            with STAGE_SECONDS.labels("base64_decode").time():
+                self._image_bytes = base64.b64decode(encoded)
         except Exception as e:
             raise ValueError("Invalid base64 image format.") from e
-        return value
+        return self
+
+    @property
+    def image_bytes(self) -> bytes:
+        return self._image_bytes
+
+
+class Request(ImageInput):
+    pos_coord: List[List[float]] = Field(..., description="Array of positive coordinates for the segmentation points.")
+    format: MaskFormat = Field("png", description="Output format: PNG mask image, COCO RLE, contour polygons or bbox only.")
     
     @validator("pos_coord")
     def validate_coordinates(cls, value):
@@ -32,26 +57,124 @@ class Request(BaseModel):
         return value
 
 
+def _validate_base64_mask(value):
+    try:
+        # Check if the string starts with 'data:image/' and contains a valid base64 image
+        if not value.startswith(("data:image/png;base64,", "data:image/webp;base64,")):
+            raise ValueError("Masked image must start with 'data:image/png;base64,' or 'data:image/webp;base64,'.")
+        header, encoded = value.split(",", 1)
+        base64.b64decode(encoded)
+    except Exception as e:
+        raise ValueError("Invalid base64 mask format.") from e
+    return value
+
+
+class RLEMask(BaseModel):
+    size: List[int] = Field(..., description="[height, width] of the mask.")
+    counts: str = Field(..., description="COCO compressed run-length counts.")
+
+
 class Response(BaseModel):
-    mask: str = Field(..., description="Base64 encoded string of the masked image.")
+    mask: Optional[str] = Field(None, description="Base64 encoded string of the masked image, a PNG or WebP per MASK_IMAGE_FORMAT (format=png).")
+    rle: Optional[RLEMask] = Field(None, description="COCO run-length encoded mask (format=rle).")
+    polygons: Optional[List[List[int]]] = Field(None, description="Simplified outer contours as flat [x1, y1, x2, y2, ...] lists (format=polygon).")
+    bbox: Optional[List[int]] = Field(None, description="Bounding box of the mask as [x, y, width, height] (every format except png).")
+    area: Optional[int] = Field(None, description="Number of mask pixels (every format except png).")
+    score: Optional[float] = Field(None, description="Predicted IoU of the mask (sessions only).")
 
     @validator("mask")
     def validate_base64_mask(cls, value):
         """
         Validates that the `mask` is a valid base64 string with the appropriate prefix.
         """
-        try:
-            # Check if the string starts with 'data:image/' and contains a valid base64 image
-            if not value.startswith("data:image/png;base64,"):
-                raise ValueError("Masked image must start with 'data:image/png;base64,'.")
-            header, encoded = value.split(",", 1)
-            base64.b64decode(encoded)
-        except Exception as e:
-            raise ValueError("Invalid base64 mask format.") from e
+        if value is None:
+            return value
+        return _validate_base64_mask(value)
+
+    @classmethod
+    def from_image_bytes(cls, image_bytes: bytes, media_type: str = "image/png") -> "Response":
+        """
+        Builds a response from mask image bytes encoded by the server itself,
+        skipping the decode in `validate_base64_mask`.
+        """
+        with STAGE_SECONDS.labels("base64_encode").time():
+            mask = f"data:{media_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+        return cls.model_construct(mask=mask)
+
+
+class BatchRequest(ImageInput):
+    prompts: List[List[List[float]]] = Field(..., description="One list of positive coordinates per object to segment.")
+    format: MaskFormat = Field("png", description="Output format: PNG mask image, COCO RLE, contour polygons or bbox only.")
+
+    @validator("prompts")
+    def validate_prompts(cls, value):
+        """
+        Validates that there is at least one prompt group, that no group is
+        empty and that the number of groups stays within MAX_PROMPT_GROUPS.
+        """
+        if not value:
+            raise ValueError("prompts must contain at least one group of coordinates.")
+        if len(value) > MAX_PROMPT_GROUPS:
+            raise ValueError(f"prompts may contain at most {MAX_PROMPT_GROUPS} groups.")
+        if any(not group for group in value):
+            raise ValueError("Every prompt group must contain at least one coordinate.")
         return value
 
+
+class BatchResponse(BaseModel):
+    masks: Optional[List[str]] = Field(None, description="Base64 encoded masked images, one per prompt group, in request order (format=png).")
+    results: Optional[List[Response]] = Field(None, description="Compact masks, one per prompt group, in request order (every format except png).")
+
+    @validator("masks")
+    def validate_base64_masks(cls, value):
+        """
+        Validates that every mask is a valid base64 string with the appropriate prefix.
+        """
+        if value is None:
+            return value
+        return [_validate_base64_mask(mask) for mask in value]
+
+    @classmethod
+    def from_image_bytes(cls, image_bytes_list: List[bytes], media_type: str = "image/png") -> "BatchResponse":
+        """
+        Builds a response from mask image bytes encoded by the server itself,
+        skipping the decode in `validate_base64_masks`.
+        """
+        with STAGE_SECONDS.labels("base64_encode_batch").time():
+            masks = [f"data:{media_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}" for image_bytes in image_bytes_list]
+        return cls.model_construct(masks=masks)
+
+
+class SessionPrompt(BaseModel):
+    pos_coord: List[List[float]] = Field([], description="New positive [x, y] points, added to the ones sent before.")
+    neg_coord: List[List[float]] = Field([], description="New negative [x, y] points, added to the ones sent before.")
+    box: Optional[List[float]] = Field(None, description="Box as [x1, y1, x2, y2], replaces the previous box.")
+    reset: bool = Field(False, description="Drop the earlier points, box and mask before applying these.")
+    format: MaskFormat = Field("png", description="Output format: PNG mask image, COCO RLE, contour polygons or bbox only.")
+
+    @validator("box")
+    def validate_box(cls, value):
+        """
+        Validates that the box has four coordinates.
+        """
+        if value is not None and len(value) != 4:
+            raise ValueError("box must be [x1, y1, x2, y2].")
+        return value
+
+
+class SessionInfo(BaseModel):
+    session_id: str = Field(..., description="Id to send new prompts for this image to.")
+    original_size: List[int] = Field(..., description="[height, width] of the image.")
+    expires_in: float = Field(..., description="Seconds of inactivity after which the session is dropped.")
+
 class ImageRequest(BaseModel):
     input: Request
 
 class ImageResponse(BaseModel):
     output: Response
+
+class BatchImageRequest(BaseModel):
+    input: BatchRequest
+
+class BatchImageResponse(BaseModel):
+    output: BatchResponse
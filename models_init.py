@@ -1,18 +1,137 @@
-from segment_anything import build_sam, SamPredictor
-import torch.cuda
-import random
+from segment_anything import sam_model_registry, SamPredictor
+import numpy as np
+import torch
+import os
+import resource
+import time
+from config import (logger, SAM_MODEL_TYPE, SAM_CHECKPOINT, SAM_DEVICE, MAX_BATCH_SIZE, ENCODER_DTYPE, SDPA_ATTENTION,
+                    CHANNELS_LAST, TORCH_COMPILE, OPTIMIZATION_IOU_TOLERANCE, VALIDATE_OPTIMIZATIONS,
+                    STUB_ENCODER_LATENCY, STUB_ENCODER_IMAGE_LATENCY, STUB_DECODER_LATENCY)
+from checkpoints import load_state_dict
+from inference_opt import apply_optimizations
 
-if torch.cuda.is_available():
-    SUPIR_device = 'cuda:0'
-else:
-    raise ValueError('Currently support CUDA only.')
+# Normalisation constants build_sam passes to Sam, kept in non-persistent buffers
+PIXEL_MEAN = [123.675, 116.28, 103.53]
+PIXEL_STD = [58.395, 57.12, 57.375]
+
+def resolve_device(device):
+    if device == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device.startswith('cuda') and not torch.cuda.is_available():
+        raise ValueError(f"Device '{device}' was requested but CUDA is not available.")
+    return device
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _restore_non_persistent_buffers(sam):
+    # Not in the state dict, so still on the meta device after the assign-load
+    for name, values in (("pixel_mean", PIXEL_MEAN), ("pixel_std", PIXEL_STD)):
+        if getattr(sam, name).is_meta:
+            sam.register_buffer(name, torch.tensor(values).view(-1, 1, 1), False)
+    leftover = [name for name, tensor in list(sam.named_parameters()) + list(sam.named_buffers()) if tensor.is_meta]
+    if leftover:
+        raise RuntimeError(f"Checkpoint is missing weights for {', '.join(leftover[:5])}.")
+
+@torch.no_grad()
+def warm_up(model):
+    """Run one tiny image and prompt through the predictor so the first request does not pay for lazy init."""
+    model.set_image(np.zeros((64, 64, 3), dtype=np.uint8))
+    model.predict(point_coords=np.array([[32, 32]]), point_labels=np.array([1]), multimask_output=False)
+    model.reset_image()
+    if model.device.type == 'cuda':
+        torch.cuda.synchronize(model.device)
+
+def optimize(model):
+    """Apply the encoder execution modes from config, each validated against fp32 masks."""
+    return apply_optimizations(
+        model,
+        dtype=ENCODER_DTYPE,
+        channels_last=CHANNELS_LAST,
+        sdpa=SDPA_ATTENTION,
+        compile_mode=TORCH_COMPILE or None,
+        validate=VALIDATE_OPTIMIZATIONS,
+        iou_tolerance=OPTIMIZATION_IOU_TOLERANCE,
+        # Every batch size the scheduler can hand to encode_images
+        warmup_batch_sizes=range(1, MAX_BATCH_SIZE + 1),
+    )
+
+def initialize_models(model_type=SAM_MODEL_TYPE, checkpoint=SAM_CHECKPOINT, device=SAM_DEVICE, warmup=False,
+                      optimized=True):
+    if model_type == 'stub':
+        # Sleeps instead of encoding, for load tests of the serving path
+        from stub_predictor import stub_predictor
+        device = resolve_device(device)
+        logger.info(f"Using the stub SAM on {device}: {STUB_ENCODER_LATENCY}s + {STUB_ENCODER_IMAGE_LATENCY}s per image "
+                    f"per encoder pass, {STUB_DECODER_LATENCY}s per decoder call")
+        model = stub_predictor(device, STUB_ENCODER_LATENCY, STUB_ENCODER_IMAGE_LATENCY, STUB_DECODER_LATENCY)
+        if warmup:
+            warm_up(model)
+        return model
+
+    if model_type == 'tiny':
+        # Random-weight stand-in for benchmarks, no checkpoint needed
+        from stub_predictor import tiny_predictor
+        device = resolve_device(device)
+        logger.info(f"Using the tiny random-weight SAM on {device}")
+        model = tiny_predictor(device)
+        if optimized:
+            optimize(model)
+        if warmup:
+            warm_up(model)
+        return model
 
-def initialize_models():
     # Load SAM
-    SAM_CHECKPOINT = 'sam_vit_h_4b8939.pth'
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    assert SAM_CHECKPOINT, 'SAM_CHECKPOINT is not found!'
-    sam = build_sam(checkpoint=SAM_CHECKPOINT)
+    if model_type not in sam_model_registry:
+        raise ValueError(f"Unknown SAM model type '{model_type}', expected one of {sorted(sam_model_registry)}.")
+    if not checkpoint or not os.path.isfile(checkpoint):
+        raise FileNotFoundError(f"SAM checkpoint '{checkpoint}' is not found!")
+    device = resolve_device(device)
+
+    phases = {}
+    start_time = phase_start = time.perf_counter()
+
+    # Allocate nothing for the randomly initialised weights that the
+    # checkpoint overwrites anyway
+    with torch.device('meta'):
+        sam = sam_model_registry[model_type](checkpoint=None)
+    phases['build'] = time.perf_counter() - phase_start
+
+    phase_start = time.perf_counter()
+    # Memory mapped: pages are read as the weights are first used
+    state_dict = load_state_dict(checkpoint)
+    # An fp16 copy is only smaller on disk, the model still runs in fp32
+    state_dict = {k: v.float() if v.is_floating_point() and v.dtype != torch.float32 else v for k, v in state_dict.items()}
+    sam.load_state_dict(state_dict, assign=True)
+    _restore_non_persistent_buffers(sam)
+    phases['load'] = time.perf_counter() - phase_start
+
+    phase_start = time.perf_counter()
     sam.to(device=device)
+    sam.eval()
     model = SamPredictor(sam)
-    return model
\ No newline at end of file
+    phases['to_device'] = time.perf_counter() - phase_start
+
+    if optimized:
+        phase_start = time.perf_counter()
+        optimize(model)
+        phases['optimize'] = time.perf_counter() - phase_start
+
+    if warmup:
+        phase_start = time.perf_counter()
+        warm_up(model)
+        phases['warmup'] = time.perf_counter() - phase_start
+    load_time = time.perf_counter() - start_time
+
+    param_mb = sum(p.numel() * p.element_size() for p in sam.parameters()) / 2**20
+    if device.startswith('cuda'):
+        memory = f"{torch.cuda.memory_allocated(device) / 2**20:.0f} MB CUDA allocated"
+    else:
+        memory = f"{_peak_rss_mb():.0f} MB peak RSS"
+    logger.info(
+        f"Loaded SAM {model_type} from {checkpoint} on {device} in {load_time:.2f}s "
+        f"({', '.join(f'{name} {seconds:.2f}s' for name, seconds in phases.items())}; "
+        f"{param_mb:.0f} MB of parameters, {memory})"
+    )
+    return model
@@ -0,0 +1,132 @@
+# SAM prompt encoder + mask decoder exported to ONNX, for running the cheap
+# decoder half of SAM on CPU nodes against embeddings computed elsewhere.
+# Export once with:
+#   python onnx_decoder.py --model-type vit_h --checkpoint sam_vit_h_4b8939.pth --output sam_decoder.onnx
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from segment_anything.utils.transforms import ResizeLongestSide
+
+from config import logger, DEFAULT_CHECKPOINTS
+from metrics import timed
+
+# SAM pads every image to a square of this side before encoding
+IMAGE_SIZE = 1024
+
+
+def _single_mask_onnx_model(sam):
+    from segment_anything.utils.onnx import SamOnnxModel
+
+    class SingleMaskOnnxModel(SamOnnxModel):
+        """Always returns the single-mask output token, like `predict(multimask_output=False)`."""
+
+        def select_masks(self, masks, iou_preds, num_points):
+            return masks[:, :1], iou_preds[:, :1]
+
+        def mask_postprocessing(self, masks, orig_im_size):
+            # Same as upstream, but crops with index_select so the crop size
+            # stays a graph input: the tracer bakes int(tensor) slices into
+            # constants taken from the dummy export size.
+            masks = F.interpolate(masks, size=(self.img_size, self.img_size), mode="bilinear", align_corners=False)
+            prepadded_size = self.resize_longest_image_size(orig_im_size, self.img_size).to(torch.int64)
+            masks = masks.index_select(2, torch.arange(prepadded_size[0], device=masks.device))
+            masks = masks.index_select(3, torch.arange(prepadded_size[1], device=masks.device))
+            orig_im_size = orig_im_size.to(torch.int64)
+            h, w = orig_im_size[0], orig_im_size[1]
+            return F.interpolate(masks, size=(h, w), mode="bilinear", align_corners=False)
+
+    return SingleMaskOnnxModel(sam, return_single_mask=True)
+
+
+def export_decoder(sam, output_path, opset=17):
+    """Export the prompt encoder and mask decoder of `sam` to an ONNX file."""
+    onnx_model = _single_mask_onnx_model(sam)
+    embed_dim = sam.prompt_encoder.embed_dim
+    embed_size = sam.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+    dummy_inputs = {
+        "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=IMAGE_SIZE, size=(1, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+        "has_mask_input": torch.tensor([1], dtype=torch.float),
+        "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
+    }
+    torch.onnx.export(
+        onnx_model,
+        tuple(dummy_inputs.values()),
+        output_path,
+        export_params=True,
+        opset_version=opset,
+        do_constant_folding=True,
+        input_names=list(dummy_inputs.keys()),
+        output_names=["masks", "iou_predictions", "low_res_masks"],
+        dynamic_axes={
+            "point_coords": {1: "num_points"},
+            "point_labels": {1: "num_points"},
+        },
+        dynamo=False,
+    )
+    logger.info(f"Exported SAM decoder to {output_path}")
+
+
+class OnnxDecoder:
+    """Runs an exported SAM decoder with onnxruntime. `predict` is safe to call from several threads."""
+
+    def __init__(self, model_path, providers=("CPUExecutionProvider",)):
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(model_path, providers=list(providers))
+        self.transform = ResizeLongestSide(IMAGE_SIZE)
+        logger.info(f"Loaded ONNX SAM decoder from {model_path} with {self.session.get_providers()}")
+
+    @timed("onnx_predict")
+    def predict(self, embedding, coordinates, original_size):
+        """
+        Predict the mask for positive `coordinates` (Nx2, in original image
+        pixels) given an image embedding of shape 1xCxHxW. Returns an HxW
+        boolean mask at `original_size` (height, width).
+        """
+        # A padding point with label -1 stands in for the missing box prompt
+        point_coords = np.concatenate([coordinates, np.zeros((1, 2))], axis=0)[None, :, :]
+        point_labels = np.concatenate([np.ones(len(coordinates)), np.array([-1])])[None, :]
+        point_coords = self.transform.apply_coords(point_coords, original_size)
+
+        inputs = {
+            "image_embeddings": np.asarray(embedding, dtype=np.float32),
+            "point_coords": point_coords.astype(np.float32),
+            "point_labels": point_labels.astype(np.float32),
+            "mask_input": np.zeros((1, 1, 256, 256), dtype=np.float32),
+            "has_mask_input": np.zeros(1, dtype=np.float32),
+            "orig_im_size": np.array(original_size, dtype=np.float32),
+        }
+        masks, _, _ = self.session.run(None, inputs)
+        # Same threshold as Sam.mask_threshold
+        return masks[0, 0] > 0.0
+
+
+def main():
+    from models_init import initialize_models
+
+    parser = argparse.ArgumentParser(description="Export the SAM prompt encoder and mask decoder to ONNX.")
+    parser.add_argument("--model-type", default=None, help="sam_model_registry key, defaults to SAM_MODEL_TYPE.")
+    parser.add_argument("--checkpoint", default=None, help="SAM checkpoint, defaults to SAM_CHECKPOINT.")
+    parser.add_argument("--output", default="sam_decoder.onnx")
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    kwargs = {"device": "cpu"}
+    if args.model_type:
+        kwargs["model_type"] = args.model_type
+        kwargs["checkpoint"] = DEFAULT_CHECKPOINTS.get(args.model_type, "")
+    if args.checkpoint:
+        kwargs["checkpoint"] = args.checkpoint
+    # The decoder is exported as is, the encoder execution modes don't matter here
+    predictor = initialize_models(**kwargs, optimized=False)
+    export_decoder(predictor.model, args.output, opset=args.opset)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import PIPELINE_BUSY, PIPELINE_BUSY_SECONDS, PIPELINE_QUEUED, PIPELINE_WORKERS
+from scheduler import SchedulerBusy
+from tracing import profiled
+
+# The request path runs in three stages, each with its own threads, so the
+# model never waits on image decoding or PNG encoding:
+#   pre:   image decode (or embedding store lookup), on a Stage below
+#   model: encoder and mask decoder, batched by the MicroBatchScheduler
+#   post:  mask rendering and PNG / compact encoding, on a Stage below
+# While request N is in the model, N+1 is decoded and N-1 encoded.
+
+
+class StageStats:
+    """Busy time and occupancy of a stage with `workers` slots running in parallel."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.processed = 0
+        self.busy_seconds = 0.0
+        # Workers running right now
+        self.busy = 0
+        self.started = time.perf_counter()
+        self._busy = PIPELINE_BUSY.labels(name)
+        self._busy_seconds = PIPELINE_BUSY_SECONDS.labels(name)
+        self._lock = threading.Lock()
+        PIPELINE_WORKERS.labels(name).set(workers)
+
+    def call(self, function, *args):
+        """
+        Run `function(*args)` on the calling thread, counted as busy time of
+        the stage, and profiled if the request it runs for is.
+        """
+        start_time = time.perf_counter()
+        with self._lock:
+            self.busy += 1
+        try:
+            with self._busy.track_inprogress():
+                return profiled(self.name, function, *args)
+        finally:
+            with self._lock:
+                self.busy -= 1
+            self.add(time.perf_counter() - start_time)
+
+    def add(self, seconds):
+        """Count one item that kept a worker busy for `seconds`, e.g. timed in another process."""
+        self._busy_seconds.inc(seconds)
+        with self._lock:
+            self.processed += 1
+            self.busy_seconds += seconds
+
+    def stats(self, queued) -> dict:
+        uptime = time.perf_counter() - self.started
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "busy": self.busy,
+                "queued": queued,
+                "processed": self.processed,
+                "busy_seconds": round(self.busy_seconds, 3),
+                # Share of the worker time since startup spent working
+                "occupancy": round(self.busy_seconds / (self.workers * uptime), 4) if uptime > 0 else 0.0,
+            }
+
+
+class Stage:
+    """
+    A CPU stage of the request path: `workers` threads and room for
+    `queue_size` more requests waiting for one. `run` waits up to
+    `put_timeout` seconds for room, then raises SchedulerBusy, so a slow
+    stage pushes back on the stages before it instead of piling up work.
+    """
+
+    def __init__(self, name, workers, queue_size, put_timeout=5.0):
+        self.name = name
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-stage")
+        self.stats = StageStats(name, workers)
+        # One slot per request running or waiting in the stage
+        self._slots = asyncio.Semaphore(workers + queue_size)
+        self._admitted = 0
+        PIPELINE_QUEUED.labels(name).set_function(self.queue_depth)
+
+    def queue_depth(self) -> int:
+        return max(0, self._admitted - self.stats.busy)
+
+    async def run(self, function, *args):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            raise SchedulerBusy(f"The {self.name} stage is full.", retry_after=1)
+        loop = asyncio.get_running_loop()
+        self._admitted += 1
+
+        def release(_):
+            loop.call_soon_threadsafe(self._release)
+
+        # With the request ID and profile of the caller
+        context = contextvars.copy_context()
+        future = self.executor.submit(context.run, self.stats.call, function, *args)
+        # The slot is held until the work is done, even if the caller gives up
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self):
+        self._admitted -= 1
+        self._slots.release()
+
+    def report(self) -> dict:
+        return {**self.stats.stats(self.queue_depth()), "queue_size": self.queue_size}
@@ -0,0 +1,172 @@
+# Model side of the server: the predictor, its embedding cache and store, and
+# the calls that run on it. It runs in every replica process of the worker
+# pool (see worker_pool.py), or in the server process itself without one.
+# Replicas import this module instead of endpoint, so importing it must not
+# build anything only the server needs: no executors, stages, response cache
+# or worker pool.
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from config import logger, SAM_DEVICE, SAM_MODEL_TYPE, SAM_CHECKPOINT, EMBEDDING_CACHE_MAX_BYTES, EMBEDDING_STORE_PATH, DOWNSCALE_ON_DECODE
+from embedding_cache import EmbeddingCache, restore_embedding, embedding_to_bytes, embedding_from_bytes
+from embedding_store import EmbeddingStore, store_settings
+from mask_formats import COMPACT_FORMATS, encode_mask, merge_masks
+from models_init import initialize_models
+from segment_everything import decode_point_batch
+from utils import original_size_for, encode_mask_image, encode_images, predict_masks, predict_prompt_groups, predict_refined_mask
+from worker_pool import SharedArray
+
+# Loaded by `load`: in the background once the server is up, or at replica start
+model = None
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MAX_BYTES)
+# Precomputed embeddings, memory-mapped by every replica
+embedding_store = EmbeddingStore(
+    EMBEDDING_STORE_PATH, store_settings(SAM_MODEL_TYPE, SAM_CHECKPOINT, DOWNSCALE_ON_DECODE),
+) if EMBEDDING_STORE_PATH else None
+
+
+def load(device=SAM_DEVICE):
+    """Load and warm up the predictor on `device`. Returns what the server needs to know about it."""
+    global model
+    model = initialize_models(device=device, warmup=True)
+    return {"target_length": model.transform.target_length}
+
+
+@dataclass
+class SegmentJob:
+    """A decoded-transport request: raw image bytes plus parsed prompts."""
+    image_bytes: bytes
+    # Nx2 array for a single mask, list of Nx2 arrays for a batch request
+    prompts: Any
+    batch: bool = False
+    # "embedding" returns the serialized image embedding instead of a mask
+    output_format: str = "png"
+    # The decoded HWC image, set by the server's prepare_job (a SharedArray
+    # when the job runs on a replica), with the (width, height) of the original
+    image: Any = None
+    size: Any = None
+    # Hash of image_bytes, once found in the embedding store
+    key: Optional[str] = None
+
+
+@dataclass
+class EverythingJob:
+    """One batch of grid points of /segment_everything/, for the decoder only."""
+    # (embedding bytes, shape, original size) of the crop the points are in
+    embedding: Any
+    points: Any
+    crop_box: Any
+    image_size: Any
+    options: Any
+
+
+def encode_output(mask, output_format):
+    """Mask image bytes (MASK_IMAGE_FORMAT) or compact encoding of one HxW boolean mask."""
+    if output_format in COMPACT_FORMATS:
+        return encode_mask(mask, output_format)
+    height, width = mask.shape
+    return encode_mask_image(mask[None], (width, height))
+
+
+def segment_requests(jobs):
+    """
+    Model stage, the batch handler of the scheduler, for jobs the server has
+    prepared. Runs the image encoder once over all images of the batch, then
+    decodes the prompts of each job against its own embedding; images in the
+    embedding store skip the encoder. Returns, per job and in order, its mask
+    as an HxW boolean array (a list of them for batch jobs), or the embedding
+    bytes with their shape and original size, or an exception. An
+    `EverythingJob` only runs the decoder and gets its mask records.
+    """
+    results = [None] * len(jobs)
+    # (index, embedding) of the jobs ready for the decoder
+    ready = []
+
+    decoded = []
+    for i, job in enumerate(jobs):
+        try:
+            logger.info(f"Request {i + 1}/{len(jobs)} of batch received at {time.time()}")
+            if isinstance(job, EverythingJob):
+                results[i] = everything_batch(*job.embedding, job.points, job.crop_box, job.image_size, job.options)
+                continue
+            if job.key is not None:
+                features, shape, original_size = embedding_store.lookup(job.key)
+                if job.output_format == "embedding":
+                    results[i] = features.tobytes(), shape, original_size
+                else:
+                    ready.append((i, embedding_from_bytes(features, shape, original_size, model.transform.target_length, model.device)))
+                continue
+            image = job.image.read() if isinstance(job.image, SharedArray) else job.image
+            decoded.append((i, image, job.size))
+        except Exception as e:
+            results[i] = e
+
+    if decoded:
+        # One encoder pass over the stacked batch of images
+        images = [image for _, image, _ in decoded]
+        original_sizes = [original_size_for(image, size) for _, image, size in decoded]
+        try:
+            embeddings = encode_images(model, images, embedding_cache, original_sizes)
+        except Exception:
+            # One bad image fails the stacked pass; encode them one by one so
+            # only its own job fails
+            embeddings = [_encode_alone(image, size) for image, size in zip(images, original_sizes)]
+        for (i, _, _), embedding in zip(decoded, embeddings):
+            if isinstance(embedding, BaseException):
+                results[i] = embedding
+            else:
+                ready.append((i, embedding))
+
+    for i, embedding in ready:
+        job = jobs[i]
+        try:
+            if job.output_format == "embedding":
+                results[i] = embedding_to_bytes(embedding), tuple(embedding.features.shape), embedding.original_size
+                continue
+            restore_embedding(model, embedding)
+            if job.batch:
+                results[i] = [merge_masks(masks) for masks in predict_prompt_groups(model, job.prompts)]
+            else:
+                results[i] = merge_masks(predict_masks(model, job.prompts))
+        except Exception as e:
+            results[i] = e
+
+    return results
+
+
+def _encode_alone(image, original_size):
+    try:
+        return encode_images(model, [image], embedding_cache, [original_size])[0]
+    except Exception as e:
+        return e
+
+
+def decode_embedding(embedding_bytes, shape, original_size, pos_coord, output_format):
+    """Run only the prompt encoder and mask decoder of the model against a client-supplied embedding."""
+    entry = embedding_from_bytes(embedding_bytes, shape, original_size, model.transform.target_length, model.device)
+    restore_embedding(model, entry)
+    return encode_output(merge_masks(predict_masks(model, pos_coord)), output_format)
+
+
+def refine_session_mask(embedding_bytes, shape, original_size, point_coords, point_labels, box, mask_input, output_format):
+    """Decoder-only prediction for an interactive session, refined from the logits of its last prediction."""
+    entry = embedding_from_bytes(embedding_bytes, shape, original_size, model.transform.target_length, model.device)
+    restore_embedding(model, entry)
+    has_points = len(point_coords) > 0
+    mask, score, logits = predict_refined_mask(
+        model,
+        point_coords if has_points else None,
+        point_labels if has_points else None,
+        box,
+        mask_input,
+    )
+    return encode_output(mask, output_format), score, logits
+
+
+def everything_batch(embedding_bytes, shape, crop_size, points, crop_box, image_size, options):
+    """One batch of grid points of /segment_everything/ against the embedding of its crop."""
+    entry = embedding_from_bytes(embedding_bytes, shape, crop_size, model.transform.target_length, model.device)
+    restore_embedding(model, entry)
+    return decode_point_batch(model, points, crop_box, image_size, options)
@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from config import logger
+
+
+def response_key(image_bytes: bytes, prompts, *options) -> str:
+    """
+    Cache key of a request: a hash of its image file bytes, its prompts
+    (an Nx2 array, a list of them or None) as float32 and its output options.
+    The bytes are hashed as uploaded, before decoding, so the same picture
+    re-encoded (or with other metadata) is a different key; hashing the
+    decoded pixels would cost a decode on every cache hit.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(image_bytes)
+    if prompts is not None:
+        for group in prompts if isinstance(prompts, list) else [prompts]:
+            group = np.ascontiguousarray(group, dtype=np.float32)
+            h.update(repr(group.shape).encode("utf-8"))
+            h.update(group.tobytes())
+    h.update(repr(options).encode("utf-8"))
+    return h.hexdigest()
+
+
+def file_fingerprint(path) -> tuple:
+    """(path, size, mtime) of a file such as a checkpoint, so a key changes when it is replaced."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (path,)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+def size_of(value) -> int:
+    """Rough size in bytes of a response (bytes, str, arrays and dicts or lists of them), without serializing it."""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(size_of(k) + size_of(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(size_of(item) for item in value)
+    return 8
+
+
+class ResponseCache:
+    """
+    Finished responses by request key: an LRU in memory bounded by
+    `max_bytes` (as counted by `size_of`) and, with `disk_dir` set, a directory of
+    pickled responses bounded by `disk_max_bytes` that survives restarts.
+    Entries in both expire `ttl` seconds after they were stored. Blocking:
+    call it off the event loop when the disk tier is on.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, disk_dir: str = "", disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        # key -> (expiry time, size, response)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        # key -> size of the files on disk, oldest first
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if disk_dir:
+            self._scan_disk()
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def _scan_disk(self):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".pkl"):
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                files.append((stat.st_mtime, name[:-len(".pkl")], stat.st_size))
+        for _, key, size in sorted(files):
+            self._files[key] = size
+            self._disk_bytes += size
+        logger.info(f"Response cache has {len(self._files)} entries ({self._disk_bytes} bytes) in {self.disk_dir}")
+
+    def _drop_file(self, key):
+        self._disk_bytes -= self._files.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _remember(self, key, value, size, expires_at):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._entries[key] = (expires_at, size, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _read_file(self, key, now):
+        path = self._path(key)
+        try:
+            expires_at = os.stat(path).st_mtime + self.ttl
+            if expires_at <= time.time():
+                self._drop_file(key)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # Removed from outside, its size no longer counts against the budget
+            self._drop_file(key)
+            return None
+        value = pickle.loads(data)
+        # Back in memory for the rest of its lifetime
+        size = size_of(value)
+        if size <= self.max_bytes:
+            self._remember(key, value, size, now + (expires_at - time.time()))
+        return value
+
+    def get(self, key: str):
+        """The cached response for `key`, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                self._entries.pop(key)
+                self._bytes -= entry[1]
+            if key in self._files:
+                value = self._read_file(key, now)
+                if value is not None:
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value) -> None:
+        size = size_of(value)
+        # Only pickled for the disk tier
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL) if self.disk_dir else None
+        with self._lock:
+            if size <= self.max_bytes:
+                self._remember(key, value, size, time.monotonic() + self.ttl)
+            if data is None or len(data) > self.disk_max_bytes:
+                return
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            self._disk_bytes -= self._files.pop(key, 0)
+            self._files[key] = len(data)
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self.disk_max_bytes:
+                self._drop_file(next(iter(self._files)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_entries": len(self._files),
+                "disk_bytes": self._disk_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first one runs,
+    the others wait for its result (or exception) instead of running again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def run(self, key, function, deadline=None, retry=lambda e: False):
+        """
+        `await function()` unless a call with `key` is already running, then
+        wait for that one until `deadline` (a time.perf_counter() time,
+        asyncio.TimeoutError after). If that call is cancelled, or fails with
+        an exception for which `retry` is true (say its client went away, or
+        it ran out of its own deadline), try again while `deadline` has not
+        passed.
+        """
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                return await self._lead(key, function)
+            self.coalesced += 1
+            timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.CancelledError:
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+            except Exception as e:
+                # A timeout of our own wait leaves the call running
+                if not future.done() or not retry(e):
+                    raise
+                if deadline is not None and time.perf_counter() >= deadline:
+                    raise
+
+    async def _lead(self, key, function):
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting for the outcome
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
@@ -0,0 +1,270 @@
+import asyncio
+import contextvars
+import math
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from config import logger
+from metrics import BATCH_SIZE, DROPPED, ERRORS, IN_FLIGHT, QUEUE_WAIT_SECONDS, track
+from tracing import bind_batch, run_in_executor
+
+# Priority lanes, drained in this order
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+
+
+class SchedulerBusy(Exception):
+    """
+    Raised by `submit` when the queue stays full for longer than the put
+    timeout, or when the request could not be served before its deadline.
+    `retry_after` is the estimated number of seconds until there is room.
+    """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised by `submit` when a request's deadline passes before its result is ready."""
+
+
+@dataclass(eq=False)
+class _Entry:
+    request_id: Any
+    request: Any
+    future: asyncio.Future
+    enqueued_at: float
+    # time.perf_counter() value after which the result is no use to anyone
+    deadline: Optional[float] = None
+    priority: str = INTERACTIVE
+    # Request ID and profile of the caller, for the batch it ends up in
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+
+
+class MicroBatchScheduler:
+    """
+    Collects queued requests into micro-batches and runs them on an executor.
+
+    A batch is dispatched as soon as `max_batch_size` requests are waiting, or
+    `max_wait_ms` after the first request of the batch arrived, whichever comes
+    first. `batch_handler` receives the list of requests and must return a list
+    of the same length holding either a result or an exception per request;
+    results are fanned back out to the future of each request. Up to
+    `concurrency` batches run at a time: 1 for a model in this process, which
+    is not thread safe, one per replica with a worker pool.
+
+    Interactive requests are always batched ahead of bulk ones, and the last
+    `interactive_reserve` queue slots are only open to interactive requests.
+    Requests whose caller went away or whose deadline passed are dropped
+    before they reach the executor.
+    """
+
+    # Weight of the newest batch in the service time average
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, batch_handler, executor, max_batch_size=1, max_wait_ms=0.0, queue_size=3, put_timeout=5.0,
+                 interactive_reserve=0, concurrency=1):
+        self.batch_handler = batch_handler
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout
+        self.interactive_reserve = min(interactive_reserve, queue_size - 1)
+        self.concurrency = concurrency
+        self._lanes = {priority: deque() for priority in PRIORITIES}
+        # Smoothed seconds of model time per request, None until the first batch
+        self._service_time = None
+        self._cond = None
+        self._task = None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def service_time(self) -> Optional[float]:
+        """Smoothed model time per request in seconds, None before the first batch."""
+        return self._service_time
+
+    def estimated_wait(self, ahead=None) -> float:
+        """Seconds until a request behind `ahead` queued requests (default: all of them) is served."""
+        if ahead is None:
+            ahead = self.queue_depth
+        # Batches in parallel serve `concurrency` requests per service time
+        return (ahead + 1) * (self._service_time or 0.0) / self.concurrency
+
+    def retry_after(self) -> int:
+        """Whole seconds a rejected client should wait before trying again."""
+        return max(1, math.ceil(self.estimated_wait()))
+
+    def start(self):
+        """Start the dispatch loop on the running event loop."""
+        self._cond = asyncio.Condition()
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _has_room(self, priority):
+        capacity = self.queue_size if priority == INTERACTIVE else self.queue_size - self.interactive_reserve
+        return self.queue_depth < capacity
+
+    async def submit(self, request_id, request, deadline=None, priority=INTERACTIVE):
+        """
+        Queue `request` and wait for its result. `deadline` is a
+        time.perf_counter() value; work not started by then is dropped and
+        the caller gets DeadlineExceeded. Cancelling the caller drops the
+        request too, if it has not reached the executor yet.
+        """
+        if priority not in self._lanes:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {PRIORITIES}.")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        put_timeout = self.put_timeout
+        if deadline is not None:
+            remaining = deadline - time.perf_counter()
+            # Queued behind everything of the same or higher priority
+            ahead = len(self._lanes[INTERACTIVE]) if priority == INTERACTIVE else self.queue_depth
+            if remaining <= 0 or self.estimated_wait(ahead) > remaining:
+                DROPPED.labels("admission").inc()
+                raise SchedulerBusy("Request cannot be served before its deadline.", self.retry_after())
+            put_timeout = min(put_timeout, remaining)
+
+        async with self._cond:
+            try:
+                await asyncio.wait_for(self._cond.wait_for(lambda: self._has_room(priority)), timeout=put_timeout)
+            except asyncio.TimeoutError:
+                raise SchedulerBusy(f"Queue is full ({self.queue_size} pending requests).", self.retry_after())
+            entry = _Entry(request_id, request, future, time.perf_counter(), deadline, priority)
+            self._lanes[priority].append(entry)
+            self._cond.notify_all()
+
+        try:
+            if deadline is None:
+                return await future
+            return await asyncio.wait_for(future, timeout=max(0.0, deadline - time.perf_counter()))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(f"Request {request_id} was not served before its deadline.")
+        finally:
+            if future.cancelled():
+                self._discard(entry)
+
+    def _discard(self, entry):
+        """Free the queue slot of a request whose caller gave up, if it is still queued."""
+        try:
+            self._lanes[entry.priority].remove(entry)
+        except ValueError:
+            # Already taken for a batch
+            return
+        expired = entry.deadline is not None and entry.deadline <= time.perf_counter()
+        DROPPED.labels("expired" if expired else "cancelled").inc()
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def _pop_live(self):
+        """Next request to run, interactive first, dropping abandoned and expired ones on the way."""
+        now = time.perf_counter()
+        for priority in PRIORITIES:
+            lane = self._lanes[priority]
+            while lane:
+                entry = lane.popleft()
+                expired = entry.deadline is not None and entry.deadline <= now
+                if entry.future.done():
+                    # The caller disconnected or gave up at its deadline while queued
+                    DROPPED.labels("expired" if expired else "cancelled").inc()
+                    continue
+                if expired:
+                    DROPPED.labels("expired").inc()
+                    entry.future.set_exception(DeadlineExceeded(f"Request {entry.request_id} expired in the queue."))
+                    continue
+                return entry
+        return None
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        async with self._cond:
+            batch = []
+            while not batch:
+                await self._cond.wait_for(lambda: self.queue_depth > 0)
+                deadline = loop.time() + self.max_wait
+                while self.queue_depth < self.max_batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                while len(batch) < self.max_batch_size:
+                    entry = self._pop_live()
+                    if entry is None:
+                        break
+                    batch.append(entry)
+                # Wake up submitters waiting for a free slot
+                self._cond.notify_all()
+            dispatch_time = time.perf_counter()
+            for entry in batch:
+                QUEUE_WAIT_SECONDS.observe(dispatch_time - entry.enqueued_at)
+            BATCH_SIZE.observe(len(batch))
+        return batch
+
+    def _record_service_time(self, seconds, batch_size):
+        per_request = seconds / batch_size
+        if self._service_time is None:
+            self._service_time = per_request
+        else:
+            self._service_time += self.EWMA_ALPHA * (per_request - self._service_time)
+
+    async def _dispatch(self, batch):
+        # Logged, run and profiled as the requests in the batch
+        bind_batch([entry.context for entry in batch])
+        requests = [entry.request for entry in batch]
+        start_time = time.time()
+        try:
+            with track(IN_FLIGHT, len(batch)):
+                results = await run_in_executor(self.executor, self.batch_handler, requests)
+        except Exception as e:
+            results = [e] * len(batch)
+        elapsed = time.time() - start_time
+        self._record_service_time(elapsed, len(batch))
+        logger.info(f"Processed batch of {len(batch)} in {elapsed:.3f}s")
+
+        for entry, result in zip(batch, results):
+            if isinstance(result, BaseException):
+                ERRORS.labels(type(result).__name__).inc()
+            if entry.future.done():
+                # The caller went away while the batch was running
+                continue
+            if isinstance(result, BaseException):
+                entry.future.set_exception(result)
+            else:
+                entry.future.set_result(result)
+
+    async def run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        # The loop only keeps weak references to tasks
+        running = set()
+        while True:
+            # Wait for a free slot first, so requests keep piling up into the
+            # next batch while every slot is busy
+            await slots.acquire()
+            batch = await self._next_batch()
+            task = asyncio.create_task(self._dispatch(batch))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
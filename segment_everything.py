@@ -0,0 +1,176 @@
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.utils.amg import (
+    MaskData,
+    area_from_rle,
+    batch_iterator,
+    batched_mask_to_box,
+    box_xyxy_to_xywh,
+    build_all_layer_point_grids,
+    calculate_stability_score,
+    coco_encode_rle,
+    generate_crop_boxes,
+    is_box_near_crop_edge,
+    mask_to_rle_pytorch,
+    uncrop_boxes_xyxy,
+    uncrop_masks,
+    uncrop_points,
+)
+from torchvision.ops.boxes import batched_nms, box_iou
+
+from metrics import timed
+
+# "Segment everything" with segment_anything's automatic mask generator, cut
+# into one call per batch of grid points so masks can be sent to the client as
+# soon as their batch is decoded. SamAutomaticMaskGenerator.generate removes
+# duplicates once at the end, ranked by score; here each batch is deduplicated
+# on its own and then against the masks already sent, in arrival order.
+# Only public pieces of segment_anything are used (SamPredictor.predict_torch,
+# the utils.amg helpers and the static postprocess_small_regions); the
+# filtering below follows SamAutomaticMaskGenerator._process_batch of the
+# commit pinned in requirements.txt.
+
+# Offset of the mask threshold for the stability score, the generator's default
+STABILITY_SCORE_OFFSET = 1.0
+
+
+@dataclass
+class EverythingOptions:
+    """The SamAutomaticMaskGenerator settings exposed by the endpoint, with its defaults."""
+    points_per_side: int = 32
+    points_per_batch: int = 64
+    pred_iou_thresh: float = 0.88
+    stability_score_thresh: float = 0.95
+    box_nms_thresh: float = 0.7
+    crop_n_layers: int = 0
+    crop_nms_thresh: float = 0.7
+    crop_overlap_ratio: float = 512 / 1500
+    crop_n_points_downscale_factor: int = 1
+    min_mask_region_area: int = 0
+
+
+def plan_crops(options: EverythingOptions, image_size):
+    """
+    (crop box, point batches) for every crop of an image of (height, width)
+    `image_size`, the whole image first. Crop boxes are XYXY, points are in
+    crop pixels.
+    """
+    crop_boxes, layer_idxs = generate_crop_boxes(tuple(image_size), options.crop_n_layers, options.crop_overlap_ratio)
+    point_grids = build_all_layer_point_grids(
+        options.points_per_side, options.crop_n_layers, options.crop_n_points_downscale_factor
+    )
+    for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
+        x0, y0, x1, y1 = crop_box
+        points = point_grids[layer_idx] * np.array([[x1 - x0, y1 - y0]])
+        yield crop_box, [batch for (batch,) in batch_iterator(options.points_per_batch, points)]
+
+
+def predict_points(sam_predictor, points, crop_size, crop_box, image_size, options: EverythingOptions) -> MaskData:
+    """
+    Three masks per point of the crop whose embedding is set on the
+    predictor, kept if confident and stable enough and not cut by the crop
+    edge, as RLEs in full image coordinates.
+    """
+    image_height, image_width = image_size
+    mask_threshold = sam_predictor.model.mask_threshold
+    in_points = torch.as_tensor(sam_predictor.transform.apply_coords(points, crop_size), device=sam_predictor.device)
+    in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
+    masks, iou_preds, _ = sam_predictor.predict_torch(
+        in_points[:, None, :], in_labels[:, None], multimask_output=True, return_logits=True
+    )
+    data = MaskData(
+        masks=masks.flatten(0, 1),
+        iou_preds=iou_preds.flatten(0, 1),
+        points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
+    )
+    del masks
+
+    if options.pred_iou_thresh > 0.0:
+        data.filter(data["iou_preds"] > options.pred_iou_thresh)
+    data["stability_score"] = calculate_stability_score(data["masks"], mask_threshold, STABILITY_SCORE_OFFSET)
+    if options.stability_score_thresh > 0.0:
+        data.filter(data["stability_score"] >= options.stability_score_thresh)
+
+    data["masks"] = data["masks"] > mask_threshold
+    data["boxes"] = batched_mask_to_box(data["masks"])
+    keep = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, image_width, image_height])
+    if not torch.all(keep):
+        data.filter(keep)
+
+    data["masks"] = uncrop_masks(data["masks"], crop_box, image_height, image_width)
+    data["rles"] = mask_to_rle_pytorch(data["masks"])
+    del data["masks"]
+    return data
+
+
+@timed("everything_batch")
+@torch.no_grad()
+def decode_point_batch(sam_predictor, points, crop_box, image_size, options: EverythingOptions):
+    """
+    Masks for one batch of grid points on the crop whose embedding is set on
+    the predictor, filtered and deduplicated like the automatic mask
+    generator does. Returns JSON-ready records with the mask as COCO RLE in
+    full image coordinates.
+    """
+    x0, y0, x1, y1 = crop_box
+    data = predict_points(sam_predictor, np.asarray(points), (y1 - y0, x1 - x0), list(crop_box), tuple(image_size), options)
+    if len(data["rles"]) == 0:
+        return []
+
+    keep = batched_nms(
+        data["boxes"].float(),
+        data["iou_preds"],
+        torch.zeros(len(data["boxes"])),
+        iou_threshold=options.box_nms_thresh,
+    )
+    data.filter(keep)
+    data["boxes"] = uncrop_boxes_xyxy(data["boxes"], list(crop_box))
+    data["points"] = uncrop_points(data["points"], list(crop_box))
+    if options.min_mask_region_area > 0:
+        data = SamAutomaticMaskGenerator.postprocess_small_regions(
+            data, options.min_mask_region_area, max(options.box_nms_thresh, options.crop_nms_thresh)
+        )
+    data.to_numpy()
+
+    crop_xywh = box_xyxy_to_xywh(torch.as_tensor(crop_box)).tolist()
+    records = []
+    for i, rle in enumerate(data["rles"]):
+        records.append({
+            "rle": coco_encode_rle(rle),
+            "bbox": [int(v) for v in box_xyxy_to_xywh(torch.as_tensor(data["boxes"][i])).tolist()],
+            "area": int(area_from_rle(rle)),
+            "predicted_iou": float(data["iou_preds"][i]),
+            "stability_score": float(data["stability_score"][i]),
+            "point_coords": [data["points"][i].tolist()],
+            "crop_box": crop_xywh,
+        })
+    return records
+
+
+class MaskDeduplicator:
+    """
+    Drops masks whose box overlaps one already sent by more than the NMS
+    threshold: `box_nms_thresh` within a crop, `crop_nms_thresh` across crops.
+    """
+
+    def __init__(self, box_nms_thresh, crop_nms_thresh):
+        self.box_nms_thresh = box_nms_thresh
+        self.crop_nms_thresh = crop_nms_thresh
+        self._boxes = torch.zeros((0, 4))
+        self._crops = torch.zeros(0, dtype=torch.long)
+
+    def filter(self, records, crop_index):
+        if not records:
+            return records
+        boxes = torch.tensor([[x, y, x + w, y + h] for x, y, w, h in (r["bbox"] for r in records)], dtype=torch.float32)
+        if len(self._boxes):
+            thresholds = torch.where(self._crops == crop_index, self.box_nms_thresh, self.crop_nms_thresh)
+            keep = ~(box_iou(boxes, self._boxes) > thresholds[None, :]).any(dim=1)
+            records = [record for record, kept in zip(records, keep.tolist()) if kept]
+            boxes = boxes[keep]
+        self._boxes = torch.cat([self._boxes, boxes])
+        self._crops = torch.cat([self._crops, torch.full((len(boxes),), crop_index, dtype=torch.long)])
+        return records
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+import numpy as np
+
+from config import logger
+
+
+@dataclass(eq=False)
+class Session:
+    """
+    One image being segmented click by click: its fp16 embedding as returned
+    by /embedding/, the prompts so far and the low-res logits of the last
+    prediction, which the next one is refined from.
+    """
+    session_id: str
+    embedding: bytes
+    shape: Tuple[int, ...]
+    original_size: Tuple[int, int]
+    point_coords: np.ndarray = field(default_factory=lambda: np.zeros((0, 2), dtype=np.float32))
+    point_labels: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int64))
+    box: Optional[np.ndarray] = None
+    # 1x256x256 float32, None until the first prediction
+    logits: Optional[np.ndarray] = None
+    last_used: float = field(default_factory=time.monotonic)
+    # One prediction at a time, each builds on the previous one
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @property
+    def nbytes(self) -> int:
+        logits = self.logits.nbytes if self.logits is not None else 0
+        return len(self.embedding) + logits + self.point_coords.nbytes
+
+    def prompts_with(self, point_coords, point_labels, box=None, reset=False):
+        """
+        Points, labels, box and previous logits for a prediction with these
+        new prompts, without changing the session; see `update`.
+        """
+        if reset:
+            coords, labels, previous_box, logits = np.zeros((0, 2), dtype=np.float32), np.zeros(0, dtype=np.int64), None, None
+        else:
+            coords, labels, previous_box, logits = self.point_coords, self.point_labels, self.box, self.logits
+        if len(point_coords):
+            coords = np.concatenate([coords, point_coords]).astype(np.float32)
+            labels = np.concatenate([labels, point_labels]).astype(np.int64)
+        box = np.asarray(box, dtype=np.float32) if box is not None else previous_box
+        return coords, labels, box, logits
+
+    def update(self, point_coords, point_labels, box, logits):
+        """Keep the prompts and logits of a successful prediction."""
+        self.point_coords, self.point_labels, self.box, self.logits = point_coords, point_labels, box, logits
+
+
+class SessionStore:
+    """
+    Interactive sessions by id. A session expires `ttl` seconds after it was
+    last used; beyond `max_bytes` of embeddings and logits the least recently
+    used sessions are evicted.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def _bytes(self) -> int:
+        return sum(session.nbytes for session in self._sessions.values())
+
+    def _expire(self, now):
+        # Ordered by last use, so the expired ones are at the front
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.expired += 1
+
+    def _evict(self):
+        total = self._bytes()
+        while total > self.max_bytes and len(self._sessions) > 1:
+            _, session = self._sessions.popitem(last=False)
+            total -= session.nbytes
+            self.evictions += 1
+            logger.info(f"Evicted session {session.session_id} to stay within {self.max_bytes} bytes")
+
+    def create(self, embedding, shape, original_size) -> Session:
+        session = Session(uuid.uuid4().hex, embedding, tuple(shape), tuple(original_size))
+        with self._lock:
+            self._expire(time.monotonic())
+            self._sessions[session.session_id] = session
+            self.created += 1
+            self._evict()
+        return session
+
+    def get(self, session_id) -> Optional[Session]:
+        """The session, marked as used, or None if it is unknown or expired."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session.last_used = now
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def trim(self):
+        """Evict down to `max_bytes` again after a session grew, e.g. by its first logits."""
+        with self._lock:
+            self._evict()
+
+    def delete(self, session_id) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._bytes(),
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "created": self.created,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,108 @@
+import time
+from functools import partial
+
+import torch
+from segment_anything import SamPredictor
+from segment_anything.modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
+
+# Stand-in SAM for benchmarks and local testing without a checkpoint: the real
+# architecture and pre/post-processing (1024 px input, 64x64x256 embeddings,
+# full-resolution mask upsampling) with a two-block, 64-wide image encoder and
+# random weights. Masks are meaningless, but every CPU-side stage does the same
+# amount of work as with vit_h.
+#
+# The "stub" model goes further for load tests (see load_test.py): its image
+# encoder and mask decoder compute nothing and sleep for a configured latency
+# instead, so the server behaves like it would with a GPU model of that speed
+# while the pre- and post-processing around the model stay real.
+
+def build_tiny_sam(seed=0):
+    """Randomly initialised SAM with a tiny image encoder, deterministic for a given seed."""
+    generator_state = torch.random.get_rng_state()
+    torch.manual_seed(seed)
+    try:
+        sam = Sam(
+            image_encoder=ImageEncoderViT(
+                depth=2,
+                embed_dim=64,
+                img_size=1024,
+                mlp_ratio=2,
+                norm_layer=partial(torch.nn.LayerNorm, eps=1e-6),
+                num_heads=2,
+                patch_size=16,
+                qkv_bias=True,
+                use_rel_pos=True,
+                global_attn_indexes=[1],
+                window_size=14,
+                out_chans=256,
+            ),
+            prompt_encoder=PromptEncoder(
+                embed_dim=256,
+                image_embedding_size=(64, 64),
+                input_image_size=(1024, 1024),
+                mask_in_chans=16,
+            ),
+            mask_decoder=MaskDecoder(
+                num_multimask_outputs=3,
+                transformer=TwoWayTransformer(depth=2, embedding_dim=256, mlp_dim=2048, num_heads=8),
+                transformer_dim=256,
+                iou_head_depth=3,
+                iou_head_hidden_dim=256,
+            ),
+            pixel_mean=[123.675, 116.28, 103.53],
+            pixel_std=[58.395, 57.12, 57.375],
+        )
+    finally:
+        torch.random.set_rng_state(generator_state)
+    return sam
+
+def tiny_predictor(device="cpu", seed=0):
+    sam = build_tiny_sam(seed)
+    sam.to(device=device)
+    sam.eval()
+    return SamPredictor(sam)
+
+class SleepingImageEncoder(torch.nn.Module):
+    """Image encoder stand-in: sleeps `pass_latency` plus `image_latency` per image, returns zero embeddings."""
+
+    def __init__(self, pass_latency, image_latency, img_size=1024, out_chans=256):
+        super().__init__()
+        self.pass_latency = pass_latency
+        self.image_latency = image_latency
+        # Read by SamPredictor to check the input size
+        self.img_size = img_size
+        self.out_chans = out_chans
+
+    def forward(self, x):
+        time.sleep(self.pass_latency + self.image_latency * x.shape[0])
+        side = self.img_size // 16
+        return x.new_zeros((x.shape[0], self.out_chans, side, side))
+
+class SleepingMaskDecoder(torch.nn.Module):
+    """
+    Mask decoder stand-in: sleeps `latency` per call and returns the same
+    ellipse covering the middle of the image for every prompt, so the masks
+    rendered and encoded after it are not empty.
+    """
+
+    def __init__(self, latency, low_res_size=256):
+        super().__init__()
+        self.latency = latency
+        y, x = torch.meshgrid(torch.linspace(-1, 1, low_res_size), torch.linspace(-1, 1, low_res_size), indexing="ij")
+        self.register_buffer("logits", 10.0 * (1 - (x / 0.6) ** 2 - (y / 0.5) ** 2), persistent=False)
+
+    def forward(self, image_embeddings, image_pe, sparse_prompt_embeddings, dense_prompt_embeddings, multimask_output):
+        time.sleep(self.latency)
+        count = 3 if multimask_output else 1
+        batch = sparse_prompt_embeddings.shape[0]
+        masks = self.logits.expand(batch, count, *self.logits.shape).contiguous()
+        return masks, masks.new_full((batch, count), 0.9)
+
+def stub_predictor(device="cpu", encoder_latency=0.0, image_latency=0.0, decoder_latency=0.0, seed=0):
+    """The tiny SAM with its image encoder and mask decoder replaced by ones that only sleep."""
+    sam = build_tiny_sam(seed)
+    sam.image_encoder = SleepingImageEncoder(encoder_latency, image_latency)
+    sam.mask_decoder = SleepingMaskDecoder(decoder_latency)
+    sam.to(device=device)
+    sam.eval()
+    return SamPredictor(sam)
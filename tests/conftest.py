@@ -0,0 +1,43 @@
+import io
+import os
+import time
+
+# Config is read at import time, so the server under test is set up here,
+# before any test imports it: the "stub" SAM (see stub_predictor.py) in the
+# test process, fast enough to run many requests
+os.environ.setdefault("SAM_MODEL_TYPE", "stub")
+os.environ.setdefault("SAM_DEVICE", "cpu")
+os.environ.setdefault("NUM_REPLICAS", "0")
+os.environ.setdefault("STUB_ENCODER_LATENCY", "0.05")
+os.environ.setdefault("STUB_ENCODER_IMAGE_LATENCY", "0.02")
+os.environ.setdefault("STUB_DECODER_LATENCY", "0.0")
+os.environ.setdefault("RESPONSE_CACHE_DIR", "")
+os.environ.setdefault("EMBEDDING_STORE_PATH", "")
+
+import numpy as np
+import pytest
+from PIL import Image
+
+
+def png_bytes(width=64, height=48, seed=0):
+    """A random RGB PNG, distinct per seed so neither cache answers for it."""
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope="session")
+def client():
+    """TestClient of the endpoint app, started in-process with the model ready."""
+    from fastapi.testclient import TestClient
+
+    import endpoint
+
+    # One client for the whole session: the scheduler runs on its event loop
+    with TestClient(endpoint.app) as client:
+        deadline = time.perf_counter() + 60
+        while client.get("/ready").status_code != 200:
+            assert time.perf_counter() < deadline, "stub model did not load"
+            time.sleep(0.05)
+        yield client
@@ -0,0 +1,112 @@
+import asyncio
+import base64
+import json
+
+import httpx
+
+from bulk_mask_generation_with_sam import Checkpoint, post_with_retry, process_images_async
+from conftest import png_bytes
+
+ENDPOINT = "http://stub/mask_image/"
+
+
+class StubServer:
+    """httpx.MockTransport handler answering like /mask_image/, optionally busy for the first requests."""
+
+    def __init__(self, output_folder, busy=0, retry_after="0"):
+        self.output_folder = str(output_folder)
+        self.busy = busy
+        self.retry_after = retry_after
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        if len(self.requests) <= self.busy:
+            return httpx.Response(503, headers={"Retry-After": self.retry_after}, json={"detail": "busy"})
+        mask = "data:image/png;base64," + base64.b64encode(png_bytes(8, 8)).decode("ascii")
+        return httpx.Response(200, json={"output": {"mask": mask, "folder_name": self.output_folder}})
+
+    @property
+    def targets(self):
+        # Images told apart by their payload, see write_entries
+        return [json.loads(request.content)["input"]["pos_coord"][0][0] for request in self.requests]
+
+
+def write_entries(tmp_path, names):
+    """Images and a coordinates file with one entry per name; entry i clicks at (i, i)."""
+    folder = tmp_path / "images"
+    folder.mkdir()
+    with open(tmp_path / "coords.jsonl", "w") as f:
+        for i, name in enumerate(names):
+            (folder / name).write_bytes(png_bytes(16, 16, seed=i))
+            f.write(json.dumps({"target": name, "coordinates": [[i, i]]}) + "\n")
+    return folder, tmp_path / "coords.jsonl"
+
+
+def run(tmp_path, server, folder, coords, **kwargs):
+    return asyncio.run(process_images_async(
+        str(folder), str(coords), ENDPOINT, concurrency=2, checkpoint_path=str(tmp_path / "checkpoint.jsonl"),
+        composite_workers=1, transport=httpx.MockTransport(server), **kwargs,
+    ))
+
+
+def test_retries_busy_server_after_retry_after(tmp_path):
+    server = StubServer(tmp_path, busy=2, retry_after="0")
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(server)) as client:
+            # With backoff alone the retries would take minutes
+            return await asyncio.wait_for(post_with_retry(client, ENDPOINT, {}, max_retries=3, backoff=60), timeout=5)
+
+    response = asyncio.run(main())
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+
+
+def test_gives_up_after_max_retries(tmp_path):
+    server = StubServer(tmp_path, busy=10)
+    folder, coords = write_entries(tmp_path, ["a.png"])
+    stats = run(tmp_path, server, folder, coords, max_retries=2)
+
+    assert len(server.requests) == 3
+    assert (stats.done, stats.failed) == (0, 1)
+
+
+def test_resumes_from_checkpoint(tmp_path):
+    server = StubServer(tmp_path / "masks")
+    folder, coords = write_entries(tmp_path, ["a.png", "b.png", "c.png"])
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.jsonl"))
+    checkpoint.mark(Checkpoint.key(1, "a.png"))
+    checkpoint.close()
+
+    stats = run(tmp_path, server, folder, coords)
+
+    assert sorted(server.targets) == [1, 2]
+    assert (stats.done, stats.skipped, stats.failed) == (2, 1, 0)
+    assert (tmp_path / "masks" / "masked_b.png").is_file()
+    assert (tmp_path / "masks" / "comparison_c.png").is_file()
+    # A second run finds everything done
+    assert run(tmp_path, server, folder, coords).skipped == 3
+    assert len(server.requests) == 2
+
+
+def test_unreadable_image_counts_as_failed(tmp_path):
+    server = StubServer(tmp_path / "masks")
+    folder, coords = write_entries(tmp_path, ["a.png", "b.png"])
+    # Exists, but cannot be read as a file
+    (folder / "a.png").unlink()
+    (folder / "a.png").mkdir()
+
+    stats = run(tmp_path, server, folder, coords)
+
+    assert server.targets == [1]
+    assert (stats.done, stats.failed) == (1, 1)
+
+
+def test_requests_are_sent_as_bulk(tmp_path):
+    server = StubServer(tmp_path / "masks")
+    folder, coords = write_entries(tmp_path, ["a.png", "b.png"])
+    run(tmp_path, server, folder, coords)
+
+    assert len(server.requests) == 2
+    assert all(request.headers["X-Priority"] == "bulk" for request in server.requests)
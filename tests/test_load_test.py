@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from load_test import Recorder, histogram_quantile, parse_histogram, percentiles, queue_wait_report, summarize
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_percentiles():
+    report = percentiles([float(v) for v in reversed(range(101))])
+    assert (report["p50"], report["p95"], report["p99"], report["max"]) == (50.0, 95.0, 99.0, 100.0)
+    assert report["mean"] == pytest.approx(50.0)
+    assert percentiles([]) == {}
+
+
+def test_histogram_quantile_interpolates_within_buckets():
+    buckets = {0.1: 10.0, 0.2: 20.0, float("inf"): 20.0}
+    assert histogram_quantile(0.5, buckets) == pytest.approx(0.1)
+    assert histogram_quantile(0.95, buckets) == pytest.approx(0.19)
+    assert histogram_quantile(0.5, {}) is None
+
+
+def test_queue_wait_report_counts_only_the_run():
+    text = "\n".join([
+        '# TYPE sam_queue_wait_seconds histogram',
+        'sam_queue_wait_seconds_bucket{le="0.1"} 4',
+        'sam_queue_wait_seconds_bucket{le="1.0"} 6',
+        'sam_queue_wait_seconds_bucket{le="+Inf"} 6',
+        'sam_queue_wait_seconds_sum 1.5',
+        'sam_queue_wait_seconds_count 6',
+    ])
+    before = parse_histogram(text, "sam_queue_wait_seconds")
+    after = parse_histogram(text.replace("} 6", "} 10").replace("} 4", "} 8").replace("_sum 1.5", "_sum 2.3"), "sam_queue_wait_seconds")
+
+    report = queue_wait_report(before, after)
+    assert report["count"] == 4
+    assert report["mean"] == pytest.approx(0.2)
+    assert report["buckets"] == {"0.1": 4, "1.0": 4, "+Inf": 4}
+
+
+def test_summary_reports_503s_and_their_retry_after():
+    recorder = Recorder()
+    for i in range(8):
+        recorder.record(float(i), 200, 0.1 * (i + 1))
+    recorder.record(8.0, 503, 0.01, retry_after=2.0)
+    recorder.record(9.0, 503, 0.01, retry_after=4.0)
+
+    report = summarize(recorder, 10, None)
+    assert report["statuses"] == {"200": 8, "503": 2}
+    assert report["rate_503"] == pytest.approx(0.2)
+    assert report["error_rate"] == pytest.approx(0.2)
+    assert report["latency_s"]["max"] == pytest.approx(0.8)
+    assert (report["retry_after_s"]["p50"], report["retry_after_s"]["max"]) == (2.0, 4.0)
+
+
+def run_load_test(tmp_path, *args):
+    """load_test.py against the stub server it starts itself; returns the JSON report."""
+    output = tmp_path / "report.json"
+    subprocess.run(
+        [sys.executable, os.path.join(REPO, "load_test.py"), "--max-payloads", "2", "--warmup", "1",
+         "--encoder-latency", "0.01", "--image-latency", "0.01", "--decoder-latency", "0",
+         "--ready-timeout", "60", "--output", str(output), *args],
+        check=True, timeout=180, capture_output=True,
+    )
+    with open(output) as f:
+        return json.load(f)
+
+
+def test_closed_loop_smoke(tmp_path):
+    report = run_load_test(tmp_path, "--concurrency", "2", "--requests", "6")
+
+    assert report["sent"] == 6
+    assert report["statuses"] == {"200": 6}
+    assert report["throughput_rps"] > 0
+    assert set(report["latency_s"]) == {"p50", "p95", "p99", "mean", "max"}
+    assert report["latency_s"]["p50"] <= report["latency_s"]["p99"] <= report["latency_s"]["max"]
+    # Scraped from the server's /metrics
+    assert report["queue_wait_s"]["count"] == 6
+    assert "model" in report["pipeline"]
+    assert report["config"]["requests"] == 6
+
+
+def test_overload_reports_retry_after(tmp_path):
+    # One queue slot, given up on almost at once: most of a burst gets a 503
+    report = run_load_test(
+        tmp_path, "--rate", "200", "--uniform", "--requests", "20", "--encoder-latency", "0.3",
+        "--server-env", "QUEUE_SIZE=1", "--server-env", "QUEUE_PUT_TIMEOUT=0.01",
+    )
+
+    assert report["sent"] == 20
+    assert report["statuses"].get("503", 0) > 0
+    assert report["rate_503"] == report["statuses"]["503"] / 20
+    assert report["retry_after_s"]["p50"] >= 1
@@ -0,0 +1,72 @@
+import asyncio
+import pickle
+import time
+
+from response_cache import ResponseCache, SingleFlight, size_of
+
+
+class LeaderTimedOut(Exception):
+    pass
+
+
+def test_memory_only_cache_does_not_pickle(monkeypatch):
+    def no_pickle(*args, **kwargs):
+        raise AssertionError("pickled without a disk tier")
+
+    monkeypatch.setattr(pickle, "dumps", no_pickle)
+    cache = ResponseCache(max_bytes=1000, ttl=60)
+    cache.put("a", {"mask": b"x" * 100, "shape": [4, 4]})
+    assert cache.get("a") == {"mask": b"x" * 100, "shape": [4, 4]}
+    assert cache.stats()["bytes"] == size_of({"mask": b"x" * 100, "shape": [4, 4]})
+
+
+def test_memory_cache_evicts_by_size():
+    cache = ResponseCache(max_bytes=250, ttl=60)
+    for key in "abc":
+        cache.put(key, b"x" * 100)
+    assert cache.get("a") is None
+    assert cache.get("c") == b"x" * 100
+    assert cache.stats()["evictions"] == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    ResponseCache(max_bytes=1000, ttl=60, disk_dir=str(tmp_path), disk_max_bytes=1000).put("a", b"mask")
+    cache = ResponseCache(max_bytes=1000, ttl=60, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    assert cache.get("a") == b"mask"
+    assert cache.stats()["disk_hits"] == 1
+
+
+def run_pair(leader_deadline, follower_deadline):
+    """A leader that fails at its deadline and a follower of the same key; returns the follower's outcome and the number of runs."""
+    flight = SingleFlight()
+    runs = []
+
+    async def process(deadline):
+        runs.append(deadline)
+        await asyncio.sleep(0.05)
+        if time.perf_counter() >= deadline:
+            raise LeaderTimedOut()
+        return "mask"
+
+    async def main():
+        start = time.perf_counter()
+        retry = lambda e: isinstance(e, LeaderTimedOut)
+        leader = asyncio.create_task(flight.run("k", lambda: process(start + leader_deadline), start + leader_deadline, retry))
+        await asyncio.sleep(0)
+        follower = flight.run("k", lambda: process(start + follower_deadline), start + follower_deadline, retry)
+        results = await asyncio.gather(leader, follower, return_exceptions=True)
+        return results[1], len(runs)
+
+    return asyncio.run(main())
+
+
+def test_follower_reruns_when_leader_runs_out_of_its_deadline():
+    result, runs = run_pair(leader_deadline=0.01, follower_deadline=5.0)
+    assert result == "mask"
+    assert runs == 2
+
+
+def test_follower_past_its_own_deadline_gives_up():
+    result, runs = run_pair(leader_deadline=0.01, follower_deadline=0.02)
+    assert isinstance(result, (LeaderTimedOut, asyncio.TimeoutError))
+    assert runs == 1
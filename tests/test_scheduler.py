@@ -0,0 +1,101 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from scheduler import MicroBatchScheduler
+
+
+@pytest.fixture
+def server(client):
+    """The model side of the running server, with the stub model loaded."""
+    import replica
+
+    return replica
+
+
+@pytest.fixture
+def encoder_passes(server, monkeypatch):
+    """Batch size of every image encoder pass of the stub model from here on."""
+    encoder = server.model.model.image_encoder
+    forward = encoder.forward
+    passes = []
+
+    def counting_forward(x):
+        passes.append(x.shape[0])
+        return forward(x)
+
+    monkeypatch.setattr(encoder, "forward", counting_forward)
+    return passes
+
+
+def image(height, width, seed):
+    # Sizes tell the callers' masks apart, the stub decoder draws the same shape for every prompt
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def run_jobs(server, jobs, max_batch_size, max_wait_ms):
+    """Submit every job at once to a scheduler over `segment_requests`; results or exceptions, in order."""
+    async def main():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            scheduler = MicroBatchScheduler(
+                server.segment_requests, executor, max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms, queue_size=len(jobs) + 1,
+            )
+            scheduler.start()
+            try:
+                submits = [scheduler.submit(i, job) for i, job in enumerate(jobs)]
+                return await asyncio.gather(*submits, return_exceptions=True)
+            finally:
+                await scheduler.stop()
+
+    return asyncio.run(main())
+
+
+def mask_job(server, height, width, seed):
+    return server.SegmentJob(None, np.array([[width // 2, height // 2]]), image=image(height, width, seed))
+
+
+def test_concurrent_requests_share_one_encoder_pass(server, encoder_passes):
+    sizes = [(40 + i, 60 + i) for i in range(4)]
+    jobs = [mask_job(server, height, width, seed=100 + i) for i, (height, width) in enumerate(sizes)]
+    results = run_jobs(server, jobs, max_batch_size=4, max_wait_ms=500)
+
+    assert encoder_passes == [4]
+    # Every caller gets the mask of its own image
+    assert [result.shape for result in results] == sizes
+
+
+def test_batches_are_capped_at_max_batch_size(server, encoder_passes):
+    jobs = [mask_job(server, 32, 32, seed=200 + i) for i in range(5)]
+    results = run_jobs(server, jobs, max_batch_size=2, max_wait_ms=500)
+
+    assert encoder_passes == [2, 2, 1]
+    assert all(result.shape == (32, 32) for result in results)
+
+
+def test_lone_request_is_sent_after_max_wait(server, encoder_passes):
+    results = run_jobs(server, [mask_job(server, 32, 32, seed=300)], max_batch_size=4, max_wait_ms=20)
+
+    assert encoder_passes == [1]
+    assert results[0].shape == (32, 32)
+
+
+def test_failing_jobs_do_not_fail_their_batch(server, encoder_passes):
+    jobs = [
+        mask_job(server, 40, 50, seed=400),
+        # Fails in the encoder pass: an RGBA image
+        server.SegmentJob(None, np.array([[5, 5]]), image=np.zeros((40, 50, 4), dtype=np.uint8)),
+        mask_job(server, 30, 20, seed=401),
+        # Fails in the decoder: coordinates of the wrong shape
+        server.SegmentJob(None, np.zeros((1, 3)), image=image(30, 30, seed=402)),
+    ]
+    results = run_jobs(server, jobs, max_batch_size=4, max_wait_ms=500)
+
+    assert results[0].shape == (40, 50)
+    assert isinstance(results[1], Exception)
+    assert results[2].shape == (30, 20)
+    assert isinstance(results[3], Exception)
+    # The stacked pass failed on the RGBA image, the other three were encoded on their own
+    assert sum(encoder_passes) == 3
@@ -0,0 +1,31 @@
+import base64
+
+import pytest
+
+from conftest import png_bytes
+
+OCTET_STREAM = {"Content-Type": "application/octet-stream"}
+NOT_AN_IMAGE = b"this is not an image"
+
+
+def data_uri(data):
+    return "data:image/png;base64," + base64.b64encode(data).decode("ascii")
+
+
+def test_mask_image_returns_mask(client):
+    payload = {"input": {"target_image": data_uri(png_bytes()), "pos_coord": [[10, 10]], "format": "bbox"}}
+    response = client.post("/mask_image/", json=payload)
+    assert response.status_code == 200
+    assert response.json()["output"]["area"] > 0
+
+
+@pytest.mark.parametrize("path, kwargs", [
+    ("/mask_image/", {"json": {"input": {"target_image": data_uri(NOT_AN_IMAGE), "pos_coord": [[10, 10]]}}}),
+    ("/mask_image/batch/", {"json": {"input": {"target_image": data_uri(NOT_AN_IMAGE), "prompts": [[[10, 10]]]}}}),
+    ("/embedding/", {"content": NOT_AN_IMAGE, "headers": OCTET_STREAM}),
+    ("/sessions/", {"content": NOT_AN_IMAGE, "headers": OCTET_STREAM}),
+])
+def test_undecodable_image_is_rejected(client, path, kwargs):
+    response = client.post(path, **kwargs)
+    assert response.status_code == 422
+    assert response.json()["detail"] == "Could not decode the image."
@@ -0,0 +1,264 @@
+import asyncio
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+
+# Request IDs and on-demand profiling. The server middleware gives every
+# request a random ID of its own and, when the request asks for it with an
+# X-Profile header or is sampled, a profile. A client's X-Request-ID is only
+# logged next to it and echoed back: two clients can send the same one, and
+# the server ID names the profile, which only its own client should find.
+# Both live in context variables, which follow the request onto the stage
+# threads (see pipeline.py), into its scheduler batch and over to the model
+# replicas, so its log lines can be told apart and the work done for it
+# anywhere can be profiled. A request that is not profiled pays for one
+# context variable lookup per stage.
+
+# ID of the request being worked on, "-" outside of requests; a batch on the
+# model runs under the IDs of all its requests, comma separated
+request_id_var = contextvars.ContextVar("request_id", default="-")
+# X-Request-ID the client sent with it, "-" for none, likewise comma separated
+client_request_id_var = contextvars.ContextVar("client_request_id", default="-")
+# RequestProfile of the request being worked on, None unless it is profiled
+profile_var = contextvars.ContextVar("profile", default=None)
+
+PROFILE_MODES = ("cprofile", "torch")
+# Stages torch.profiler traces; the others run no torch code worth tracing
+TORCH_STAGES = ("model", "decode")
+# Client request IDs are used as file names, so only short plain tokens are taken
+_REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,64}")
+# Only one torch.profiler can run at a time in a process
+_torch_profiler_lock = threading.Lock()
+
+
+def valid_request_id(value) -> bool:
+    return bool(value) and _REQUEST_ID.fullmatch(value) is not None
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+def client_request_id(header) -> str:
+    """The client's X-Request-ID if it is a short plain token, else "-"."""
+    return header if valid_request_id(header) else "-"
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the IDs of the current request to every log record, as `request_id` and `client_request_id`."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.client_request_id = client_request_id_var.get()
+        return True
+
+
+@contextmanager
+def bound_request_id(request_id, client_id="-"):
+    token = request_id_var.set(request_id)
+    client_token = client_request_id_var.set(client_id)
+    try:
+        yield
+    finally:
+        client_request_id_var.reset(client_token)
+        request_id_var.reset(token)
+
+
+def bind_batch(contexts):
+    """
+    Run the rest of the current task as the batch of requests whose contexts
+    are given: under all their IDs, and profiled if any of them is.
+    """
+    request_id_var.set(",".join(context.get(request_id_var, "-") for context in contexts))
+    client_request_id_var.set(",".join(context.get(client_request_id_var, "-") for context in contexts))
+    profile_var.set(next((context[profile_var] for context in contexts if context.get(profile_var) is not None), None))
+
+
+async def run_in_executor(executor, function, *args):
+    """`loop.run_in_executor` with the request ID and profile carried over to the executor thread."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, function, *args)
+
+
+def profile_mode(header, sample_rate, allow_header=True):
+    """
+    Profiling mode of a request: the one its X-Profile header asks for
+    ("1" means cprofile), else cprofile for a `sample_rate` share of
+    requests, else None.
+    """
+    if header and allow_header:
+        header = header.strip().lower()
+        return "cprofile" if header in ("1", "true") else header if header in PROFILE_MODES else None
+    if sample_rate > 0 and random.random() < sample_rate:
+        return "cprofile"
+    return None
+
+
+class _Stats:
+    """cProfile stats in the shape pstats.Stats reads them from a profiler."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class RequestProfile:
+    """
+    Profile of one request, captured stage by stage on whichever thread or
+    replica does its work: the cProfile stats of every stage, or in torch
+    mode a torch.profiler trace of the model stages. In a batch, the work of
+    the other requests in it is captured too.
+    """
+
+    def __init__(self, request_id, mode):
+        self.request_id = request_id
+        self.mode = mode
+        self.stats = []
+        self.events = []
+        self._lock = threading.Lock()
+
+    def call(self, stage, function, *args):
+        """Run `function(*args)` as `stage` of the request, profiled."""
+        if self.mode == "torch":
+            return self._trace(stage, function, *args) if stage in TORCH_STAGES else function(*args)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active (from Python 3.12 on, anywhere in the process)
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profiler.disable()
+            profiler.create_stats()
+            with self._lock:
+                self.stats.append(profiler.stats)
+
+    def _trace(self, stage, function, *args):
+        import torch
+        from torch.profiler import ProfilerActivity, profile, record_function
+
+        if not _torch_profiler_lock.acquire(blocking=False):
+            return function(*args)
+        try:
+            activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+            with profile(activities=activities) as profiler:
+                with record_function(f"{stage} {request_id_var.get()}"):
+                    result = function(*args)
+            fd, path = tempfile.mkstemp(suffix=".json")
+            os.close(fd)
+            try:
+                profiler.export_chrome_trace(path)
+                with open(path) as f:
+                    events = json.load(f).get("traceEvents", [])
+            finally:
+                os.remove(path)
+        finally:
+            _torch_profiler_lock.release()
+        with self._lock:
+            self.events.extend(events)
+        return result
+
+    def export(self):
+        with self._lock:
+            return list(self.stats), list(self.events)
+
+    def merge(self, exported):
+        """Add what `export` returned for the same request elsewhere, say on a replica."""
+        stats, events = exported
+        with self._lock:
+            self.stats.extend(stats)
+            self.events.extend(events)
+
+    @property
+    def extension(self):
+        return ".json" if self.mode == "torch" else ".prof"
+
+    def save(self, directory, max_files=None):
+        """
+        Write the profile to `directory` as <request id>.prof (pstats, for
+        snakeviz or `python -m pstats`) or .json (Chrome trace, for
+        chrome://tracing or Perfetto), keeping the newest `max_files`.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.request_id + self.extension)
+        stats, events = self.export()
+        tmp_path = path + ".tmp"
+        if self.mode == "torch":
+            with open(tmp_path, "w") as f:
+                json.dump({"traceEvents": events}, f)
+        else:
+            merged = pstats.Stats(_Stats(stats[0]) if stats else _Stats({}))
+            for stage_stats in stats[1:]:
+                merged.add(_Stats(stage_stats))
+            merged.dump_stats(tmp_path)
+        os.replace(tmp_path, path)
+        if max_files is not None:
+            _prune(directory, max_files)
+        return path
+
+
+def _prune(directory, max_files):
+    paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith((".prof", ".json"))]
+    if len(paths) <= max_files:
+        return
+    paths.sort(key=lambda path: os.stat(path).st_mtime)
+    for path in paths[:len(paths) - max_files]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def find_profile(directory, request_id):
+    """Path of the saved profile of `request_id`, or None."""
+    if not valid_request_id(request_id):
+        return None
+    for extension in (".prof", ".json"):
+        path = os.path.join(directory, request_id + extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def profiled(stage, function, *args):
+    """`function(*args)`, profiled as `stage` if the current request is being profiled."""
+    profile = profile_var.get()
+    if profile is None:
+        return function(*args)
+    return profile.call(stage, function, *args)
+
+
+def run_traced(request_ids, mode, function, *args):
+    """Replica side of `remote_call`. Returns the result and the exported profile, or None."""
+    request_id, client_id = request_ids
+    with bound_request_id(request_id, client_id):
+        if mode is None:
+            return function(*args), None
+        profile = RequestProfile(request_id, mode)
+        return profile.call("model", function, *args), profile.export()
+
+
+def remote_call(call, function, *args):
+    """
+    `call(function, *args)` for a `call` that runs it in another process,
+    like WorkerPool.call, with the request ID and profiling carried along.
+    """
+    profile = profile_var.get()
+    request_ids = request_id_var.get(), client_request_id_var.get()
+    result, exported = call(run_traced, request_ids, profile.mode if profile is not None else None, function, *args)
+    if exported is not None:
+        profile.merge(exported)
+    return result
@@ -3,13 +3,98 @@ import io
 from PIL import Image
 from io import BytesIO
 import random
-from PIL import Image, ImageDraw
 import numpy as np
+import torch
+from segment_anything.utils.transforms import ResizeLongestSide
+from config import logger, MASK_IMAGE_FORMAT, MASK_PNG_COMPRESS_LEVEL, MASK_WEBP_METHOD
+from embedding_cache import CachedEmbedding, embedding_key, set_image_cached
+from metrics import timed
 
-def image_to_base64(pil_image: Image.Image) -> str:
+# PIL mode and media type of each mask image encoding (MASK_IMAGE_FORMAT)
+MASK_IMAGE_ENCODINGS = {
+    "png": ("RGB", "image/png"),
+    "png-l": ("L", "image/png"),
+    "png-1bit": ("1", "image/png"),
+    "webp": ("L", "image/webp"),
+}
+
+if MASK_IMAGE_FORMAT not in MASK_IMAGE_ENCODINGS:
+    raise ValueError(f"Unknown MASK_IMAGE_FORMAT '{MASK_IMAGE_FORMAT}', expected one of {sorted(MASK_IMAGE_ENCODINGS)}.")
+
+@timed("png_encode")
+def image_to_png_bytes(pil_image: Image.Image, compress_level=MASK_PNG_COMPRESS_LEVEL) -> bytes:
     buffered = io.BytesIO()
-    pil_image.save(buffered, format="PNG")  # Adjust format as needed
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    pil_image.save(buffered, format="PNG", compress_level=compress_level)
+    return buffered.getvalue()
+
+@timed("webp_encode")
+def image_to_webp_bytes(pil_image: Image.Image, method=MASK_WEBP_METHOD) -> bytes:
+    """Lossless WebP; Pillow stores grayscale images as RGB."""
+    buffered = io.BytesIO()
+    pil_image.save(buffered, format="WEBP", lossless=True, method=method)
+    return buffered.getvalue()
+
+def mask_image_mode(encoding=MASK_IMAGE_FORMAT) -> str:
+    """PIL mode to render masks in for `encoding`."""
+    return MASK_IMAGE_ENCODINGS[encoding][0]
+
+def mask_media_type(encoding=MASK_IMAGE_FORMAT) -> str:
+    return MASK_IMAGE_ENCODINGS[encoding][1]
+
+def mask_image_bytes(pil_image: Image.Image, encoding=MASK_IMAGE_FORMAT) -> bytes:
+    """Encode a mask image rendered by `render_masks` as `encoding`."""
+    if encoding == "webp":
+        return image_to_webp_bytes(pil_image)
+    return image_to_png_bytes(pil_image)
+
+def encode_mask_image(masks, size, encoding=MASK_IMAGE_FORMAT) -> bytes:
+    """Render boolean masks white on black at `size` (width, height) and encode them as `encoding`."""
+    return mask_image_bytes(render_masks(masks, size, mode=mask_image_mode(encoding)), encoding)
+
+def image_to_base64(pil_image: Image.Image) -> str:
+    return base64.b64encode(image_to_png_bytes(pil_image)).decode('utf-8')
+
+@timed("decode")
+def bytes_to_image(image_data):
+    """Load encoded image bytes (PNG, JPEG, ...) into an RGB PIL image."""
+    try:
+        image = Image.open(BytesIO(image_data))
+        # Convert the image to RGB
+        rgb_image = image.convert('RGB')
+        return rgb_image
+    except IOError as e:
+        print(f"Error loading image data: {e}")
+        return None
+
+@timed("decode_model_image")
+def bytes_to_model_image(image_data, target_length=None):
+    """
+    Load encoded image bytes into an RGB PIL image no larger than the model
+    input: with `target_length` set, images whose longest side exceeds it are
+    decoded straight to the size SAM would resize them to. JPEGs are decoded
+    at a reduced DCT scale (draft mode), so a 5k photo is never materialized
+    at full resolution.
+
+    Returns the image and the (width, height) of the original, or
+    (None, None) if the data cannot be decoded.
+    """
+    try:
+        image = Image.open(BytesIO(image_data))
+        full_size = image.size
+        if target_length is not None and max(full_size) > target_length:
+            # Exactly the size ResizeLongestSide produces, so the predictor's
+            # input_size matches what the full image would have given
+            height, width = ResizeLongestSide.get_preprocess_shape(full_size[1], full_size[0], target_length)
+            # draft only picks a scale that keeps the image at least this big
+            image.draft("RGB", (width, height))
+            image = image.convert('RGB')
+            if image.size != (width, height):
+                image = image.resize((width, height), Image.BILINEAR, reducing_gap=2.0)
+            return image, full_size
+        return image.convert('RGB'), full_size
+    except IOError as e:
+        print(f"Error loading image data: {e}")
+        return None, None
 
 def base64_to_image(base64_string):
     try:
@@ -25,30 +110,37 @@ def base64_to_image(base64_string):
             return None
         
         # Load the image data into a PIL Image object
-        try:
-            image = Image.open(BytesIO(image_data))
-            # Convert the image to RGB
-            rgb_image = image.convert('RGB')
-            return rgb_image
-        except IOError as e:
-            print(f"Error loading image data: {e}")
-            return None
+        return bytes_to_image(image_data)
 
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         return None
 
-def run_sam(image_pil, coordinates, sam_predictor):
-    
-    size = image_pil.size
-
-    point_coords = coordinates
-    point_labels = np.ones(point_coords.shape[0])
+def original_size_for(image, full_size):
+    """SAM (height, width) of the full image when `image` (PIL or HWC array) is a downscaled stand-in for it."""
+    size = image.size if isinstance(image, Image.Image) else (image.shape[1], image.shape[0])
+    if full_size is None or tuple(full_size) == size:
+        return None
+    return full_size[1], full_size[0]
 
+def run_sam(image_pil, coordinates, sam_predictor, embedding_cache=None, full_size=None):
+    """
+    `full_size` is the (width, height) of the original when `image_pil` came
+    from `bytes_to_model_image`; coordinates and the returned mask are then
+    in original image pixels.
+    """
     image = np.array(image_pil)
-    sam_predictor.set_image(image)
+    set_image_cached(sam_predictor, image, embedding_cache, original_size_for(image_pil, full_size))
 
-    print(f"shape of image: {image.shape}")
+    logger.debug(f"shape of image: {image.shape}")
+
+    return predict_mask_image(sam_predictor, coordinates, full_size or image_pil.size)
+
+@timed("predict_masks")
+def predict_masks(sam_predictor, coordinates):
+    """Predict boolean masks for positive `coordinates` on the image currently set on the predictor."""
+    point_coords = coordinates
+    point_labels = np.ones(point_coords.shape[0])
 
     masks, _, _ = sam_predictor.predict(
         point_coords=point_coords,
@@ -56,16 +148,190 @@ def run_sam(image_pil, coordinates, sam_predictor):
         box=None,
         multimask_output=False,
     )
+    return masks
 
-    mask_image = Image.new('RGB', size, color=(0, 0, 0, 0))
-    mask_draw = ImageDraw.Draw(mask_image)
-    for mask in masks:
-        draw_mask(mask, mask_draw, random_color=False)
+def predict_mask_image(sam_predictor, coordinates, size):
+    """Predict and render the mask for `coordinates` on the image currently set on the predictor."""
+    masks = predict_masks(sam_predictor, coordinates)
+    return render_masks(masks, size, random_color=False, mode=mask_image_mode())
 
-    mask_image.save("masked.png")
-    return mask_image
+@timed("predict_refined_mask")
+def predict_refined_mask(sam_predictor, point_coords=None, point_labels=None, box=None, mask_input=None):
+    """
+    Predict one mask on the image currently set on the predictor from
+    positive (label 1) and negative (label 0) points and/or an XYXY box,
+    refined from `mask_input`, the low-res logits of the previous prediction.
+    Returns the HxW boolean mask, its predicted IoU and its 1x256x256 logits.
+    """
+    # A single click is ambiguous: let SAM propose three masks and keep the best
+    multimask = mask_input is None and box is None and point_coords is not None and len(point_coords) == 1
+    masks, scores, logits = sam_predictor.predict(
+        point_coords=point_coords,
+        point_labels=point_labels,
+        box=box,
+        mask_input=mask_input,
+        multimask_output=multimask,
+    )
+    best = int(np.argmax(scores))
+    return masks[best], float(scores[best]), logits[best:best + 1]
+
+@timed("encode_images")
+@torch.no_grad()
+def encode_images(sam_predictor, images, embedding_cache=None, original_sizes=None):
+    """
+    Compute SAM embeddings for a list of HWC uint8 images, running the image
+    encoder once on a stacked batch of every image not already in the cache.
+    Images with identical content in the same batch are encoded only once.
+
+    `original_sizes` optionally gives, per image, the (height, width) of the
+    original that a downscaled image stands in for, or None.
+
+    Returns one `CachedEmbedding` per input image, in order; pass it to
+    `restore_embedding` to make the predictor ready for `predict`.
+    """
+    sam = sam_predictor.model
+    target_length = sam_predictor.transform.target_length
+    if original_sizes is None:
+        original_sizes = [None] * len(images)
+    keys = [embedding_key(image, size) for image, size in zip(images, original_sizes)]
+
+    embeddings = {}
+    for key in keys:
+        if embedding_cache is None or key in embeddings:
+            continue
+        entry = embedding_cache.get(key)
+        if entry is not None and entry.target_length == target_length:
+            embeddings[key] = entry
+
+    misses = {}
+    for key, image, original_size in zip(keys, images, original_sizes):
+        if key not in embeddings and key not in misses:
+            misses[key] = image, original_size
+
+    if misses:
+        input_images = []
+        input_sizes = []
+        for image, _ in misses.values():
+            if sam.image_format != "RGB":
+                image = image[..., ::-1]
+            input_image = sam_predictor.transform.apply_image(image)
+            input_image_torch = torch.as_tensor(input_image, device=sam_predictor.device)
+            input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+            input_sizes.append(tuple(input_image_torch.shape[-2:]))
+            # preprocess pads every image to the same square, so they stack
+            input_images.append(sam.preprocess(input_image_torch))
+
+        features = sam.image_encoder(torch.cat(input_images))
+
+        for i, (key, (image, original_size)) in enumerate(misses.items()):
+            entry = CachedEmbedding(
+                # clone so each cached entry does not pin the whole batch tensor
+                features=features[i:i + 1].clone(),
+                original_size=tuple(original_size or image.shape[:2]),
+                input_size=input_sizes[i],
+                target_length=target_length,
+            )
+            embeddings[key] = entry
+            if embedding_cache is not None:
+                embedding_cache.put(key, entry)
+
+    return [embeddings[key] for key in keys]
+
+def parse_coordinates(pos_coord):
+    """Convert request coordinates into an Nx2 array of [x, y] points."""
+    pos_coord = np.array(pos_coord)
+    if pos_coord.ndim == 1:
+        # Reshape flat list to list of lists
+        pos_coord = pos_coord.reshape(-1, 2)
+    elif pos_coord.ndim != 2 or pos_coord.shape[1] != 2:
+        raise ValueError("pos_coord must be a list of [x, y] coordinate pairs.")
+    return pos_coord
+
+@timed("predict_prompt_groups")
+@torch.no_grad()
+def predict_prompt_groups(sam_predictor, prompt_groups):
+    """
+    Decode several independent point prompts against the image currently set
+    on the predictor. Groups are bucketed by point count and every bucket is
+    decoded in one batched mask-decoder call, so no padding points are added
+    and each mask is identical to what `predict` returns for that group alone.
 
-def draw_mask(mask, draw, random_color=False):
+    Masks are upsampled to the original size one at a time so that memory
+    stays bounded by a single full-resolution mask on large images.
+    """
+    sam = sam_predictor.model
+    buckets = {}
+    for index, group in enumerate(prompt_groups):
+        buckets.setdefault(len(group), []).append(index)
+
+    masks = [None] * len(prompt_groups)
+    for indices in buckets.values():
+        point_coords = np.stack([prompt_groups[i] for i in indices]).astype(np.float32)
+        point_labels = np.ones(point_coords.shape[:2], dtype=np.float32)
+
+        coords_torch = sam_predictor.transform.apply_coords_torch(
+            torch.as_tensor(point_coords, device=sam_predictor.device), sam_predictor.original_size
+        )
+        labels_torch = torch.as_tensor(point_labels, device=sam_predictor.device)
+
+        sparse_embeddings, dense_embeddings = sam.prompt_encoder(
+            points=(coords_torch, labels_torch),
+            boxes=None,
+            masks=None,
+        )
+        low_res_masks, _ = sam.mask_decoder(
+            image_embeddings=sam_predictor.features,
+            image_pe=sam.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=False,
+        )
+
+        for i, low_res_mask in zip(indices, low_res_masks):
+            mask = sam.postprocess_masks(low_res_mask[None], sam_predictor.input_size, sam_predictor.original_size)
+            masks[i] = (mask[0] > sam.mask_threshold).cpu().numpy()
+    return masks
+
+def run_sam_batch(image_pil, prompt_groups, sam_predictor, embedding_cache=None, full_size=None):
+    """
+    Encode `image_pil` once and return one rendered mask image per entry of
+    `prompt_groups` (each an Nx2 array of positive points). `full_size` as in
+    `run_sam`.
+    """
+    image = np.array(image_pil)
+    set_image_cached(sam_predictor, image, embedding_cache, original_size_for(image_pil, full_size))
+
+    return predict_mask_images(sam_predictor, prompt_groups, full_size or image_pil.size)
+
+def predict_mask_images(sam_predictor, prompt_groups, size):
+    """Predict and render one mask per prompt group on the image currently set on the predictor."""
+    masks = predict_prompt_groups(sam_predictor, prompt_groups)
+    return [render_masks(mask, size, random_color=False, mode=mask_image_mode()) for mask in masks]
+
+@timed("render")
+def render_masks(masks, size, random_color=False, mode="RGB"):
+    """
+    Render boolean masks onto a black image of `size` (width, height).
+    Later masks are painted over earlier ones. Masks are white unless
+    `random_color`; in "L" or "1" `mode` they are rendered as a single plane.
+    """
+    width, height = size
+    if mode != "RGB" and not random_color:
+        mask = np.zeros((height, width), dtype=bool)
+        for m in masks:
+            mask |= np.asarray(m, dtype=bool)
+        if mode == "1":
+            return Image.fromarray(mask)
+        return Image.fromarray(np.multiply(mask, 255, dtype=np.uint8))
+    # Channel-planar canvas: each channel is a contiguous HxW plane, which is
+    # much cheaper to fill than an interleaved HxWx3 array
+    canvas = np.zeros((3, height, width), dtype=np.uint8)
+    for mask in masks:
+        draw_mask(mask, canvas, random_color=random_color)
+    return Image.merge("RGB", [Image.fromarray(channel) for channel in canvas])
+
+def draw_mask(mask, canvas, random_color=False):
+    """Paint the foreground pixels of `mask` onto a 3xHxW uint8 `canvas` in place."""
     if random_color:
         color = (random.randint(0, 255), random.randint(
             0, 255), random.randint(0, 255), 153)
@@ -74,8 +340,7 @@ def draw_mask(mask, draw, random_color=False):
         color = (255, 255, 255, 255)
         # color = (245, 165, 0, 0)
 
-
-    nonzero_coords = np.transpose(np.nonzero(mask))
-
-    for coord in nonzero_coords:
-        draw.point(coord[::-1], fill=color)
\ No newline at end of file
+    # The canvas is RGB, so the alpha component is dropped as ImageDraw did
+    mask = np.asarray(mask, dtype=bool)
+    for channel, value in zip(canvas, color[:3]):
+        np.copyto(channel, value, where=mask)
@@ -0,0 +1,360 @@
+import itertools
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import connection
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch
+
+from config import logger
+from metrics import REPLICA_RESTARTS, REPLICAS_READY
+
+# Index of the replica this process is, None in the front process
+REPLICA = None
+
+# Longest wait between restarts of a replica that keeps dying before it is ready
+MAX_RESTART_DELAY = 60.0
+
+
+class ReplicaUnavailable(Exception):
+    """Raised by `WorkerPool.call` when no replica is ready, or the replica running the call died."""
+
+
+class SharedArray:
+    """
+    A numpy array handed to a replica through shared memory. Only the block
+    name, shape and dtype are pickled; the replica copies the data out with
+    `read`, and the front process frees the block with `unlink` once the
+    call returned.
+    """
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._shm = None
+
+    @classmethod
+    def copy_from(cls, array):
+        array = np.ascontiguousarray(array)
+        shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        shared = cls(shm.name, array.shape, array.dtype)
+        shared._shm = shm
+        return shared
+
+    def read(self):
+        """Copy of the array, in the replica."""
+        # Replicas share the front process's resource tracker, which already
+        # knows the block; the front process unlinks it
+        shm = SharedMemory(name=self.name)
+        try:
+            return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+
+    def unlink(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype, "_shm": None}
+
+
+def replica_devices(num_replicas, devices=""):
+    """
+    Device of each replica: the comma separated `devices` list, cycled, or
+    else one CUDA device per replica round-robin, or the CPU.
+    """
+    if devices:
+        names = [d.strip() for d in devices.split(",") if d.strip()]
+    elif torch.cuda.is_available():
+        names = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    else:
+        names = ["cpu"]
+    return [names[i % len(names)] for i in range(num_replicas)]
+
+
+def split_cores(count):
+    """Split the cores this process may run on into `count` disjoint, contiguous sets."""
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < count:
+        # Fewer cores than CPU replicas: they have to share
+        return [cores] * count
+    size, extra = divmod(len(cores), count)
+    sets, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+
+def _dumps(message):
+    try:
+        return pickle.dumps(message)
+    except Exception as e:
+        # Most likely an exception or result type that does not pickle
+        return pickle.dumps(message[:2] + (False, RuntimeError(f"Unpicklable result: {e!r}")))
+
+
+def _replica_main(index, device, cores, load, conn):
+    global REPLICA
+    REPLICA = index
+    if cores:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+    try:
+        info = load(device)
+    except Exception as e:
+        logger.exception(f"Replica {index} failed to load")
+        conn.send_bytes(pickle.dumps(("failed", repr(e))))
+        raise SystemExit(1)
+    conn.send_bytes(pickle.dumps(("ready", info)))
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            # The front process went away
+            return
+        if message is None:
+            return
+        task_id, function, args, kwargs = message
+        try:
+            reply = ("result", task_id, True, function(*args, **kwargs))
+        except Exception as e:
+            reply = ("result", task_id, False, e)
+        conn.send_bytes(_dumps(reply))
+
+
+class _Replica:
+    def __init__(self, index, device, cores):
+        self.index = index
+        self.device = device
+        self.cores = cores
+        self.process = None
+        self.conn = None
+        self.ready = False
+        # task id -> Future of the calls sent to this replica and not answered yet
+        self.in_flight = {}
+        self.send_lock = threading.Lock()
+        self.restarts = 0
+        # Deaths in a row without becoming ready, for the restart backoff
+        self.failures = 0
+        self.restart_at = 0.0
+        self.error = None
+
+    def status(self):
+        return {
+            "replica": self.index,
+            "device": self.device,
+            "cores": len(self.cores) if self.cores else None,
+            "ready": self.ready,
+            "in_flight": len(self.in_flight),
+            "restarts": self.restarts,
+            "error": self.error,
+        }
+
+
+class WorkerPool:
+    """
+    `num_replicas` model processes, each running `load(device)` once (it
+    returns a picklable info dict, see `info`) and then any module-level
+    function sent with `call`. Calls go to the ready replica with the fewest
+    calls in flight. CPU replicas are pinned to disjoint sets of cores. A
+    replica that dies fails its in-flight calls with ReplicaUnavailable and is
+    started again, with backoff if it keeps failing before it is ready.
+    """
+
+    def __init__(self, load, num_replicas, devices="", restart_delay=1.0):
+        self.load = load
+        self.restart_delay = restart_delay
+        device_names = replica_devices(num_replicas, devices)
+        cpu_replicas = [i for i, device in enumerate(device_names) if device == "cpu"]
+        core_sets = dict(zip(cpu_replicas, split_cores(len(cpu_replicas)))) if cpu_replicas else {}
+        self.replicas = [_Replica(i, device, core_sets.get(i)) for i, device in enumerate(device_names)]
+        # From the first replica that became ready, e.g. the model input size
+        self.info = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._task_ids = itertools.count()
+        self._stopping = False
+        self._monitor_thread = None
+        REPLICAS_READY.set_function(self.ready_count)
+
+    def start(self):
+        for replica in self.replicas:
+            self._spawn(replica)
+        self._monitor_thread = threading.Thread(target=self._monitor, name="worker-pool-monitor", daemon=True)
+        self._monitor_thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping = True
+        for replica in self.replicas:
+            if replica.process is None:
+                continue
+            try:
+                with replica.send_lock:
+                    replica.conn.send(None)
+            except OSError:
+                pass
+        for replica in self.replicas:
+            if replica.process is None:
+                continue
+            replica.process.join(timeout)
+            if replica.process.is_alive():
+                replica.process.terminate()
+        if self._monitor_thread is not None:
+            self._monitor_thread.join(timeout)
+
+    def ready_count(self) -> int:
+        return sum(replica.ready for replica in self.replicas)
+
+    def status(self):
+        return [replica.status() for replica in self.replicas]
+
+    def _spawn(self, replica):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_replica_main,
+            args=(replica.index, replica.device, replica.cores, self.load, child_conn),
+            name=f"sam-replica-{replica.index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        replica.process, replica.conn = process, parent_conn
+        cores = f" on {len(replica.cores)} cores" if replica.cores else ""
+        logger.info(f"Started replica {replica.index} (pid {process.pid}) on {replica.device}{cores}")
+
+    def _handle_message(self, replica, message):
+        kind = message[0]
+        if kind == "ready":
+            replica.ready, replica.failures, replica.error = True, 0, None
+            if not self.info:
+                self.info = message[1]
+            logger.info(f"Replica {replica.index} is ready")
+        elif kind == "failed":
+            replica.error = message[1]
+        elif kind == "result":
+            _, task_id, ok, value = message
+            with self._lock:
+                future = replica.in_flight.pop(task_id, None)
+            if future is None:
+                return
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _receive(self, replica):
+        """Handle one message from `replica`, False once its end of the pipe is closed."""
+        try:
+            data = replica.conn.recv_bytes()
+        except (EOFError, OSError):
+            # The replica died, its sentinel reports it
+            return False
+        self._handle_message(replica, pickle.loads(data))
+        return True
+
+    def _on_exit(self, replica):
+        # Answers sent right before the replica died
+        while replica.conn.poll() and self._receive(replica):
+            pass
+        exitcode = replica.process.exitcode
+        with self._lock:
+            failed, replica.in_flight = replica.in_flight, {}
+            was_ready, replica.ready = replica.ready, False
+        for future in failed.values():
+            future.set_exception(ReplicaUnavailable(f"Replica {replica.index} exited with code {exitcode}."))
+        replica.conn.close()
+        replica.process, replica.conn = None, None
+        if self._stopping:
+            return
+
+        replica.failures = 0 if was_ready else replica.failures + 1
+        delay = min(self.restart_delay * 2 ** max(replica.failures - 1, 0), MAX_RESTART_DELAY)
+        replica.restart_at = time.monotonic() + delay
+        replica.restarts += 1
+        REPLICA_RESTARTS.inc()
+        logger.warning(f"Replica {replica.index} exited with code {exitcode} ({len(failed)} calls failed), "
+                       f"restarting in {delay:.0f}s")
+
+    def _monitor(self):
+        while not self._stopping:
+            running = [replica for replica in self.replicas if replica.process is not None]
+            by_handle = {}
+            for replica in running:
+                by_handle[replica.conn] = replica
+                by_handle[replica.process.sentinel] = replica
+            for handle in connection.wait(list(by_handle), timeout=0.5):
+                replica = by_handle[handle]
+                if handle is replica.conn:
+                    self._receive(replica)
+            if self._stopping:
+                return
+            for replica in self.replicas:
+                if replica.process is not None and not replica.process.is_alive():
+                    self._on_exit(replica)
+                elif replica.process is None and time.monotonic() >= replica.restart_at:
+                    self._spawn(replica)
+
+    def _track(self, replica):
+        """Register a new call on `replica`; the caller holds the pool lock."""
+        task_id = next(self._task_ids)
+        future = Future()
+        replica.in_flight[task_id] = future
+        return task_id, future
+
+    def _transmit(self, replica, task_id, function, args, kwargs):
+        try:
+            with replica.send_lock:
+                replica.conn.send((task_id, function, args, kwargs))
+        except (OSError, AttributeError) as e:
+            # Died since it was picked, AttributeError once its conn is gone
+            with self._lock:
+                replica.in_flight.pop(task_id, None)
+            raise ReplicaUnavailable(f"Replica {replica.index} went away: {e}")
+
+    def call(self, function, *args, **kwargs):
+        """Run `function(*args, **kwargs)` on the least loaded ready replica and return its result."""
+        with self._lock:
+            ready = [replica for replica in self.replicas if replica.ready]
+            if not ready:
+                raise ReplicaUnavailable("No model replica is ready.")
+            replica = min(ready, key=lambda r: (len(r.in_flight), r.index))
+            task_id, future = self._track(replica)
+        self._transmit(replica, task_id, function, args, kwargs)
+        return future.result()
+
+    def call_each(self, function, *args, timeout=None, **kwargs):
+        """
+        Run `function` on every ready replica. Returns the results in replica
+        order, leaving out replicas that failed or did not answer in `timeout`.
+        """
+        with self._lock:
+            calls = [(replica,) + self._track(replica) for replica in self.replicas if replica.ready]
+        futures = []
+        for replica, task_id, future in calls:
+            try:
+                self._transmit(replica, task_id, function, args, kwargs)
+                futures.append(future)
+            except ReplicaUnavailable:
+                continue
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results = []
+        for future in futures:
+            try:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                results.append(future.result(remaining))
+            except Exception:
+                continue
+        return results